@@ -1,20 +1,215 @@
+import json
 from flask_api import FlaskAPI, exceptions
+from flask_api.settings import perform_imports
 from flask_sqlalchemy import SQLAlchemy
 from instance.config import app_config
-from flask import request, jsonify
-from app import helpers
+from flask import request, Response, stream_with_context, g
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from app import helpers, schemas
+from app.cache import cache
+from app.helpers import ApiError, jsonify
+from app.metrics import metrics
+from app.pool import InstrumentedQueuePool
 
 db = SQLAlchemy()
 
 
 def create_app(config_name):
-    from app.models import Car, Branch, Driver
+    from app.models import Car, Branch, Driver, get_version, commit, natural_key
 
     app = FlaskAPI(__name__, instance_relative_config=True)
     app.config.from_object(app_config[config_name])
     app.config.from_pyfile('config.py')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+                                                   poolclass=InstrumentedQueuePool)
+    # FlaskAPI imports parsers and renderers by name on every request, resolve them once. Without the browsable API
+    # responses are only ever rendered as JSON
+    renderers = ['flask_api.renderers.JSONRenderer']
+    if app.config['BROWSABLE_API']:
+        renderers.append('flask_api.renderers.BrowsableAPIRenderer')
+    app.config['DEFAULT_RENDERERS'] = perform_imports(renderers, 'DEFAULT_RENDERERS')
+    app.config['DEFAULT_PARSERS'] = app.api_settings.DEFAULT_PARSERS
     db.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+
+    def list_page(model, params, args, owner=None):
+        """
+        Gets one page of records using keyset pagination on id
+        :param model: model class to list
+        :param params: validated filters
+        :param args: request args holding limit and after
+        :param owner: (model, id, not found message) of the driver or branch the records belong to
+        :return: JSON of records on the page and cursor for the next one
+        """
+        limit = helpers.validate_limit(args.get('limit'))
+        after = helpers.decode_cursor(args['after']) if args.get('after') else None
+
+        # Ask for one extra row to know if there is a next page
+        rows = model.get_page(params, limit + 1, after)
+        # Only an empty page has to be told apart from an owner that doesn't exist
+        if owner and not rows and get_version(owner[0], owner[1]) is None:
+            raise ApiError(404, owner[2])
+        next_cursor = helpers.encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+        return helpers.json_response({"status_code": 200, "items": [model.serialize_row(row) for row in rows[:limit]],
+                                      "next": next_cursor})
+
+    def export_response(model):
+        """
+        Streams every record of a model as NDJSON, one object per line, straight from column tuples
+        :param model: model class to export
+        :return: streamed response
+        """
+        def generate():
+            for rows in model.export():
+                yield b''.join(helpers.dumps(model.serialize_row(row)) + b'\n' for row in rows)
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def conditional_get(model, params, not_found):
+        """
+        Gets a serialized record with a strong ETag built from its version. Answers If-None-Match with 304, for lookups
+        by id alone that's decided from the cache or the version column, without loading the whole row
+        :param model: model class
+        :param params: validated search params
+        :param not_found: message when no record matches
+        :return: JSON of an object, 304 or 404 status
+        """
+        if request.if_none_match and list(params.keys()) == ['id']:
+            record = cache.peek(model, params['id'])
+            version = record['version'] if record else get_version(model, params['id'])
+            if version is not None:
+                etag = helpers.make_etag(model.__tablename__, params['id'], version)
+                if request.if_none_match.contains_weak(etag):
+                    return helpers.not_modified(etag)
+
+        record = cache.get_serialized(model, params)
+        if not record:
+            return jsonify({"status_code": 404, "message": not_found})
+
+        etag = helpers.make_etag(model.__tablename__, record['id'], record['version'])
+        if request.if_none_match.contains_weak(etag):
+            return helpers.not_modified(etag)
+        response = helpers.json_response(record)
+        response.set_etag(etag)
+        return response
+
+    def get_many(model):
+        """
+        Gets records by id in one query, ids=1,2,3 in the query string or {"ids": [1, 2, 3]} in a POST body for long
+        lists
+        :param model: model class
+        :return: JSON of the records found in the order of ids and the ids that weren't found
+        """
+        data = request.data if request.method == "POST" else request.args
+        try:
+            if not hasattr(data, 'keys'):
+                raise ApiError(400, "Invalid request")
+            ids = schemas.get_many(data)['ids']
+            records = cache.get_many_serialized(model, ids)
+            return helpers.json_response({"status_code": 200, "items": [records[id] for id in ids if id in records],
+                                          "missing": [id for id in ids if id not in records]})
+        except Exception as e:
+            return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    def upsert(model, validate, name):
+        """
+        Inserts records that are new and updates the ones that changed, matched on the model's natural key (upsert_key).
+        Body is a JSON array or NDJSON like /car/bulk_create, valid records are written in one transaction
+        :param model: Branch or Driver
+        :param validate: schema function of a record
+        :param name: plural name of the records in messages
+        :return: JSON with numbers of records inserted, updated and unchanged and errors for records that were rejected
+        """
+        try:
+            records = helpers.parse_bulk(request)
+            rows, errors = helpers.validate_upsert(records, validate, lambda row: natural_key(model, row))
+            inserted = updated = 0
+            if rows:
+                inserted, updated = model.upsert(rows)
+                commit()
+
+            return jsonify(helpers.upsert_result(name, len(rows), inserted, updated, errors))
+        except Exception as e:
+            return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    def dispatch(sub):
+        """
+        Runs a sub-request of /batch through the URL map and view function of its path. Request hooks don't run for
+        it, so metrics count the batch as one request
+        :param sub: validated sub-request
+        :return: HTTP status and body, parsed when it's JSON, None when it's empty
+        """
+        builder = EnvironBuilder(path=sub['path'], method=sub['method'], query_string=sub['query'] or None,
+                                 data=helpers.dumps(sub['body']) if sub['body'] is not None else None,
+                                 content_type='application/json')
+        with app.request_context(builder.get_environ()):
+            try:
+                response = app.make_response(app.dispatch_request())
+            except HTTPException as e:
+                return e.code, {"status_code": e.code, "message": e.name}
+            except exceptions.APIException as e:
+                return e.status_code, {"status_code": e.status_code, "message": e.detail}
+            body = response.get_data()
+        if not body:
+            return response.status_code, None
+        if response.mimetype == 'application/json':
+            return response.status_code, json.loads(body)
+        return response.status_code, body.decode()
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        """
+        Runs up to 20 sub-requests to the other endpoints in order, in one request, transaction and database
+        connection. Each one that fails is rolled back on its own (to a savepoint), with atomic the first one that
+        fails rolls back all of them and the rest don't run
+        Endpoint URL: /batch
+        :return: JSON with status and body of every sub-request run or exception response
+        """
+        if request.method == "POST":
+            try:
+                data = {"requests": request.data} if isinstance(request.data, list) else request.data
+                if not hasattr(data, 'keys'):
+                    raise ApiError(400, "Invalid request")
+                values = schemas.batch(data)
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+            responses = []
+            g.batch = True  # turns commit() of the sub-requests into a flush, see models.commit
+            try:
+                for index, sub in enumerate(values['requests']):
+                    savepoint = None
+                    if not values['atomic'] and sub['method'] != 'GET':
+                        savepoint = db.session.begin_nested()
+                    status_code, body = dispatch(sub)
+                    responses.append({"status_code": status_code, "body": body})
+                    if isinstance(body, dict) and isinstance(body.get('status_code'), int):
+                        status_code = max(status_code, body['status_code'])  # errors come with HTTP 200
+
+                    if values['atomic'] and status_code >= 400:
+                        db.session.rollback()
+                        return helpers.json_response({"status_code": status_code, "message": "Batch rolled back",
+                                                      "failed": index, "responses": responses})
+                    if savepoint is not None and status_code >= 400:
+                        savepoint.rollback()
+                    elif savepoint is not None:
+                        savepoint.commit()
+                db.session.commit()
+            finally:
+                g.batch = False
+            return helpers.json_response({"status_code": 200, "responses": responses})
+
+    @app.route('/cache/stats', methods=['GET'])
+    def cache_stats():
+        """
+        Shows hit, miss and eviction counters of this worker's record cache
+        Endpoint URL: /cache/stats
+        :return: JSON of cache counters
+        """
+        return jsonify(dict(status_code=200, **cache.stats()))
 
     @app.route('/car/create', methods=['POST'])
     def car_create():
@@ -30,65 +225,103 @@ def create_app(config_name):
 
             try:
                 # Find and validate required parameters in order to create car record
-                make = helpers.check_missing('list', request_data, 'make')
-                make = helpers.validate_string(make, 'make')
-                model = helpers.check_missing('list', request_data, 'model')
-                model = helpers.validate_string(model, 'model')
-                year = helpers.check_missing('list', request_data, 'year')
-                year = helpers.validate_year(year)
-                assigned_type = helpers.check_missing('list', request_data, 'assigned_type')
-                assigned_id = helpers.check_missing('list', request_data, 'assigned_id')
-                assigned_id = helpers.validate_int(assigned_id, 'assigned_id')
+                values = schemas.car_create(request_data)
 
                 # Validate the assigned type and id, more logic for assigning in a helper function
-                assigned_type, assigned_id = helpers.validate_assigning(assigned_type, assigned_id)
+                assigned_type, assigned_id = helpers.validate_assigning(values['assigned_type'], values['assigned_id'])
 
                 # Create object and save it in the database
-                car = Car(make, model, year, assigned_type, assigned_id)
+                car = Car(values['make'], values['model'], values['year'], assigned_type, assigned_id)
                 car.save()
                 return jsonify({"status_code": 201, "message": "Car created"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
-    @app.route('/car/get', methods=['GET'])
+    @app.route('/car/bulk_create', methods=['POST'])
+    def car_bulk_create():
+        """
+        Creates many car records in one transaction. Body is a JSON array or NDJSON, one car per item
+        Endpoint URL: /car/bulk_create
+        :return: JSON with number of cars created and errors for rows that were rejected
+        """
+        if request.method == "POST":
+            try:
+                records = helpers.parse_bulk(request)
+
+                # Validate every row on its own first, then check assignments for all valid rows together
+                cars, errors = helpers.validate_bulk(records)
+                errors.update(helpers.validate_assigning_bulk(cars))
+
+                # Insert all rows that passed validation with a single commit
+                rows = [car for index, car in cars if index not in errors]
+                if rows:
+                    Car.bulk_insert(rows)
+                    commit()
+
+                return jsonify(helpers.bulk_result(len(rows), errors))
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/car/get', methods=['GET', 'POST'])
     def car_get():
         """
-        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params
+        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params.
+        With expand=assignee the car's driver or branch is embedded. With ids (query string or POST body) gets all
+        records with those ids instead
         Endpoint URL: /car/get
-        :return: JSON of an object or exception status
+        :return: JSON of an object, of a list of objects or exception status
         """
+        if request.method == "POST" or "ids" in request.args:
+            return get_many(Car)
+
         if request.method == "GET":
             if request.args is None:
                 return jsonify({"status_code": 400, "message": "Invalid request"})
 
             try:
-                params = {}  # list of params that we will search by
-                # Check if any of the parameters are being passed and then validate them
-                if "id" in request.args.keys():
-                    params['id'] = helpers.validate_int(request.args.get('id'), 'id')
-                if "make" in request.args.keys():
-                    params['make'] = helpers.validate_string(request.args.get('make'), 'make')
-                if "model" in request.args.keys():
-                    params['model'] = helpers.validate_string(request.args.get('model'), 'model')
-                if "year" in request.args.keys():
-                    params['year'] = helpers.validate_year(request.args.get('year'))
-                if "assigned_type" in request.args.keys():
-                    params['assigned_type'] = helpers.validate_int(request.args.get('assigned_type'), 'assigned_type')
-                if "assigned_id" in request.args.keys():
-                    params['assigned_id'] = helpers.validate_int(request.args.get('assigned_id'), 'assigned_id')
+                params = schemas.car_search(request.args)  # list of params that we will search by
 
                 # If no allowed params were passed on - invalidate the request
                 if not params:
-                    raise Exception({"status_code": 400, "message": "Invalid request"})
+                    raise ApiError(400, "Invalid request")
+
+                # With expand=assignee the driver or branch comes in the same query, not cached and without ETag
+                if helpers.validate_expand(request.args.get('expand')):
+                    row = Car.get_with_assignee(params)
+                    if row is None:
+                        raise ApiError(404, "Car not found")
+                    return helpers.json_response(Car.serialize_with_assignee(row))
 
                 # Get the object based on the given parameters
-                car = Car.get(params)
-                if not car:
-                    raise Exception({"status_code": 404, "message": "Car not found"})
-                return jsonify(car.serialize())
+                return conditional_get(Car, params, "Car not found")
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/car/list', methods=['GET'])
+    def car_list():
+        """
+        Lists records matching parameters supplied, ordered by id. Pass next from the response as after to get the
+        next page
+        Endpoint URL: /car/list
+        :return: JSON with list of objects and cursor of the next page or exception status
+        """
+        if request.method == "GET":
+            try:
+                params = schemas.car_search(request.args)
+                return list_page(Car, params, request.args)
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/car/export', methods=['GET'])
+    def car_export():
+        """
+        Exports all records as NDJSON ordered by id
+        Endpoint URL: /car/export
+        :return: streamed NDJSON of all objects
+        """
+        if request.method == "GET":
+            return export_response(Car)
+
     @app.route('/car/update', methods=['PUT'])
     def car_update():
         """
@@ -102,43 +335,47 @@ def create_app(config_name):
             request_data = request.data
 
             try:
-                # Validate id parameter passed
-                id = helpers.check_missing('list', request_data, 'id')
-                id = helpers.validate_int(id, 'id')
-
-                # Find the object to update
-                params = {"id": id}
-                car = Car.get(params)
-
-                # Return 404 if not found the object to update
-                if not car:
-                    raise Exception({"status_code": 404, "message": "Car not found"})
-
-                # Find and validate any allowed parameters
-                if "make" in request_data.keys():
-                    car.make = helpers.validate_string(request_data['make'], 'make')
-                if "model" in request_data.keys():
-                    car.model = helpers.validate_string(request_data['model'], 'model')
-                if "year" in request.data.keys():
-                    car.year = helpers.validate_year(request_data['year'])
-
-                # Logic to enforce assigned type and id to be passed on and validated together
-                if "assigned_type" in request_data.keys() and not "assigned_id" in request_data.keys():
-                    raise Exception({"status_code": 400, "message": "Missing assigned_id"})
-                elif "assigned_id" in request_data.keys() and not "assigned_type" in request_data.keys():
-                    raise Exception({"status_code": 400, "message": "Missing assigned_type"})
-                elif set(("assigned_type", "assigned_id")) <= request_data.keys():
-                    assigned_type, assigned_id = helpers.validate_assigning(request_data['assigned_type'],
-                                                                            request_data['assigned_id'])
-                    car.assigned_type = assigned_type
-                    car.assigned_id = assigned_id
-
-                # Save an object and return successful message
-                car.save()
+                # Validate id and any allowed parameters, assigned type and id are passed on together
+                values = schemas.car_update(request_data)
+                id = values.pop('id')
+                if 'assigned_type' in values:
+                    values['assigned_type'], values['assigned_id'] = helpers.validate_assigning(
+                        values['assigned_type'], values['assigned_id'])
+
+                # Update in one statement, nothing matches if the record doesn't exist
+                if not Car.update_by_id(id, values):
+                    raise ApiError(404, "Car not found")
+                commit()
                 return jsonify({"status_code": 200, "message": "Car record was updated"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/car/transfer', methods=['PUT'])
+    def car_transfer():
+        """
+        Moves cars to a branch or driver in one transaction. Cars are picked by a list of ids, by a filter with the
+        params of /car/get or by both
+        Endpoint URL: /car/transfer
+        :return: JSON with number of cars moved or exception response
+        """
+        if request.method == "PUT":
+            if request.data is None:
+                return jsonify({"status_code": 400, "message": "Invalid request"})
+            request_data = request.data
+
+            try:
+                values = schemas.car_transfer(request_data)
+                if "ids" not in values and "filter" not in values:
+                    raise ApiError(400, "Missing ids")
+
+                # The target is checked once, whether it has room for all the cars is part of the counter update
+                assigned_type, assigned_id = helpers.validate_assigning(values['assigned_type'], values['assigned_id'])
+                moved = Car.transfer(values.get('ids'), values.get('filter', {}), assigned_type, assigned_id)
+                commit()
+                return jsonify({"status_code": 200, "message": "Cars transferred", "moved": moved})
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
     @app.route('/car/delete', methods=['DELETE'])
     def car_delete():
         """
@@ -155,16 +392,10 @@ def create_app(config_name):
                 id = helpers.check_missing('args', request, 'id')
                 id = helpers.validate_int(id, 'id')
 
-                # Find the object to delete
-                params = {"id": id}
-                car = Car.get(params)
-
-                # Return 404 if not found the object to delete
-                if not car:
+                # Delete in one statement, return 404 if nothing matched
+                if not Car.delete_by_id(id):
                     return jsonify({"status_code": 404, "message": "Car not found"})
-
-                # Delete object and return successful message
-                car.delete()
+                commit()
                 return jsonify({"status_code": 200, "message": "Car deleted"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
@@ -183,56 +414,97 @@ def create_app(config_name):
 
             try:
                 # Find and validate required parameters in order to create branch record
-                city = helpers.check_missing('list', request_data, 'city')
-                city = helpers.validate_string(city, 'city')
-                postcode = helpers.check_missing('list', request_data, 'postcode')
-                postcode = helpers.validate_postcode(postcode)
-                capacity = helpers.check_missing('list', request_data, 'capacity')
-                capacity = helpers.validate_int(capacity, 'capacity')
+                values = schemas.branch_create(request_data)
 
                 # Create object and save it in the database
-                branch = Branch(city, postcode, capacity)
+                branch = Branch(values['city'], values['postcode'], values['capacity'])
                 branch.save()
                 return jsonify({"status_code": 201, "message": "Branch created"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
-    @app.route('/branch/get', methods=['GET'])
+    @app.route('/branch/get', methods=['GET', 'POST'])
     def branch_get():
         """
-        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params
+        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params.
+        With ids (query string or POST body) gets all records with those ids instead
         Endpoint URL: /branch/get
-        :return: JSON of an object or exception status
+        :return: JSON of an object, of a list of objects or exception status
         """
+        if request.method == "POST" or "ids" in request.args:
+            return get_many(Branch)
+
         if request.method == "GET":
             if request.args is None:
                 return jsonify({"status_code": 400, "message": "Invalid request"})
 
             try:
-                params = {}  # list of params that we will search by
-                # Check if any of the parameters are being passed and then validate them
-                if "id" in request.args.keys():
-                    params['id'] = helpers.validate_int(request.args.get('id'), 'id')
-                if "city" in request.args.keys():
-                    params['city'] = helpers.validate_string(request.args.get('city'), 'city')
-                if "postcode" in request.args.keys():
-                    params['postcode'] = helpers.validate_postcode(request.args.get('postcode'))
-                if "capacity" in request.args.keys():
-                    params['capacity'] = helpers.validate_int(request.args.get('capacity'), 'capacity')
+                params = schemas.branch_search(request.args)  # list of params that we will search by
 
                 # If no allowed params were passed on - invalidate the request
                 if not params:
                     return jsonify({"status_code": 400, "message": "Invalid request"})
 
                 # Get the object based on the given parameters
-                branch = Branch.get(params)
-                if not branch:
-                    return jsonify({"status_code": 404, "message": "Branch not found"})
-                return jsonify(branch.serialize())
+                return conditional_get(Branch, params, "Branch not found")
+
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/branch/list', methods=['GET'])
+    def branch_list():
+        """
+        Lists records matching parameters supplied, ordered by id. Pass next from the response as after to get the
+        next page
+        Endpoint URL: /branch/list
+        :return: JSON with list of objects and cursor of the next page or exception status
+        """
+        if request.method == "GET":
+            try:
+                params = schemas.branch_search(request.args)
+                return list_page(Branch, params, request.args)
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/branch/occupancy', methods=['GET'])
+    def branch_occupancy():
+        """
+        Gets capacity, occupancy and free slots of every branch, or of the branches of a city, in one query
+        Endpoint URL: /branch/occupancy
+        :return: JSON with one item per branch and totals or exception status
+        """
+        if request.method == "GET":
+            try:
+                params = schemas.branch_occupancy(request.args)
+                rows = Branch.occupancy_report(params.get('city'), app.config['OCCUPANCY_VIEW'])
+                return helpers.json_response(dict(status_code=200, **Branch.serialize_occupancy(rows)))
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/branch/cars', methods=['GET'])
+    def branch_cars():
+        """
+        Lists cars assigned to a branch, ordered by id. Pass next from the response as after to get the next page
+        Endpoint URL: /branch/cars
+        :return: JSON with list of cars and cursor of the next page or exception status
+        """
+        if request.method == "GET":
+            try:
+                id = helpers.validate_int(helpers.check_missing('args', request, 'id'), 'id')
+                return list_page(Car, {"branch_id": id}, request.args, (Branch, id, "Branch not found"))
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/branch/export', methods=['GET'])
+    def branch_export():
+        """
+        Exports all records as NDJSON ordered by id
+        Endpoint URL: /branch/export
+        :return: streamed NDJSON of all objects
+        """
+        if request.method == "GET":
+            return export_response(Branch)
+
     @app.route('/branch/update', methods=['PUT'])
     def branch_update():
         """
@@ -246,32 +518,28 @@ def create_app(config_name):
             request_data = request.data
 
             try:
-                # Validate id parameter passed
-                id = helpers.check_missing('list', request_data, 'id')
-                id = helpers.validate_int(id, 'id')
-
-                # Find the object to update
-                params = {"id": id}
-                branch = Branch.get(params)
-
-                # Return 404 if not found the object to update
-                if not branch:
-                    return jsonify({"status_code": 404, "message": "Branch not found"})
-
-                # Find and validate any allowed parameters
-                if "city" in request_data.keys():
-                    branch.city = helpers.validate_string(request_data['city'], 'city')
-                if "postcode" in request_data.keys():
-                    branch.postcode = helpers.validate_postcode(request_data['postcode'])
-                if "capacity" in request_data.keys():
-                    branch.capacity = helpers.validate_int(request_data['capacity'], 'capacity')
-
-                # Save an object and return successful message
-                branch.save()
+                # Validate id and any allowed parameters
+                values = schemas.branch_update(request_data)
+                id = values.pop('id')
+
+                # Update in one statement, nothing matches if the record doesn't exist
+                if not Branch.update_by_id(id, values):
+                    raise ApiError(404, "Branch not found")
+                commit()
                 return jsonify({"status_code": 200, "message": "Branch record was updated"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/branch/upsert', methods=['PUT'])
+    def branch_upsert():
+        """
+        Creates or updates branches by postcode, for jobs resending the whole list of branches
+        Endpoint URL: /branch/upsert
+        :return: JSON with numbers of branches inserted, updated and unchanged or exception response
+        """
+        if request.method == "PUT":
+            return upsert(Branch, schemas.branch_create, "branches")
+
     @app.route('/branch/delete', methods=['DELETE'])
     def branch_delete():
         """
@@ -288,16 +556,10 @@ def create_app(config_name):
                 id = helpers.check_missing('args', request, 'id')
                 id = helpers.validate_int(id, 'id')
 
-                # Find the object to delete
-                params = {"id": id}
-                branch = Branch.get(params)
-
-                # Return 404 if not found the object to delete
-                if not branch:
+                # Delete in one statement, return 404 if nothing matched
+                if not Branch.delete_by_id(id):
                     return jsonify({"status_code": 404, "message": "Branch not found"})
-
-                # Delete object and return successful message
-                branch.delete()
+                commit()
                 return jsonify({"status_code": 200, "message": "Branch deleted"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
@@ -316,62 +578,81 @@ def create_app(config_name):
 
             try:
                 # Find and validate required parameters in order to create driver record
-                first_name = helpers.check_missing('list', request_data, 'first_name')
-                first_name = helpers.validate_string(first_name, 'first_name')
-
-                # Middle name is optional for creating a driver
-                middle_name = None
-                if "middle_name" in request_data.keys():
-                    middle_name = helpers.validate_string(request_data['middle_name'], 'middle_name')
-                last_name = helpers.check_missing('list', request_data, 'last_name')
-                last_name = helpers.validate_string(last_name, 'last_name')
-                dob = helpers.check_missing('list', request_data, 'dob')
-                dob = helpers.validate_dob(dob)  # Only accepting drivers that are 18 or older
+                values = schemas.driver_create(request_data)
 
                 # Create object and save it in the database
-                driver = Driver(first_name, middle_name, last_name, dob)
+                driver = Driver(values['first_name'], values['middle_name'], values['last_name'], values['dob'])
                 driver.save()
                 return jsonify({"status_code": 201, "message": "Driver created"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
-    @app.route('/driver/get', methods=['GET'])
+    @app.route('/driver/get', methods=['GET', 'POST'])
     def driver_get():
         """
-        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params
+        Gets a record based on parameters supplied to the endpoint. Returns first suitable found object based on params.
+        With ids (query string or POST body) gets all records with those ids instead
         Endpoint URL: /driver/get
-        :return: JSON of an object or exception status
+        :return: JSON of an object, of a list of objects or exception status
         """
+        if request.method == "POST" or "ids" in request.args:
+            return get_many(Driver)
+
         if request.method == "GET":
             if request.args is None:
                 return jsonify({"status_code": 400, "message": "Invalid request"})
 
             try:
-                params = {}  # list of params that we will search by
-                # Check if any of the parameters are being passed and then validate them
-                if "id" in request.args.keys():
-                    params['id'] = helpers.validate_int(request.args.get('id'), 'id')
-                if "first_name" in request.args.keys():
-                    params["first_name"] = helpers.validate_string(request.args.get('first_name'), 'first_name')
-                if "middle_name" in request.args.keys():
-                    params["middle_name"] = helpers.validate_string(request.args.get('middle_name'), 'middle_name')
-                if "last_name" in request.args.keys():
-                    params["last_name"] = helpers.validate_string(request.args.get('last_name'), 'last_name')
-                if "dob" in request.args.keys():
-                    params["dob"] = helpers.validate_dob(request.args.get('dob'))
+                params = schemas.driver_search(request.args)  # list of params that we will search by
 
                 # If no allowed params were passed on - invalidate the request
                 if not params:
                     return jsonify({"status_code": 400, "message": "Invalid request"})
 
                 # Get the object based on the given parameters
-                driver = Driver.get(params)
-                if not driver:
-                    return jsonify({"status_code": 404, "message": "Driver not found"})
-                return jsonify(driver.serialize())
+                return conditional_get(Driver, params, "Driver not found")
             except Exception as e:  # Return messages of any exceptions raised during validation
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/driver/list', methods=['GET'])
+    def driver_list():
+        """
+        Lists records matching parameters supplied, ordered by id. Pass next from the response as after to get the
+        next page
+        Endpoint URL: /driver/list
+        :return: JSON with list of objects and cursor of the next page or exception status
+        """
+        if request.method == "GET":
+            try:
+                params = schemas.driver_search(request.args)
+                return list_page(Driver, params, request.args)
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/driver/cars', methods=['GET'])
+    def driver_cars():
+        """
+        Lists cars assigned to a driver, ordered by id. Pass next from the response as after to get the next page
+        Endpoint URL: /driver/cars
+        :return: JSON with list of cars and cursor of the next page or exception status
+        """
+        if request.method == "GET":
+            try:
+                id = helpers.validate_int(helpers.check_missing('args', request, 'id'), 'id')
+                return list_page(Car, {"driver_id": id}, request.args, (Driver, id, "Driver not found"))
+            except Exception as e:
+                return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+    @app.route('/driver/export', methods=['GET'])
+    def driver_export():
+        """
+        Exports all records as NDJSON ordered by id
+        Endpoint URL: /driver/export
+        :return: streamed NDJSON of all objects
+        """
+        if request.method == "GET":
+            return export_response(Driver)
+
     @app.route('/driver/update', methods=['PUT'])
     def driver_update():
         """
@@ -385,34 +666,29 @@ def create_app(config_name):
             request_data = request.data
 
             try:
-                # Validate id parameter passed
-                id = helpers.check_missing('list', request_data, 'id')
-                id = helpers.validate_int(id, 'id')
-
-                # Find the object to update
-                params = {"id": id}
-                driver = Driver.get(params)
-
-                # Return 404 if not found the object to update
-                if not driver:
-                    return jsonify({"status_code": 404, "message": "Driver not found"})
-
-                # Find and validate any allowed parameters
-                if "first_name" in request_data.keys():
-                    driver.first_name = helpers.validate_string(request_data['first_name'], 'first_name')
-                if "middle_name" in request_data.keys():
-                    driver.middle_name = helpers.validate_string(request_data['middle_name'], 'middle_name')
-                if "last_name" in request_data.keys():
-                    driver.last_name = helpers.validate_string(request_data['last_name'], 'last_name')
-                if "dob" in request_data.keys():
-                    driver.dob = helpers.validate_dob(request_data["dob"])
-
-                # Save an object and return successful message
-                driver.save()
+                # Validate id and any allowed parameters
+                values = schemas.driver_update(request_data)
+                id = values.pop('id')
+
+                # Update in one statement, nothing matches if the record doesn't exist
+                if not Driver.update_by_id(id, values):
+                    raise ApiError(404, "Driver not found")
+                commit()
                 return jsonify({"status_code": 200, "message": "Driver record was updated"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
 
+    @app.route('/driver/upsert', methods=['PUT'])
+    def driver_upsert():
+        """
+        Creates or updates drivers by first name, last name and date of birth, for jobs resending the whole list of
+        drivers
+        Endpoint URL: /driver/upsert
+        :return: JSON with numbers of drivers inserted, updated and unchanged or exception response
+        """
+        if request.method == "PUT":
+            return upsert(Driver, schemas.driver_create, "drivers")
+
     @app.route('/driver/delete', methods=['DELETE'])
     def driver_delete():
         """
@@ -429,16 +705,10 @@ def create_app(config_name):
                 id = helpers.check_missing('args', request, 'id')
                 id = helpers.validate_int(id, 'id')
 
-                # Find the object to delete
-                params = {"id": id}
-                driver = Driver.get(params)
-
-                # Return 404 if not found the object to delete
-                if not driver:
+                # Delete in one statement, return 404 if nothing matched
+                if not Driver.delete_by_id(id):
                     return jsonify({"status_code": 404, "message": "Driver not found"})
-
-                # Delete object and return successful message
-                driver.delete()
+                commit()
                 return jsonify({"status_code": 200, "message": "Driver deleted"})
             except Exception as e:
                 return jsonify({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
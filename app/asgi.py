@@ -0,0 +1,663 @@
+import json
+import datetime
+import databases
+from asyncpg.exceptions import UniqueViolationError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, Mount
+from werkzeug.http import parse_etags, quote_etag
+from app import create_app, db, helpers, schemas
+from app.cache import cache
+from app.helpers import ApiError
+from app.models import Car, Branch, Driver, update_statement, delete_statement, occupancy_changes, \
+    occupancy_statement, check_occupancy_changed, transfer_statement, transfer_changes, occupancy_report_statement, \
+    assignee_columns, assignee_join, unassign_statement, upsert_statements, natural_key, search_statement, any_id, \
+    free_slots_statement, car_insert_statement, added_cars
+
+
+def coerce(column, value):
+    """
+    Converts a validated value to the python type of its column, asyncpg doesn't cast strings like psycopg2 does
+
+    :param column: table column
+    :param value: value returned by the helpers
+    :return: value of the column type
+    """
+    if value is None:
+        return None
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    if isinstance(column.type, db.Date) and isinstance(value, str):
+        return datetime.datetime.strptime(value, '%m/%d/%Y').date()  # validate_dob format
+    return value
+
+
+def clean(model, values):
+    return {field: coerce(model.__table__.c[field], value) for field, value in values.items()}
+
+
+def select(model, params, columns=None):
+    # Same filters as models.search_query, with values of the column types asyncpg expects
+    return search_statement(model, clean(model, params), columns)
+
+
+def serialize(model, row):
+    return model.serialize_row([row[field] for field in model.export_fields])
+
+
+class FastJSONResponse(JSONResponse):
+    # Encoded with helpers.dumps (orjson when installed), used for records on the get, list and export endpoints
+    def render(self, content):
+        return helpers.dumps(content)
+
+
+def invalidate(model, ids):
+    # Writes here don't go through the session, drop changed records from the cache once they're committed
+    for id in ids:
+        cache.invalidate(model.__tablename__, id)
+
+
+def error_response(e):
+    return JSONResponse({"status_code": e.args[0]['status_code'], "message": e.args[0]['message']})
+
+
+async def request_data(request):
+    """
+    Parses the body the same way as Flask-API's request.data: JSON or form, empty dict when there is no body
+
+    :param request: starlette request
+    :return: parsed body
+    :raises HTTPException: 400 if JSON can't be parsed
+    """
+    body = await request.body()
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    if not body or not content_type:
+        return {}
+    if content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+        return dict(await request.form())
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="JSON parse error")
+
+
+async def request_records(request):
+    """
+    Async version of helpers.parse_bulk: a JSON array or NDJSON, one record per line
+
+    :param request: starlette request
+    :return: list of records
+    :raises ApiError: if body is empty or can't be parsed
+    """
+    if request.headers.get('content-type', '').split(';')[0] in ('application/x-ndjson', 'application/ndjson'):
+        try:
+            records = [json.loads(line) for line in (await request.body()).decode().splitlines() if line.strip()]
+        except ValueError:
+            raise ApiError(400, "Invalid request")
+    else:
+        records = await request_data(request)
+    if not isinstance(records, list) or not records:
+        raise ApiError(400, "Invalid request")
+    return records
+
+
+async def validate_assigning(database, assigned_type, assigned_id):
+    """
+    Async version of helpers.validate_assigning
+
+    :param database: database to query
+    :param assigned_type:
+    :param assigned_id:
+    :return: list with type and id if passed validation
+    :raises ApiError: either type or id is invalid
+    """
+    assigned_type, assigned_id = helpers.validate_assignment(assigned_type, assigned_id)
+
+    if assigned_type == 1:  # 1 = driver
+        if await database.fetch_val(select(Driver, {"id": assigned_id}, [Driver.id])) is None:
+            raise ApiError(404, "Driver not found")
+        return [assigned_type, assigned_id]
+
+    # 2 = branch
+    branch = await database.fetch_one(select(Branch, {"id": assigned_id}, [Branch.capacity, Branch.occupancy]))
+    if branch is None:
+        raise ApiError(404, "Branch not found")
+    if branch["capacity"] <= branch["occupancy"]:
+        raise ApiError(400, "Branch has reached its capacity")
+    return [assigned_type, assigned_id]
+
+
+async def validate_assigning_bulk(database, cars):
+    """
+    Async version of helpers.validate_assigning_bulk
+
+    :param database: database to query
+    :param cars: list of (index, car) tuples where car is a dict returned by validate_car
+    :return: dict of index => error dict for cars that can't be assigned
+    """
+    driver_ids = set(car['assigned_id'] for index, car in cars if car['assigned_type'] == 1)
+    branch_ids = set(car['assigned_id'] for index, car in cars if car['assigned_type'] == 2)
+
+    drivers = set()
+    if driver_ids:
+        rows = await database.fetch_all(db.select([Driver.id]).where(any_id(Driver.id, driver_ids)))
+        drivers = set(row["id"] for row in rows)
+    free = {}
+    if branch_ids:
+        # Locked like Branch.get_free_slots, the caller inserts the cars in the same transaction
+        rows = await database.fetch_all(free_slots_statement(branch_ids))
+        free = dict((row["id"], row["free"]) for row in rows)
+    return helpers.check_assigning_bulk(cars, drivers, free)
+
+
+async def adjust_occupancy(database, changes):
+    """
+    Async version of Branch.adjust_occupancy, runs in the caller's transaction
+
+    :param database: database to query
+    :param changes: dict of branch id => number of cars added (or removed if negative)
+    :return: ids of branches changed
+    :raises ApiError: if a branch doesn't have room, the caller's transaction has to be rolled back then
+    """
+    if not any(changes.values()):
+        return []
+    changed = [row["id"] for row in await database.fetch_all(occupancy_statement(changes))]
+    check_occupancy_changed(changes, changed)
+    return changed
+
+
+def create_asgi_app(config_name):
+    """
+    Serves the car, branch and driver API with async handlers on an asyncpg connection pool, so a request waiting
+    on the database doesn't hold a worker. Anything else (e.g. /metrics) is passed on to the Flask app.
+
+    :param config_name: development, testing or production
+    :return: Starlette app
+    """
+    flask_app = create_app(config_name)  # loads the config and sets up the cache the same way as run.py
+    options = flask_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    database = databases.Database(flask_app.config['SQLALCHEMY_DATABASE_URI'], min_size=options['pool_size'],
+                                  max_size=options['pool_size'] + options['max_overflow'],
+                                  max_inactive_connection_lifetime=options['pool_recycle'])
+
+    async def get_serialized(model, params):
+        # Async version of cache.get_serialized
+        if not cache.enabled or list(params.keys()) != ['id']:
+            row = await database.fetch_one(select(model, params).limit(1))
+            return serialize(model, row) if row else None
+
+        key = (model.__tablename__, params['id'])
+        value = cache.get(key)
+        if value is None:
+            row = await database.fetch_one(select(model, params).limit(1))
+            if not row:
+                return None
+            value = serialize(model, row)
+            cache.put(key, value)
+        return value
+
+    async def get_many(request, model):
+        """
+        Gets records by id in one query, ids=1,2,3 in the query string or {"ids": [1, 2, 3]} in a POST body
+        :param request: starlette request
+        :param model: model class
+        :return: JSON of the records found in the order of ids and the ids that weren't found
+        """
+        data = await request_data(request) if request.method == "POST" else request.query_params
+        try:
+            if not hasattr(data, 'keys'):
+                raise ApiError(400, "Invalid request")
+            ids = schemas.get_many(data)['ids']
+
+            # Async version of cache.get_many_serialized
+            records = {}
+            if cache.enabled:
+                for id in ids:
+                    value = cache.get((model.__tablename__, id))
+                    if value is not None:
+                        records[id] = value
+            missing = [id for id in ids if id not in records]
+            if missing:
+                for row in await database.fetch_all(select(model, {}).where(any_id(model.id, missing))):
+                    value = serialize(model, row)
+                    records[value['id']] = value
+                    if cache.enabled:
+                        cache.put((model.__tablename__, value['id']), value)
+
+            return FastJSONResponse({"status_code": 200, "items": [records[id] for id in ids if id in records],
+                                     "missing": [id for id in ids if id not in records]})
+        except Exception as e:
+            return error_response(e)
+
+    async def conditional_get(request, model, params, not_found):
+        """
+        Gets a serialized record with a strong ETag built from its version and answers If-None-Match with 304
+        :param request: starlette request
+        :param model: model class
+        :param params: validated search params
+        :param not_found: message when no record matches
+        :return: JSON of an object, 304 or 404 status
+        """
+        if_none_match = parse_etags(request.headers.get('if-none-match'))
+        if if_none_match and list(params.keys()) == ['id']:
+            record = cache.peek(model, params['id'])
+            if record:
+                version = record['version']
+            else:
+                version = await database.fetch_val(db.select([model.version]).where(model.id == params['id']))
+            if version is not None:
+                etag = helpers.make_etag(model.__tablename__, params['id'], version)
+                if if_none_match.contains_weak(etag):
+                    return Response(status_code=304, headers={"ETag": quote_etag(etag)})
+
+        record = await get_serialized(model, params)
+        if not record:
+            return JSONResponse({"status_code": 404, "message": not_found})
+
+        etag = helpers.make_etag(model.__tablename__, record['id'], record['version'])
+        if if_none_match.contains_weak(etag):
+            return Response(status_code=304, headers={"ETag": quote_etag(etag)})
+        return FastJSONResponse(record, headers={"ETag": quote_etag(etag)})
+
+    async def list_page(model, params, args, owner=None):
+        """
+        Gets one page of records using keyset pagination on id
+        :param model: model class to list
+        :param params: validated filters
+        :param args: request query params holding limit and after
+        :param owner: (model, id, not found message) of the driver or branch the records belong to
+        :return: JSON of records on the page and cursor for the next one
+        """
+        limit = helpers.validate_limit(args.get('limit'))
+        after = helpers.decode_cursor(args['after']) if args.get('after') else None
+
+        # Ask for one extra row to know if there is a next page
+        statement = select(model, params)
+        if after is not None:
+            statement = statement.where(model.id > after)
+        rows = await database.fetch_all(statement.order_by(model.id).limit(limit + 1))
+        # Only an empty page has to be told apart from an owner that doesn't exist
+        if owner and not rows and await database.fetch_val(
+                db.select([owner[0].id]).where(owner[0].id == owner[1])) is None:
+            raise ApiError(404, owner[2])
+        next_cursor = helpers.encode_cursor(rows[limit - 1]["id"]) if len(rows) > limit else None
+        return FastJSONResponse({"status_code": 200, "items": [serialize(model, row) for row in rows[:limit]],
+                                 "next": next_cursor})
+
+    def export_response(model, batch_size=1000):
+        """
+        Streams every record of a model as NDJSON ordered by id
+        :param model: model class to export
+        :param batch_size: number of records sent at a time
+        :return: streamed response
+        """
+        async def generate():
+            lines = []
+            async for row in database.iterate(select(model, {}).order_by(model.id)):
+                lines.append(helpers.dumps(serialize(model, row)) + b'\n')
+                if len(lines) >= batch_size:
+                    yield b''.join(lines)
+                    lines = []
+            if lines:
+                yield b''.join(lines)
+
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    async def update_record(model, id, values, not_found, message):
+        # Single statement update, same as model.update_by_id
+        try:
+            async with database.transaction():
+                found = await database.fetch_one(update_statement(model, id, clean(model, values))) is not None
+        except UniqueViolationError:
+            raise ApiError(400, model.__name__ + " already exists")
+        if not found:
+            return JSONResponse({"status_code": 404, "message": not_found})
+        if values:
+            invalidate(model, [id])
+        return JSONResponse({"status_code": 200, "message": message})
+
+    async def delete_record(model, id, not_found, message):
+        # Same as model.delete_by_id, cars of the driver or branch are unassigned first
+        column = Car.driver_id if model is Driver else Car.branch_id
+        async with database.transaction():
+            cars = [row["id"] for row in await database.fetch_all(unassign_statement(column, id))]
+            found = await database.fetch_one(delete_statement(model, id)) is not None
+        if not found:
+            return JSONResponse({"status_code": 404, "message": not_found})
+        invalidate(Car, cars)
+        invalidate(model, [id])
+        return JSONResponse({"status_code": 200, "message": message})
+
+    async def upsert(request, model, validate, name, defaults):
+        # Same as the Flask app's upsert, inserted rows get the column defaults databases doesn't apply
+        try:
+            records = await request_records(request)
+            rows, errors = helpers.validate_upsert(records, validate, lambda row: natural_key(model, row))
+            inserted = updated = []
+            if rows:
+                async with database.transaction():
+                    written = []
+                    for statement in upsert_statements(model, [dict(clean(model, row), **defaults) for row in rows]):
+                        written += [tuple(row.values()) for row in await database.fetch_all(statement)]
+                inserted = [id for id, new in written if new]
+                updated = [id for id, new in written if not new]
+                invalidate(model, updated)
+
+            return JSONResponse(helpers.upsert_result(name, len(rows), len(inserted), len(updated), errors))
+        except Exception as e:
+            return error_response(e)
+
+    async def cache_stats(request):
+        return JSONResponse(dict(status_code=200, **cache.stats()))
+
+    async def car_create(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            # Find and validate required parameters in order to create car record
+            values = schemas.car_create(data)
+
+            async with database.transaction():
+                assigned_type, assigned_id = await validate_assigning(database, values['assigned_type'],
+                                                                      values['assigned_id'])
+                # databases doesn't apply python side column defaults, inserts set version (and occupancy) themselves
+                await database.execute(car_insert_statement([clean(Car, dict(
+                    values, assigned_type=assigned_type, assigned_id=assigned_id, version=1))]))
+                changed = await adjust_occupancy(database, occupancy_changes(None, (assigned_type, assigned_id)))
+            invalidate(Branch, changed)
+            return JSONResponse({"status_code": 201, "message": "Car created"})
+        except Exception as e:
+            return error_response(e)
+
+    async def car_bulk_create(request):
+        try:
+            records = await request_records(request)
+
+            cars, errors = helpers.validate_bulk(records)
+            async with database.transaction():
+                errors.update(await validate_assigning_bulk(database, cars))
+                rows = [car for index, car in cars if index not in errors]
+                changed = []
+                if rows:
+                    await database.execute(car_insert_statement([dict(row, version=1) for row in rows]))
+                    changed = await adjust_occupancy(database, added_cars(rows))
+            invalidate(Branch, changed)
+
+            return JSONResponse(helpers.bulk_result(len(rows), errors))
+        except Exception as e:
+            return error_response(e)
+
+    async def car_get(request):
+        if request.method == "POST" or "ids" in request.query_params:
+            return await get_many(request, Car)
+
+        try:
+            params = schemas.car_search(request.query_params)
+            if not params:
+                raise ApiError(400, "Invalid request")
+            if helpers.validate_expand(request.query_params.get('expand')):
+                # Same query as Car.get_with_assignee
+                statement = select(Car, params, assignee_columns()).select_from(assignee_join())
+                row = await database.fetch_one(statement.limit(1))
+                if row is None:
+                    raise ApiError(404, "Car not found")
+                return FastJSONResponse(Car.serialize_with_assignee(tuple(row.values())))
+            return await conditional_get(request, Car, params, "Car not found")
+        except Exception as e:
+            return error_response(e)
+
+    async def car_list(request):
+        try:
+            return await list_page(Car, schemas.car_search(request.query_params), request.query_params)
+        except Exception as e:
+            return error_response(e)
+
+    async def car_export(request):
+        return export_response(Car)
+
+    async def car_update(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = schemas.car_update(data)
+            id = values.pop('id')
+            if "assigned_type" not in values:
+                return await update_record(Car, id, values, "Car not found", "Car record was updated")
+
+            # Reassigning reads the old assignment back to move the car between branch counters
+            async with database.transaction():
+                values['assigned_type'], values['assigned_id'] = await validate_assigning(
+                    database, values['assigned_type'], values['assigned_id'])
+                old = await database.fetch_one(Car.reassign_statement(id, clean(Car, values)))
+                if old is None:
+                    raise ApiError(404, "Car not found")
+                changed = await adjust_occupancy(database, occupancy_changes(
+                    (old["assigned_type"], old["assigned_id"]), (values['assigned_type'], values['assigned_id'])))
+            invalidate(Car, [id])
+            invalidate(Branch, changed)
+            return JSONResponse({"status_code": 200, "message": "Car record was updated"})
+        except Exception as e:
+            return error_response(e)
+
+    async def car_transfer(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = schemas.car_transfer(data)
+            if "ids" not in values and "filter" not in values:
+                raise ApiError(400, "Missing ids")
+
+            async with database.transaction():
+                new = await validate_assigning(database, values['assigned_type'], values['assigned_id'])
+                statement = transfer_statement(values.get('ids'), clean(Car, values.get('filter', {})), *new)
+                # databases maps the columns of the CTE's RETURNING over the select's, read the values in order
+                rows = [tuple(row.values()) for row in await database.fetch_all(statement)]
+                changed = await adjust_occupancy(database, transfer_changes(rows, tuple(new)))
+            moved = [id for row in rows for id in row[2]]
+            invalidate(Car, moved)
+            invalidate(Branch, changed)
+            return JSONResponse({"status_code": 200, "message": "Cars transferred", "moved": len(moved)})
+        except Exception as e:
+            return error_response(e)
+
+    async def car_delete(request):
+        try:
+            id = helpers.check_missing('list', request.query_params, 'id')
+            id = helpers.validate_int(id, 'id')
+
+            async with database.transaction():
+                old = await database.fetch_one(delete_statement(Car, id, Car.assigned_type, Car.assigned_id))
+                if old is None:
+                    return JSONResponse({"status_code": 404, "message": "Car not found"})
+                changed = await adjust_occupancy(database, occupancy_changes(
+                    (old["assigned_type"], old["assigned_id"]), None))
+            invalidate(Car, [id])
+            invalidate(Branch, changed)
+            return JSONResponse({"status_code": 200, "message": "Car deleted"})
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_create(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = dict(schemas.branch_create(data), occupancy=0, version=1)
+            try:
+                await database.execute(Branch.__table__.insert().values(clean(Branch, values)))
+            except UniqueViolationError:
+                raise ApiError(400, "Branch already exists")
+            return JSONResponse({"status_code": 201, "message": "Branch created"})
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_get(request):
+        if request.method == "POST" or "ids" in request.query_params:
+            return await get_many(request, Branch)
+
+        try:
+            params = schemas.branch_search(request.query_params)
+            if not params:
+                return JSONResponse({"status_code": 400, "message": "Invalid request"})
+            return await conditional_get(request, Branch, params, "Branch not found")
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_list(request):
+        try:
+            return await list_page(Branch, schemas.branch_search(request.query_params), request.query_params)
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_occupancy(request):
+        try:
+            params = schemas.branch_occupancy(request.query_params)
+            statement = occupancy_report_statement(params.get('city'), flask_app.config['OCCUPANCY_VIEW'])
+            rows = [tuple(row.values()) for row in await database.fetch_all(statement)]
+            return FastJSONResponse(dict(status_code=200, **Branch.serialize_occupancy(rows)))
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_cars(request):
+        try:
+            id = helpers.validate_int(helpers.check_missing('list', request.query_params, 'id'), 'id')
+            return await list_page(Car, {"branch_id": id}, request.query_params, (Branch, id, "Branch not found"))
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_export(request):
+        return export_response(Branch)
+
+    async def branch_update(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = schemas.branch_update(data)
+            id = values.pop('id')
+            return await update_record(Branch, id, values, "Branch not found", "Branch record was updated")
+        except Exception as e:
+            return error_response(e)
+
+    async def branch_upsert(request):
+        return await upsert(request, Branch, schemas.branch_create, "branches", dict(occupancy=0, version=1))
+
+    async def branch_delete(request):
+        try:
+            id = helpers.check_missing('list', request.query_params, 'id')
+            id = helpers.validate_int(id, 'id')
+            return await delete_record(Branch, id, "Branch not found", "Branch deleted")
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_create(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = schemas.driver_create(data)
+            try:
+                await database.execute(Driver.__table__.insert().values(clean(Driver, dict(values, version=1))))
+            except UniqueViolationError:
+                raise ApiError(400, "Driver already exists")
+            return JSONResponse({"status_code": 201, "message": "Driver created"})
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_get(request):
+        if request.method == "POST" or "ids" in request.query_params:
+            return await get_many(request, Driver)
+
+        try:
+            params = schemas.driver_search(request.query_params)
+            if not params:
+                return JSONResponse({"status_code": 400, "message": "Invalid request"})
+            return await conditional_get(request, Driver, params, "Driver not found")
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_list(request):
+        try:
+            return await list_page(Driver, schemas.driver_search(request.query_params), request.query_params)
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_cars(request):
+        try:
+            id = helpers.validate_int(helpers.check_missing('list', request.query_params, 'id'), 'id')
+            return await list_page(Car, {"driver_id": id}, request.query_params, (Driver, id, "Driver not found"))
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_export(request):
+        return export_response(Driver)
+
+    async def driver_update(request):
+        data = await request_data(request)
+        if data is None:
+            return JSONResponse({"status_code": 400, "message": "Invalid request"})
+
+        try:
+            values = schemas.driver_update(data)
+            id = values.pop('id')
+            return await update_record(Driver, id, values, "Driver not found", "Driver record was updated")
+        except Exception as e:
+            return error_response(e)
+
+    async def driver_upsert(request):
+        return await upsert(request, Driver, schemas.driver_create, "drivers", dict(version=1))
+
+    async def driver_delete(request):
+        try:
+            id = helpers.check_missing('list', request.query_params, 'id')
+            id = helpers.validate_int(id, 'id')
+            return await delete_record(Driver, id, "Driver not found", "Driver deleted")
+        except Exception as e:
+            return error_response(e)
+
+    routes = [
+        Route('/cache/stats', cache_stats, methods=['GET']),
+        Route('/car/create', car_create, methods=['POST']),
+        Route('/car/bulk_create', car_bulk_create, methods=['POST']),
+        Route('/car/get', car_get, methods=['GET', 'POST']),
+        Route('/car/list', car_list, methods=['GET']),
+        Route('/car/export', car_export, methods=['GET']),
+        Route('/car/update', car_update, methods=['PUT']),
+        Route('/car/transfer', car_transfer, methods=['PUT']),
+        Route('/car/delete', car_delete, methods=['DELETE']),
+        Route('/branch/create', branch_create, methods=['POST']),
+        Route('/branch/get', branch_get, methods=['GET', 'POST']),
+        Route('/branch/list', branch_list, methods=['GET']),
+        Route('/branch/occupancy', branch_occupancy, methods=['GET']),
+        Route('/branch/cars', branch_cars, methods=['GET']),
+        Route('/branch/export', branch_export, methods=['GET']),
+        Route('/branch/update', branch_update, methods=['PUT']),
+        Route('/branch/upsert', branch_upsert, methods=['PUT']),
+        Route('/branch/delete', branch_delete, methods=['DELETE']),
+        Route('/driver/create', driver_create, methods=['POST']),
+        Route('/driver/get', driver_get, methods=['GET', 'POST']),
+        Route('/driver/list', driver_list, methods=['GET']),
+        Route('/driver/cars', driver_cars, methods=['GET']),
+        Route('/driver/export', driver_export, methods=['GET']),
+        Route('/driver/update', driver_update, methods=['PUT']),
+        Route('/driver/upsert', driver_upsert, methods=['PUT']),
+        Route('/driver/delete', driver_delete, methods=['DELETE']),
+        # Everything else, including wrong methods on the routes above, is answered by the Flask app
+        Mount('/', WSGIMiddleware(flask_app)),
+    ]
+
+    app = Starlette(routes=routes, on_startup=[database.connect], on_shutdown=[database.disconnect])
+    app.state.database = database
+    app.state.flask_app = flask_app
+    return app
@@ -0,0 +1,164 @@
+import time
+import threading
+from collections import OrderedDict
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class ModelCache(object):
+    """
+    Per worker LRU cache of serialized records keyed by (table, id), with a TTL on every entry.
+
+    Writes go through the models, which mark the records they change; those keys are dropped once the transaction
+    commits. Other workers only see a change when their own copy expires, so TTL is the upper bound on staleness.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.size = 0
+        self.ttl = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.reset_stats()
+
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_rollback', self.after_rollback)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CACHE_ENABLED', False)
+        self.size = app.config.get('CACHE_SIZE', 10000)
+        self.ttl = app.config.get('CACHE_TTL', 30)
+        self.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, table, id):
+        with self.lock:
+            self.entries.pop((table, id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.reset_stats()
+
+    def invalidate_on_commit(self, session, table, id):
+        """
+        Marks a record as changed by the current transaction, it's dropped from the cache when the transaction commits
+
+        :param session: session doing the change
+        :param table: table name of the record
+        :param id: id of the record
+        """
+        if self.enabled and id is not None:
+            session.info.setdefault('cache_invalidate', set()).add((table, id))
+
+    def after_commit(self, session):
+        for table, id in session.info.pop('cache_invalidate', ()):
+            self.invalidate(table, id)
+
+    def after_rollback(self, session):
+        # A savepoint rolled back (a failed sub-request of a /batch) keeps the marks, the rest of the transaction can
+        # still commit
+        if session.transaction is not None and session.transaction.nested:
+            return
+        session.info.pop('cache_invalidate', None)
+
+    def readable(self):
+        # Off inside a /batch, its reads can see changes that aren't committed yet and may never be
+        return self.enabled and not (has_app_context() and g.get('batch'))
+
+    def peek(self, model, id):
+        """
+        Gets a serialized record only if it's cached
+
+        :param model: model class
+        :param id: id of the record
+        :return: serialized record or None
+        """
+        if not self.readable():
+            return None
+        return self.get((model.__tablename__, id))
+
+    def get_serialized(self, model, params):
+        """
+        Gets a record like model.get(params) and serializes it. Lookups by id alone are read through the cache
+
+        :param model: model class
+        :param params: validated search params
+        :return: serialized record or None if not found
+        """
+        if not self.readable() or list(params.keys()) != ['id']:
+            row = model.get_row(params)
+            return model.serialize_row(row) if row else None
+
+        key = (model.__tablename__, params['id'])
+        value = self.get(key)
+        if value is None:
+            row = model.get_row(params)
+            if not row:
+                return None
+            value = model.serialize_row(row)
+            self.put(key, value)
+        return value
+
+    def get_many_serialized(self, model, ids):
+        """
+        Gets serialized records by id. Ids that aren't cached are read in one query and cached
+
+        :param model: model class
+        :param ids: list of ids
+        :return: dict of id => serialized record, for the ids that exist
+        """
+        found = {}
+        readable = self.readable()
+        if readable:
+            for id in ids:
+                value = self.get((model.__tablename__, id))
+                if value is not None:
+                    found[id] = value
+
+        missing = [id for id in ids if id not in found]
+        if missing:
+            for row in model.get_rows(missing):
+                value = model.serialize_row(row)
+                found[value['id']] = value
+                if readable:
+                    self.put((model.__tablename__, value['id']), value)
+        return found
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": self.enabled, "size": len(self.entries), "max_size": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations}
+
+
+cache = ModelCache()
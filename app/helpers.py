@@ -1,7 +1,38 @@
 import re
+import base64
 import datetime
+import json
+from flask import Response, current_app, jsonify as flask_jsonify
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
 
 UK_POSTCODE_PATTERN = r'\b[A-Z]{1,2}[0-9][A-Z0-9]?( )?[0-9][ABD-HJLNP-UW-Z]{2}\b'
+UK_POSTCODE = re.compile(UK_POSTCODE_PATTERN)
+DOB = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})')
+MIN_AGE = datetime.timedelta(weeks=52 * 18)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+MAX_TRANSFER_SIZE = 100000
+MAX_BATCH_SIZE = 20
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+class ApiError(Exception):
+    """
+    Error returned to the client as {"status_code": ..., "message": ...}. The same dict is the first arg of the
+    exception, like the plain exceptions handlers raise
+
+    :param status_code: status code put in the response
+    :param message: message put in the response
+    """
+
+    def __init__(self, status_code, message):
+        super(ApiError, self).__init__({"status_code": status_code, "message": message})
+        self.status_code = status_code
+        self.message = message
 
 
 def check_missing(format, data, field):
@@ -12,18 +43,18 @@ def check_missing(format, data, field):
     :param data: received request data
     :param field: name of field we're looking for
     :return: field value
-    :raises Exception: if field is missing
+    :raises ApiError: if field is missing
     """
     if format == "args":
         if field in data.args.keys():
             return data.args.get(field)
         else:
-            raise Exception({"status_code": 400, "message": "Missing " + field})
+            raise ApiError(400, "Missing " + field)
     if format == "list":
         if field in data.keys():
             return data[field]
         else:
-            raise Exception({"status_code": 400, "message": "Missing " + field})
+            raise ApiError(400, "Missing " + field)
 
 
 def validate_year(year):
@@ -32,15 +63,15 @@ def validate_year(year):
 
     :param year: allegedly a year we want to validate
     :return: year as integer
-    :raises Exception: if year is invalid
+    :raises ApiError: if year is invalid
     """
     try:
         int(year)  # try convert it to int
         if len(str(year)) != 4:  # year has to be 4 chars long
-            raise Exception({"status_code": 400, "message": "Invalid year"})
+            raise ApiError(400, "Invalid year")
         return year
     except Exception:
-        raise Exception({"status_code": 400, "message": "Invalid year"})
+        raise ApiError(400, "Invalid year")
 
 
 def validate_int(number, field):
@@ -50,13 +81,13 @@ def validate_int(number, field):
     :param number: number we want to validate
     :param field: name of the field we're validating
     :return: int
-    :raises Exception: if it's not an int
+    :raises ApiError: if it's not an int
     """
     try:
         number = int(number)
         return number
     except Exception:
-        raise Exception({"status_code": 400, "message": "Invalid " + field})
+        raise ApiError(400, "Invalid " + field)
 
 
 def validate_string(string, field):
@@ -66,10 +97,10 @@ def validate_string(string, field):
     :param string: value we want to validate
     :param field: name of the field we're validating
     :return: string
-    :raises Exception: if it's not a string
+    :raises ApiError: if it's not a string
     """
     if not isinstance(string, str):
-        raise Exception({"status_code": 400, "message": "Invalid " + field})
+        raise ApiError(400, "Invalid " + field)
     return string.lower()
 
 
@@ -79,14 +110,13 @@ def validate_postcode(postcode):
 
     :param postcode: value we want to validate
     :return: string
-    :raises Exception: if it's an invalid postcode
+    :raises ApiError: if it's an invalid postcode
     """
     postcode = str(postcode)
     if len(postcode) > 8:  # postcodes can't be more than 8 digits
-        raise Exception({"status_code": 400, "message": "Invalid postcode"})
-    pattern = re.compile(UK_POSTCODE_PATTERN)  # check if matches postcode pattern
-    if not pattern.match(postcode):
-        raise Exception({"status_code": 400, "message": "Invalid postcode"})
+        raise ApiError(400, "Invalid postcode")
+    if not UK_POSTCODE.match(postcode):  # check if matches postcode pattern
+        raise ApiError(400, "Invalid postcode")
     return postcode.lower()
 
 
@@ -96,29 +126,189 @@ def validate_dob(dob):
 
     :param dob: value we want to validate
     :return: string date of birth in m/d/Y format
-    :raises Exception: if invalid date of birth
+    :raises ApiError: if invalid date of birth
     """
     try:
-        dob = datetime.datetime.strptime(dob, '%d/%m/%Y')
-        min_age = datetime.timedelta(weeks=52 * 18)
-        if datetime.datetime.now() - dob < min_age:  # must be 18 or over
-            raise Exception({"status_code": 400, "message": "Invalid dob"})
-        return dob.strftime('%m/%d/%Y')
+        day, month, year = DOB.fullmatch(dob).groups()  # d/m/Y, strptime is a lot slower for one fixed format
+        dob = datetime.datetime(int(year), int(month), int(day))
+        if datetime.datetime.now() - dob < MIN_AGE:  # must be 18 or over
+            raise ApiError(400, "Invalid dob")
+        return "%02d/%02d/%04d" % (dob.month, dob.day, dob.year)
     except Exception:
-        raise Exception({"status_code": 400, "message": "Invalid dob"})
+        raise ApiError(400, "Invalid dob")
 
 
-def validate_assigning(assigned_type, assigned_id):
+def validate_ids(ids, max_size=MAX_PAGE_SIZE):
     """
-    Checks if we can assign this type to this id
+    Validates a list of ids, passed as a list or as a comma separated string like 1,2,3
+
+    :param ids: value we want to validate
+    :param max_size: most ids allowed
+    :return: list of unique ints in the order given
+    :raises ApiError: if it's empty, longer than max_size or any id isn't an int
+    """
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if not isinstance(ids, list) or not ids or len(ids) > max_size:
+        raise ApiError(400, "Invalid ids")
+    try:
+        return list(dict.fromkeys(int(id) for id in ids))
+    except (TypeError, ValueError):
+        raise ApiError(400, "Invalid ids")
+
+
+def validate_limit(limit):
+    """
+    Validates page size for list endpoints
+
+    :param limit: value we want to validate, None for default page size
+    :return: int between 1 and MAX_PAGE_SIZE
+    :raises ApiError: if it's not an int or out of range
+    """
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    limit = validate_int(limit, 'limit')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ApiError(400, "Invalid limit")
+    return limit
+
+
+def validate_expand(expand):
+    """
+    Validates the expand param of /car/get
+
+    :param expand: value we want to validate, None when it wasn't passed
+    :return: True if the assignee has to be embedded
+    :raises ApiError: if it's anything but assignee
+    """
+    if expand is None:
+        return False
+    if expand != 'assignee':
+        raise ApiError(400, "Invalid expand")
+    return True
+
+
+def validate_batch(requests):
+    """
+    Validates the sub-requests of /batch
+
+    :param requests: list of {"method": ..., "path": ..., "query": {...}, "body": ...} dicts, query and body optional,
+                     query params go either in query or in the path
+    :return: list of dicts with method in upper case and query defaulting to an empty dict
+    :raises ApiError: if it's not a list of 1 to MAX_BATCH_SIZE valid sub-requests
+    """
+    if not isinstance(requests, list) or not 0 < len(requests) <= MAX_BATCH_SIZE:
+        raise ApiError(400, "Invalid requests")
+    clean = []
+    for sub in requests:
+        if not isinstance(sub, dict) or not isinstance(sub.get('method'), str) or \
+                sub['method'].upper() not in BATCH_METHODS or not isinstance(sub.get('path'), str) or \
+                not sub['path'].startswith('/') or not isinstance(sub.get('query', {}), dict) or \
+                (sub.get('query') and '?' in sub['path']):
+            raise ApiError(400, "Invalid requests")
+        if sub['path'].split('?')[0].rstrip('/') == '/batch':
+            raise ApiError(400, "Batches can't be nested")
+        clean.append(dict(method=sub['method'].upper(), path=sub['path'], query=sub.get('query', {}),
+                          body=sub.get('body')))
+    return clean
+
+
+def encode_cursor(id):
+    """
+    Encodes last seen id into an opaque cursor for list endpoints
+
+    :param id: id of the last record on the page
+    :return: string cursor
+    """
+    return base64.urlsafe_b64encode(str(id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes cursor produced by encode_cursor
+
+    :param cursor: value we want to decode
+    :return: id of the last record on the previous page
+    :raises ApiError: if cursor is invalid
+    """
+    try:
+        return int(base64.urlsafe_b64decode(str(cursor).encode()).decode())
+    except Exception:
+        raise ApiError(400, "Invalid after")
+
+
+def make_etag(table, id, version):
+    """
+    Builds ETag value of a record, it changes whenever the record does
+
+    :param table: table name
+    :param id: id of the record
+    :param version: version of the record
+    :return: unquoted ETag
+    """
+    return "{}-{}-{}".format(table, id, version)
+
+
+def not_modified(etag):
+    """
+    Builds an empty 304 response
+
+    :param etag: unquoted ETag of the record
+    :return: response object
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def dumps(value):
+    """
+    Encodes value as compact JSON with sorted keys, the same document jsonify gives. Uses orjson when it's installed
+
+    :param value: dicts, lists, strings, numbers, None
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+
+
+def with_status(response, value):
+    # Keeps the status_code of the body on the response, so metrics can label it without decoding the body again
+    if isinstance(value, dict) and isinstance(value.get('status_code'), int):
+        response.app_status = value['status_code']
+    return response
+
+
+def jsonify(value):
+    """
+    flask.jsonify of one value, with its status_code kept on the response (see with_status)
+
+    :param value: value to encode
+    :return: response object
+    """
+    return with_status(flask_jsonify(value), value)
+
+
+def json_response(value):
+    """
+    Builds a JSON response with dumps, skipping the renderer negotiation and encoder of jsonify
+
+    :param value: value to encode
+    :return: response object
+    """
+    return with_status(current_app.response_class(dumps(value), mimetype='application/json'), value)
+
+
+def validate_assignment(assigned_type, assigned_id):
+    """
+    Checks assigned_type and assigned_id without looking up the driver or branch
 
     :param assigned_type:
     :param assigned_id:
-    :return: list with type and id if passed validation
-    :raises Exception: either type or id is invalid
+    :return: list with type and id as ints
+    :raises ApiError: either type or id is invalid
     """
-    from app.models import Branch, Driver
-
     # validate both as ints
     assigned_id = validate_int(assigned_id, 'assigned_id')
     assigned_type = validate_int(assigned_type, 'assigned_type')
@@ -126,7 +316,22 @@ def validate_assigning(assigned_type, assigned_id):
     # only allow 1 and 2 to get through
     allowed_types = [1, 2]
     if assigned_type not in allowed_types:
-        raise Exception({"status_code": 400, "message": "Invalid assigned_type"})
+        raise ApiError(400, "Invalid assigned_type")
+    return [assigned_type, assigned_id]
+
+
+def validate_assigning(assigned_type, assigned_id):
+    """
+    Checks if we can assign this type to this id
+
+    :param assigned_type:
+    :param assigned_id:
+    :return: list with type and id if passed validation
+    :raises ApiError: either type or id is invalid
+    """
+    from app.models import Branch, Driver
+
+    assigned_type, assigned_id = validate_assignment(assigned_type, assigned_id)
 
     if assigned_type == 1:  # 1 = driver
         # check if driver exists
@@ -136,17 +341,167 @@ def validate_assigning(assigned_type, assigned_id):
             assigned_id = driver.id
             return [assigned_type, assigned_id]
         else:
-            raise Exception({"status_code": 404, "message": "Driver not found"})
+            raise ApiError(404, "Driver not found")
 
     if assigned_type == 2:  # 2 = branch
         # check if branch exists
         params = {"id": assigned_id}
         branch = Branch.get(params)
         if branch:
-            occupancy = branch.get_assigned_cars_count(assigned_id)
-            if branch.capacity > occupancy:
+            if branch.capacity > branch.occupancy:
                 return [assigned_type, assigned_id]
             else:
-                raise Exception({"status_code": 400, "message": "Branch has reached its capacity"})
+                raise ApiError(400, "Branch has reached its capacity")
         else:
-            raise Exception({"status_code": 404, "message": "Branch not found"})
+            raise ApiError(404, "Branch not found")
+
+
+def parse_bulk(request):
+    """
+    Reads a list of records from the request body. Accepts either a JSON array or NDJSON (one object per line)
+
+    :param request: flask request object
+    :return: list of records
+    :raises ApiError: if body is empty or can't be parsed
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+        records = []
+        try:
+            for line in request.get_data(as_text=True).splitlines():
+                if line.strip():
+                    records.append(json.loads(line))
+        except ValueError:
+            raise ApiError(400, "Invalid request")
+    else:
+        records = request.data
+
+    if not isinstance(records, list) or not records:
+        raise ApiError(400, "Invalid request")
+    return records
+
+
+def validate_car(data):
+    """
+    Validates all fields required to create a car, without checking what it is assigned to
+
+    :param data: dict of car params
+    :return: dict of validated car params
+    :raises ApiError: if any field is missing or invalid
+    """
+    from app import schemas
+
+    if not isinstance(data, dict):
+        raise ApiError(400, "Invalid request")
+
+    car = schemas.car_create(data)
+    car['assigned_type'] = validate_int(car['assigned_type'], 'assigned_type')
+    if car['assigned_type'] not in [1, 2]:
+        raise ApiError(400, "Invalid assigned_type")
+    car['year'] = int(car['year'])
+    return car
+
+
+def validate_bulk(records):
+    """
+    Validates every car of a /car/bulk_create on its own, assignments are checked for all of them afterwards
+
+    :param records: list of records
+    :return: list of (index, car) tuples for cars that passed and dict of index => error dict for the others
+    """
+    cars = []
+    errors = {}
+    for index, record in enumerate(records):
+        try:
+            cars.append((index, validate_car(record)))
+        except Exception as e:
+            errors[index] = e.args[0]
+    return cars, errors
+
+
+def bulk_result(created, errors):
+    # Body of a /car/bulk_create response
+    return {"status_code": 201 if created else 400,
+            "message": "Cars created" if created else "No cars created",
+            "created": created,
+            "errors": [dict(index=index, **errors[index]) for index in sorted(errors)]}
+
+
+def upsert_result(name, upserted, inserted, updated, errors):
+    # Body of an upsert response, name is the plural name of the records
+    return {"status_code": 200 if upserted else 400,
+            "message": name.capitalize() + " upserted" if upserted else "No " + name + " upserted",
+            "inserted": inserted, "updated": updated, "unchanged": upserted - inserted - updated,
+            "errors": [dict(index=index, **errors[index]) for index in sorted(errors)]}
+
+
+def validate_upsert(records, validate, key):
+    """
+    Validates every record of an upsert on its own, like validate_car for /car/bulk_create. A record with the same
+    natural key as an earlier one is rejected, one INSERT ... ON CONFLICT can't write the same row twice
+
+    :param records: list of records
+    :param validate: schema function of a record, e.g. schemas.driver_create
+    :param key: function returning the natural key of a clean record, e.g. models.natural_key
+    :return: list of clean records and dict of index => error dict for records that were rejected
+    """
+    rows = []
+    errors = {}
+    keys = set()
+    for index, record in enumerate(records):
+        try:
+            if not isinstance(record, dict):
+                raise ApiError(400, "Invalid request")
+            row = validate(record)
+            if key(row) in keys:
+                raise ApiError(400, "Duplicate record")
+            keys.add(key(row))
+            rows.append(row)
+        except Exception as e:
+            errors[index] = e.args[0]
+    return rows, errors
+
+
+def validate_assigning_bulk(cars):
+    """
+    Set based version of validate_assigning. Checks that every driver and branch exists and that branches have enough
+    free capacity for all of the cars, using one query per table instead of one per car. Cars are checked in order,
+    so when a branch fills up only the cars past its capacity fail.
+
+    :param cars: list of (index, car) tuples where car is a dict returned by validate_car
+    :return: dict of index => error dict for cars that can't be assigned
+    """
+    from app.models import Branch, Driver
+
+    driver_ids = set(car['assigned_id'] for index, car in cars if car['assigned_type'] == 1)
+    branch_ids = set(car['assigned_id'] for index, car in cars if car['assigned_type'] == 2)
+
+    drivers = Driver.get_existing_ids(driver_ids)
+    free = {}  # branch id => free slots left
+    if branch_ids:
+        free = Branch.get_free_slots(branch_ids)
+
+    return check_assigning_bulk(cars, drivers, free)
+
+
+def check_assigning_bulk(cars, drivers, free):
+    """
+    Checks assignments of cars against drivers and free branch slots loaded for all of them
+
+    :param cars: list of (index, car) tuples where car is a dict returned by validate_car
+    :param drivers: set of ids of drivers that exist
+    :param free: dict of branch id => free slots, for branches that exist. Slots taken by valid cars are subtracted
+    :return: dict of index => error dict for cars that can't be assigned
+    """
+    errors = {}
+    for index, car in cars:
+        if car['assigned_type'] == 1:  # 1 = driver
+            if car['assigned_id'] not in drivers:
+                errors[index] = {"status_code": 404, "message": "Driver not found"}
+        else:  # 2 = branch
+            if car['assigned_id'] not in free:
+                errors[index] = {"status_code": 404, "message": "Branch not found"}
+            elif free[car['assigned_id']] <= 0:
+                errors[index] = {"status_code": 400, "message": "Branch has reached its capacity"}
+            else:
+                free[car['assigned_id']] -= 1
+    return errors
@@ -0,0 +1,281 @@
+import io
+import csv
+import json
+import time
+import datetime
+from flask_script import Command, Option
+from app import db, helpers
+from app.models import Branch, Driver, assignment_values, existing_keys, natural_key
+
+# Column order of rows produced by the validators below, same order is used for COPY and INSERT
+DRIVER_COLUMNS = ("first_name", "middle_name", "last_name", "dob")
+BRANCH_COLUMNS = ("city", "postcode", "capacity")
+CAR_COLUMNS = ("make", "model", "year", "assigned_type", "assigned_id", "driver_id", "branch_id")
+
+
+def read_records(path):
+    """
+    Reads records from a CSV file (with header) or an NDJSON file, one record at a time
+
+    :param path: path to .csv, .ndjson or .jsonl file
+    :return: generator of (line number, dict) tuples
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            for index, record in enumerate(csv.DictReader(f)):
+                # Empty cells are missing values, not empty strings
+                yield index + 2, {key: value for key, value in record.items() if value != ''}
+        else:
+            for index, line in enumerate(f):
+                if line.strip():
+                    try:
+                        yield index + 1, json.loads(line)
+                    except ValueError:
+                        yield index + 1, None
+
+
+def batches(records, size):
+    """
+    Splits records into lists of at most size items
+
+    :param records: iterable of records
+    :param size: batch size
+    :return: generator of lists
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def validate_columns(records, fields):
+    """
+    Validates a batch column by column with the same rules as the API helpers. Each field is checked for the whole
+    batch before moving on to the next one; a row keeps the first error it hits
+
+    :param records: list of (line number, dict) tuples
+    :param fields: list of (field, validator, required) tuples, validator takes a value and returns a clean one
+    :return: list of (line number, dict of clean values) for valid rows and list of (line number, message) errors
+    """
+    errors = {}
+    values = [{} for line, record in records]
+    for index, (line, record) in enumerate(records):
+        if not isinstance(record, dict):
+            errors[index] = "Invalid request"
+
+    for field, validator, required in fields:
+        for index, (line, record) in enumerate(records):
+            if index in errors:
+                continue
+            if field not in record:
+                if required:
+                    errors[index] = "Missing " + field
+                else:
+                    values[index][field] = None
+                continue
+            try:
+                values[index][field] = validator(record[field])
+            except Exception as e:
+                errors[index] = e.args[0]['message']
+
+    valid = [(line, values[index]) for index, (line, record) in enumerate(records) if index not in errors]
+    return valid, [(records[index][0], errors[index]) for index in sorted(errors)]
+
+
+def to_date(dob):
+    # validate_dob returns m/d/Y strings, load real dates so COPY doesn't depend on the server DateStyle
+    return datetime.datetime.strptime(helpers.validate_dob(dob), '%m/%d/%Y').date()
+
+
+def validate_drivers(records):
+    return validate_columns(records, [
+        ("first_name", lambda value: helpers.validate_string(value, 'first_name'), True),
+        ("middle_name", lambda value: helpers.validate_string(value, 'middle_name'), False),
+        ("last_name", lambda value: helpers.validate_string(value, 'last_name'), True),
+        ("dob", to_date, True),
+    ])
+
+
+def validate_branches(records):
+    return validate_columns(records, [
+        ("city", lambda value: helpers.validate_string(value, 'city'), True),
+        ("postcode", helpers.validate_postcode, True),
+        ("capacity", lambda value: helpers.validate_int(value, 'capacity'), True),
+    ])
+
+
+def validate_cars(records):
+    valid, errors = validate_columns(records, [
+        ("make", lambda value: helpers.validate_string(value, 'make'), True),
+        ("model", lambda value: helpers.validate_string(value, 'model'), True),
+        ("year", lambda value: int(helpers.validate_year(value)), True),
+        ("assigned_type", lambda value: helpers.validate_int(value, 'assigned_type'), True),
+        ("assigned_id", lambda value: helpers.validate_int(value, 'assigned_id'), True),
+    ])
+
+    # Assignment rules need the database, check them for the whole batch at once
+    cars = []
+    for line, car in valid:
+        if car['assigned_type'] not in [1, 2]:
+            errors.append((line, "Invalid assigned_type"))
+        else:
+            cars.append((line, car))
+    assigning_errors = helpers.validate_assigning_bulk(cars)
+    errors += [(line, error['message']) for line, error in assigning_errors.items()]
+    errors.sort()
+    return [(line, dict(car, **assignment_values(car['assigned_type'], car['assigned_id'])))
+            for line, car in cars if line not in assigning_errors], errors
+
+
+def check_keys(model, valid, loaded):
+    """
+    Rejects rows whose natural key (natural_key) is taken by a record in the database or by an earlier row of the file.
+    The unique index would fail the whole import on them otherwise
+
+    :param model: Branch or Driver
+    :param valid: list of (line number, dict) for rows that passed validation
+    :param loaded: set of keys of the rows kept so far, the keys of the rows kept here are added to it
+    :return: list of (line number, dict) for rows that can be loaded and list of (line number, message) errors
+    """
+    keys = [natural_key(model, row) for line, row in valid]
+    existing = existing_keys(model, keys)
+    kept = []
+    errors = []
+    for (line, row), key in zip(valid, keys):
+        if key in loaded:
+            errors.append((line, "Duplicate record"))
+        elif key in existing:
+            errors.append((line, model.__name__ + " already exists"))
+        else:
+            loaded.add(key)
+            kept.append((line, row))
+    return kept, errors
+
+
+def copy_value(value):
+    """
+    Formats a value for COPY text format
+
+    :param value: python value
+    :return: escaped string
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(table, columns, rows):
+    """
+    Loads rows with COPY FROM STDIN on the connection of the current session, so it's part of its transaction
+
+    :param table: table name
+    :param columns: column names
+    :param rows: list of dicts
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(row[column]) for column in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(table, columns, rows):
+    """
+    Loads rows with one executemany INSERT per batch instead of COPY (--no-copy). Still PostgreSQL only, the car import
+    adjusts branch counters with models.occupancy_statement
+
+    :param table: table name
+    :param columns: column names
+    :param rows: list of dicts
+    """
+    db.session.execute(db.metadata.tables[table].insert(), [{column: row[column] for column in columns}
+                                                           for row in rows])
+
+
+# table, columns, validator, called with the rows after they're loaded, model whose upsert_key has to stay unique
+IMPORTS = {
+    "drivers": ("driver", DRIVER_COLUMNS, validate_drivers, None, Driver),
+    "branches": ("branch", BRANCH_COLUMNS, validate_branches, None, Branch),
+    "cars": ("car", CAR_COLUMNS, validate_cars, Branch.add_cars, None),
+}
+
+
+def import_file(kind, path, batch_size=10000, use_copy=True):
+    """
+    Validates and loads one file into the current session transaction. Invalid rows are skipped and reported
+
+    :param kind: drivers, branches or cars
+    :param path: path to the file
+    :param batch_size: number of rows validated and loaded at a time
+    :param use_copy: use COPY, INSERT when False
+    :return: dict with loaded and rejected counts, errors and seconds taken
+    """
+    table, columns, validate, after_load, unique = IMPORTS[kind]
+    load = copy_rows if use_copy else insert_rows
+
+    started = time.time()
+    loaded = 0
+    errors = []
+    keys = set()
+    for batch in batches(read_records(path), batch_size):
+        valid, batch_errors = validate(batch)
+        if unique:
+            valid, key_errors = check_keys(unique, valid, keys)
+            batch_errors = sorted(batch_errors + key_errors)
+        errors += batch_errors
+        if valid:
+            rows = [row for line, row in valid]
+            load(table, columns, rows)
+            if after_load:
+                after_load(rows)
+            loaded += len(valid)
+
+    return {"loaded": loaded, "rejected": len(errors), "errors": errors, "seconds": time.time() - started}
+
+
+class ImportCommand(Command):
+    """Bulk loads drivers, branches and cars from NDJSON or CSV files in one transaction"""
+
+    option_list = (
+        Option('--drivers', dest='drivers', help='NDJSON or CSV file of drivers'),
+        Option('--branches', dest='branches', help='NDJSON or CSV file of branches'),
+        Option('--cars', dest='cars', help='NDJSON or CSV file of cars, loaded after drivers and branches'),
+        Option('--batch-size', dest='batch_size', type=int, default=10000),
+        Option('--no-copy', dest='use_copy', action='store_false', default=True,
+               help='Use INSERT instead of COPY'),
+        Option('--dry-run', dest='dry_run', action='store_true', default=False,
+               help='Validate and load, then roll back'),
+    )
+
+    def run(self, drivers, branches, cars, batch_size, use_copy, dry_run):
+        files = [(kind, path) for kind, path in [("drivers", drivers), ("branches", branches), ("cars", cars)] if path]
+        if not files:
+            print("Nothing to import, pass --drivers, --branches and/or --cars")
+            return
+
+        try:
+            for kind, path in files:
+                stats = import_file(kind, path, batch_size, use_copy)
+                rate = stats["loaded"] / stats["seconds"] if stats["seconds"] else 0
+                print("{}: {} rows loaded, {} rejected in {:.2f}s ({:.0f} rows/s)".format(
+                    kind, stats["loaded"], stats["rejected"], stats["seconds"], rate))
+                for line, message in stats["errors"][:20]:
+                    print("  {}:{}: {}".format(path, line, message))
+            if dry_run:
+                db.session.rollback()
+                print("Dry run, rolled back")
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
@@ -0,0 +1,85 @@
+import os
+import time
+from flask import g, request, has_request_context, Response
+from prometheus_client import Histogram, Gauge, Counter, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, \
+    REGISTRY
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Metrics live at module level, they are registered once per process however many apps are created
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by endpoint and status',
+                            ['method', 'endpoint', 'status'])
+REQUEST_QUERIES = Histogram('http_request_sql_queries', 'SQL statements issued per request by endpoint',
+                            ['method', 'endpoint'], buckets=(0, 1, 2, 3, 4, 5, 10, 20, 50, 100, float('inf')))
+REQUEST_SQL_TIME = Histogram('http_request_sql_seconds', 'Time spent in SQL statements per request by endpoint',
+                             ['method', 'endpoint'])
+
+# Connection pool of every worker (see app/pool.py), gauges are added up over live workers
+POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_seconds', 'Time to get a connection from the pool, including '
+                               'waiting for a free one and opening a new one',
+                               buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30,
+                                        float('inf')))
+POOL_TIMEOUTS = Counter('db_pool_checkout_timeouts', 'Checkouts that gave up waiting for a free connection')
+POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections in use', multiprocess_mode='livesum')
+POOL_CAPACITY = Gauge('db_pool_capacity', 'Most connections the pools can open (size + overflow)',
+                      multiprocess_mode='livesum')
+
+
+class RequestMetrics(object):
+    """
+    Records latency, SQL statement count and SQL time of every request and exposes them at /metrics.
+
+    Under gunicorn every worker writes its samples to files in prometheus_multiproc_dir (see gunicorn.conf.py) and
+    /metrics aggregates all of them, whichever worker answers the scrape. Without the variable the metrics of the
+    current process are shown.
+    """
+
+    def __init__(self):
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/metrics', 'metrics', self.expose, methods=['GET'])
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+
+    def after_request(self, response):
+        if 'metrics_started' not in g:
+            return response
+        method = request.method
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'  # raw paths would explode labels
+        REQUEST_LATENCY.labels(method, endpoint, self.status(response)).observe(
+            time.perf_counter() - g.metrics_started)
+        REQUEST_QUERIES.labels(method, endpoint).observe(g.sql_queries)
+        REQUEST_SQL_TIME.labels(method, endpoint).observe(g.sql_seconds)
+        return response
+
+    def status(self, response):
+        # Errors are returned with HTTP 200 and the real status in the body, prefer that one. It's kept on the response
+        # where the body is built (helpers.with_status), the body is never decoded here
+        return str(getattr(response, 'app_status', response.status_code))
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['metrics_started'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_queries' in g:
+            g.sql_queries += 1
+            g.sql_seconds += time.perf_counter() - conn.info['metrics_started']
+
+    def expose(self):
+        if os.environ.get('prometheus_multiproc_dir'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = RequestMetrics()
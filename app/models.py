@@ -1,8 +1,475 @@
+from flask import g, has_app_context
 from app import db
+from app.cache import cache
+from app.helpers import ApiError
+from contextlib import contextmanager
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext import baked
 import datetime
 
+# Built and compiled queries of every lookup shape, see search_query
+bakery = baked.bakery(size=500)
+
+
+def commit():
+    # Ends a write. Sub-requests of a /batch only flush, the batch commits all of them at once
+    if has_app_context() and g.get('batch'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def in_ids(column, ids):
+    """
+    Builds column IN (...) filter. On PostgreSQL ids are sent as one array parameter (column = ANY(:ids)), so the
+    statement doesn't grow and recompile with the number of ids
+
+    :param column: column to filter on
+    :param ids: iterable of ints
+    :return: filter expression
+    """
+    ids = list(ids)
+    if db.engine.dialect.name == 'postgresql':
+        return any_id(column, ids)
+    return column.in_(ids)
+
+
+def any_id(column, ids):
+    # PostgreSQL form of in_ids, which needs the app context for the dialect
+    return column == db.func.any(db.bindparam(None, list(ids), type_=postgresql.ARRAY(db.Integer)))
+
+
+def stream_rows(table, fields, batch_size):
+    """
+    Reads the whole table in id order through a server side cursor, so memory stays flat whatever the table size
+
+    :param table: table to read
+    :param fields: names of the columns to select
+    :param batch_size: number of rows fetched from the cursor at a time
+    :return: generator of lists of row tuples
+    """
+    statement = db.select([table.c[field] for field in fields]).order_by(table.c.id)
+    result = db.session.connection().execution_options(stream_results=True).execute(statement)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def search_query(model, names, fields=None):
+    """
+    Baked query filtering model on columns by equality, values are bound later with .params(). The query is built and
+    compiled once for every model and set of column names, repeated lookups of the same shape skip both steps
+
+    :param model: model class
+    :param names: column names to filter on, the keys of the search params
+    :param fields: names of the columns to select as row tuples, model objects are loaded without it
+    :return: BakedQuery
+    """
+    if fields:
+        query = bakery(lambda session: session.query(*[model.__table__.c[field] for field in fields]), model, fields)
+    else:
+        query = bakery(lambda session: session.query(model), model)
+    for name in sorted(names):
+        query += (lambda q, name=name: q.filter(getattr(model, name) == db.bindparam(name)), name)
+    return query
+
+
+def search_statement(model, params, columns=None):
+    """
+    Core version of search_query with the values bound in place, for connections outside of the session (asgi.py)
+
+    :param model: model class
+    :param params: dict of column name => value, every one an equality filter
+    :param columns: columns to select, the export fields by default
+    :return: Select
+    """
+    table = model.__table__
+    statement = db.select(columns or [table.c[field] for field in model.export_fields])
+    for field, value in params.items():
+        statement = statement.where(table.c[field] == value)
+    return statement
+
+
+def get_first(model, params, fields=None):
+    # First record (or row of fields) matching params, None if there isn't one
+    return search_query(model, params, fields)(db.session()).params(**params).first()
+
+
+def get_page(model, params, limit, after=None):
+    # Keyset pagination: seek past the last id seen instead of using OFFSET. Rows of the export fields, no objects
+    query = search_query(model, params, model.export_fields)
+    if after is not None:
+        query += lambda q: q.filter(model.id > db.bindparam('after'))
+    query += lambda q: q.order_by(model.id).limit(db.bindparam('limit'))
+    return query(db.session()).params(limit=limit, after=after, **params).all()
+
+
+def assignee_columns():
+    # Export fields of car, then of driver and branch labelled with their table name (driver_id, branch_id, ...)
+    return [Car.__table__.c[field] for field in Car.export_fields] + \
+        [model.__table__.c[field].label("%s_%s" % (model.__tablename__, field))
+         for model in (Driver, Branch) for field in model.export_fields]
+
+
+def assignee_join():
+    # Only one of a car's driver_id and branch_id is set, the other join finds nothing
+    joined = Car.__table__.outerjoin(Driver.__table__, Driver.id == Car.driver_id)
+    return joined.outerjoin(Branch.__table__, Branch.id == Car.branch_id)
+
+
+def get_with_assignee(params):
+    """
+    First car matching params together with its driver or branch, LEFT JOINed to both tables in one baked query
+
+    :param params: validated car search params
+    :return: row of assignee_columns(), None if no car matches
+    """
+    query = bakery(lambda session: session.query(*assignee_columns()).select_from(assignee_join()), "assignee")
+    for name in sorted(params):
+        query += (lambda q, name=name: q.filter(getattr(Car, name) == db.bindparam(name)), name)
+    return query(db.session()).params(**params).first()
+
+
+def get_rows(model, ids):
+    # Rows of the export fields of records with the given ids in one WHERE id = ANY(:ids) query, in no set order
+    query = db.session.query(*[model.__table__.c[field] for field in model.export_fields])
+    return query.filter(in_ids(model.id, ids)).all()
+
+
+def get_version(model, id):
+    # Reads only the version of a record, None if it doesn't exist
+    return db.session.query(model.version).filter(model.id == id).scalar()
+
+
+def update_statement(model, id, values):
+    # UPDATE ... WHERE id = :id RETURNING id, moving the version on. Without values nothing changes, the record is
+    # only looked up so its version (and ETag) stays
+    if not values:
+        return db.select([model.id]).where(model.id == id)
+    statement = model.__table__.update().where(model.id == id)
+    return statement.values(dict(values, version=model.version + 1)).returning(model.id)
+
+
+def delete_statement(model, id, *returning):
+    # DELETE ... WHERE id = :id RETURNING id and the returning columns
+    return model.__table__.delete().where(model.id == id).returning(model.id, *returning)
+
+
+def update_row(model, id, values):
+    """
+    Updates a record in one UPDATE ... WHERE id = :id RETURNING id statement, without loading it first
+
+    :param model: model class
+    :param id: id of the record
+    :param values: dict of column => new value
+    :return: True if the record exists and was updated
+    """
+    if db.session.execute(update_statement(model, id, values)).first() is None:
+        return False
+    if values:
+        cache.invalidate_on_commit(db.session, model.__tablename__, id)
+    return True
+
+
+def delete_row(model, id, *returning):
+    """
+    Deletes a record in one DELETE ... WHERE id = :id RETURNING statement, without loading it first
+
+    :param model: model class
+    :param id: id of the record
+    :param returning: extra columns of the deleted row to return
+    :return: row of id and returning columns, None if the record doesn't exist
+    """
+    row = db.session.execute(delete_statement(model, id, *returning)).first()
+    if row is not None:
+        cache.invalidate_on_commit(db.session, model.__tablename__, id)
+    return row
+
+
+@contextmanager
+def unique_key(model):
+    # A write giving a record the upsert_key of another one fails with a 400 instead of an IntegrityError
+    try:
+        yield
+    except IntegrityError:
+        raise ApiError(400, model.__name__ + " already exists")
+
+
+def spaceless(column):
+    # Column with its spaces taken out. Literals rather than bound parameters, so ON CONFLICT matches the index
+    # expression on asyncpg too
+    return db.func.replace(column, db.literal_column("' '"), db.literal_column("''"))
+
+
+def key_columns(model):
+    # Expressions of the unique index on upsert_key, fields in spaceless_key are compared without their spaces
+    return [spaceless(model.__table__.c[field]) if field in model.spaceless_key else model.__table__.c[field]
+            for field in model.upsert_key]
+
+
+def natural_key(model, row):
+    """
+    Value of key_columns for a record, so "e1w 3ss" and "e1w3ss" are the same branch
+
+    :param model: Branch or Driver
+    :param row: dict of upsert_fields
+    :return: tuple
+    """
+    return tuple(row[field].replace(' ', '') if field in model.spaceless_key else row[field]
+                 for field in model.upsert_key)
+
+
+def existing_keys(model, keys):
+    """
+    Finds which natural keys are taken already, in one query
+
+    :param model: Branch or Driver
+    :param keys: list of natural_key tuples
+    :return: set of the keys some record has
+    """
+    if not keys:
+        return set()
+    columns = key_columns(model)
+    query = db.session.query(*columns).filter(db.tuple_(*columns).in_(keys))
+    return set(tuple(row) for row in query.all())
+
+
+def upsert_statement(model, rows):
+    """
+    Builds one INSERT ... ON CONFLICT (key_columns) DO UPDATE of the rows. Records whose upsert_fields are already the
+    same are left alone, so their version doesn't move and they aren't returned
+
+    :param model: Branch or Driver
+    :param rows: list of dicts of upsert_fields and the values of other columns to insert
+    :return: statement returning id and whether it was inserted (xmax = 0) of every row inserted or updated
+    """
+    table = model.__table__
+    statement = postgresql.insert(table).values(rows)
+    fields = [field for field in model.upsert_fields if field not in model.upsert_key]
+    changed = db.or_(*[table.c[field].is_distinct_from(statement.excluded[field]) for field in fields])
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns(model), where=changed,
+        set_=dict({field: statement.excluded[field] for field in fields}, version=table.c.version + 1))
+    return statement.returning(table.c.id, db.literal_column('xmax = 0'))
+
+
+def upsert_statements(model, rows, chunk_size=1000):
+    # upsert_statement of every chunk of rows. Rows are written in key order, so concurrent upserts of the same records
+    # lock them in the same order instead of deadlocking
+    rows = sorted(rows, key=lambda row: [str(value) for value in natural_key(model, row)])
+    for start in range(0, len(rows), chunk_size):
+        yield upsert_statement(model, rows[start:start + chunk_size])
+
+
+def upsert_rows(model, rows, chunk_size=1000):
+    """
+    Inserts or updates records by their upsert_key in chunks, committed once by the caller
+
+    :param model: Branch or Driver
+    :param rows: list of dicts of upsert_fields, no two with the same key
+    :param chunk_size: rows per statement
+    :return: number of records inserted and number of records updated, the other rows were unchanged
+    """
+    inserted = updated = 0
+    for statement in upsert_statements(model, rows, chunk_size):
+        for id, new in db.session.execute(statement):
+            if new:
+                inserted += 1
+            else:
+                updated += 1
+                cache.invalidate_on_commit(db.session, model.__tablename__, id)
+    return inserted, updated
+
+
+def occupancy_changes(old, new):
+    """
+    Works out how branch counters change when a car moves from one assignment to another
+
+    :param old: (assigned_type, assigned_id) before, None for a new car
+    :param new: (assigned_type, assigned_id) after, None for a deleted car
+    :return: dict of branch id => number of cars added (or removed if negative)
+    """
+    changes = {}
+    if old and old[0] == 2:
+        changes[old[1]] = -1
+    if new and new[0] == 2:
+        changes[new[1]] = changes.get(new[1], 0) + 1
+    return changes
+
+
+def assignment_values(assigned_type, assigned_id):
+    # Foreign keys mirroring an assignment, written together with assigned_type and assigned_id (see ck_car_assignment)
+    return {"driver_id": assigned_id if assigned_type == 1 else None,
+            "branch_id": assigned_id if assigned_type == 2 else None}
+
+
+def unassign_statement(column, id):
+    # UPDATE car ... WHERE driver_id (or branch_id) = :id RETURNING id, unassigning the cars of a driver or branch
+    statement = Car.__table__.update().where(column == id)
+    statement = statement.values(dict(assignment_values(None, None), assigned_type=None, assigned_id=None,
+                                      version=Car.version + 1))
+    return statement.returning(Car.id)
+
+
+def unassign_cars(column, id):
+    # Unassigns the cars before their driver or branch is deleted, the foreign key would reject the delete otherwise
+    for car_id, in db.session.execute(unassign_statement(column, id)):
+        cache.invalidate_on_commit(db.session, Car.__tablename__, car_id)
+
+
+def orphans_statement():
+    # Unassigns cars whose driver or branch doesn't exist (or with a half set assignment), RETURNING their ids
+    valid = db.or_(
+        db.and_(Car.assigned_type == 1, db.exists().where(Driver.id == Car.assigned_id)),
+        db.and_(Car.assigned_type == 2, db.exists().where(Branch.id == Car.assigned_id)),
+        db.and_(Car.assigned_type.is_(None), Car.assigned_id.is_(None)))
+    statement = Car.__table__.update().where(db.not_(db.func.coalesce(valid, False)))
+    statement = statement.values(dict(assignment_values(None, None), assigned_type=None, assigned_id=None,
+                                      version=Car.version + 1))
+    return statement.returning(Car.id)
+
+
+def backfill_statement(start, end):
+    # Sets driver_id and branch_id from the assignment of cars with start < id <= end, where they don't match yet
+    driver_id = db.case([(Car.assigned_type == 1, Car.assigned_id)])
+    branch_id = db.case([(Car.assigned_type == 2, Car.assigned_id)])
+    statement = Car.__table__.update().where(Car.id > start).where(Car.id <= end)
+    statement = statement.where(db.or_(Car.driver_id.is_distinct_from(driver_id),
+                                       Car.branch_id.is_distinct_from(branch_id)))
+    return statement.values(driver_id=driver_id, branch_id=branch_id)
+
+
+def transfer_statement(ids, params, assigned_type, assigned_id):
+    """
+    Builds one statement moving cars to a new assignment. The cars are locked and updated in a single UPDATE ... FROM
+    and the moved ones come back grouped by their old assignment, so the result stays small however many move
+
+    :param ids: ids of the cars, None to pick them by params only
+    :param params: filters on car columns, like search params
+    :param assigned_type: type to assign to
+    :param assigned_id: id to assign to
+    :return: select of (old assigned_type, old assigned_id, ids of cars moved) rows
+    """
+    old = db.select([Car.id, Car.assigned_type, Car.assigned_id])
+    if ids is not None:
+        # PostgreSQL only like the rest of the statement, no need for in_ids
+        old = old.where(Car.id == db.func.any(db.bindparam('ids', ids, type_=postgresql.ARRAY(db.Integer))))
+    for name, value in params.items():
+        old = old.where(Car.__table__.c[name] == value)
+    old = old.with_for_update().alias('old')
+
+    statement = Car.__table__.update().where(Car.id == old.c.id)
+    # cars already there are left alone, their version doesn't move
+    statement = statement.where(db.or_(old.c.assigned_type.is_distinct_from(assigned_type),
+                                       old.c.assigned_id.is_distinct_from(assigned_id)))
+    statement = statement.values(assigned_type=assigned_type, assigned_id=assigned_id, version=Car.version + 1,
+                                 **assignment_values(assigned_type, assigned_id))
+    moved = statement.returning(Car.id, old.c.assigned_type, old.c.assigned_id).cte('moved')
+    return db.select([moved.c.assigned_type, moved.c.assigned_id, db.func.array_agg(moved.c.id).label('ids')]).group_by(
+        moved.c.assigned_type, moved.c.assigned_id)
+
+
+def transfer_changes(rows, new):
+    """
+    Works out how branch counters change with a transfer
+
+    :param rows: result of transfer_statement
+    :param new: (assigned_type, assigned_id) the cars moved to
+    :return: dict of branch id => number of cars added (or removed if negative)
+    """
+    changes = {}
+    for assigned_type, assigned_id, ids in rows:
+        for id, delta in occupancy_changes((assigned_type, assigned_id), new).items():
+            changes[id] = changes.get(id, 0) + delta * len(ids)
+    return changes
+
+
+def free_slots_statement(ids):
+    # Id and free slots of branches, locked (in id order) until the transaction ends so the slots stay free while
+    # cars are added
+    statement = db.select([Branch.id, (Branch.capacity - Branch.occupancy).label("free")])
+    return statement.where(any_id(Branch.id, ids)).order_by(Branch.id).with_for_update()
+
+
+def car_insert_statement(rows):
+    # Multi-row INSERT ... VALUES (...), (...) of validated cars with the foreign keys of their assignment
+    return Car.__table__.insert().values([dict(row, **assignment_values(row['assigned_type'], row['assigned_id']))
+                                          for row in rows])
+
+
+def added_cars(rows):
+    # Occupancy changes of cars inserted outside of the ORM: dict of branch id => number of cars added
+    changes = {}
+    for row in rows:
+        if row['assigned_type'] == 2:
+            changes[row['assigned_id']] = changes.get(row['assigned_id'], 0) + 1
+    return changes
+
+
+def occupancy_statement(changes):
+    """
+    Builds one UPDATE of the occupancy counters of all changed branches. Adding cars is conditional on the branch
+    having room in the same statement, so the check and the change happen under the row lock and concurrent
+    assigners can't both take the last slot
+
+    :param changes: dict of branch id => number of cars added (or removed if negative)
+    :return: UPDATE ... RETURNING id statement, branches left out of the result didn't have room
+    """
+    ids = sorted(id for id, delta in changes.items() if delta)  # same lock order in every transaction
+    deltas = [changes[id] for id in ids]
+    array = postgresql.ARRAY(db.Integer)
+    rows = db.select([db.func.unnest(db.cast(db.bindparam('ids', ids, type_=array), array)).label('id'),
+                      db.func.unnest(db.cast(db.bindparam('deltas', deltas, type_=array), array)).label('delta')])
+    rows = rows.alias('changes')
+    table = Branch.__table__
+    statement = table.update().where(table.c.id == rows.c.id)
+    statement = statement.where(db.or_(rows.c.delta < 0, table.c.occupancy + rows.c.delta <= table.c.capacity))
+    statement = statement.values(occupancy=table.c.occupancy + rows.c.delta, version=table.c.version + 1)
+    return statement.returning(table.c.id)
+
+
+def check_occupancy_changed(changes, changed):
+    """
+    Checks that every branch of changes was updated by occupancy_statement
+
+    :param changes: dict of branch id => number of cars added (or removed if negative)
+    :param changed: ids returned by the statement
+    :raises ApiError: if a branch didn't have room for the cars
+    """
+    if len(changed) < len([delta for delta in changes.values() if delta]):
+        raise ApiError(400, "Branch has reached its capacity")
+
+
+def bump_version(record):
+    # Every change to a persistent record moves its version on, computed in SQL so concurrent writers don't collide
+    if db.inspect(record).persistent:
+        record.version = type(record).version + 1
+
+
 class Car(db.Model):
     __tablename__ = 'car'
+    __table_args__ = (
+        db.Index('ix_car_assigned', 'assigned_type', 'assigned_id'),  # branch capacity checks and assignment lookups
+        db.Index('ix_car_driver_id', 'driver_id', 'id'),  # joins to driver and keyset pages of a driver's cars
+        db.Index('ix_car_branch_id', 'branch_id', 'id'),
+        # driver_id or branch_id holds assigned_id, depending on assigned_type. Both are null for an unassigned car
+        db.CheckConstraint("CASE assigned_type "
+                           "WHEN 1 THEN assigned_id IS NOT NULL AND driver_id IS NOT DISTINCT FROM assigned_id "
+                           "AND branch_id IS NULL "
+                           "WHEN 2 THEN assigned_id IS NOT NULL AND branch_id IS NOT DISTINCT FROM assigned_id "
+                           "AND driver_id IS NULL "
+                           "ELSE assigned_type IS NULL AND assigned_id IS NULL AND driver_id IS NULL "
+                           "AND branch_id IS NULL END", name='ck_car_assignment'),
+        db.Index('ix_car_make_model_year', 'make', 'model', 'year'),
+        db.Index('ix_car_model_year', 'model', 'year'),
+        db.Index('ix_car_year', 'year'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     make = db.Column(db.String(100), nullable=False)
@@ -10,6 +477,12 @@ class Car(db.Model):
     year = db.Column(db.Integer(), nullable=False)
     assigned_type = db.Column(db.Integer(), nullable=True)
     assigned_id = db.Column(db.Integer(), nullable=True)
+    # Set from assigned_type and assigned_id by assignment_values, so the database can check and join them
+    driver_id = db.Column(db.Integer(), db.ForeignKey('driver.id', name='fk_car_driver_id'), nullable=True)
+    branch_id = db.Column(db.Integer(), db.ForeignKey('branch.id', name='fk_car_branch_id'), nullable=True)
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default='1')  # changes on every update
+
+    export_fields = ("id", "make", "model", "year", "assigned_type", "assigned_id", "version")
 
     def __init__(self, make, model, year, assigned_type=None, assigned_id=None):
         self.make = make
@@ -20,27 +493,110 @@ class Car(db.Model):
 
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        for name, value in assignment_values(self.assigned_type, self.assigned_id).items():
+            setattr(self, name, value)
+        self.update_occupancy()
+        bump_version(self)
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
+        commit()
 
     def delete(self):
+        if self.assigned_type == 2:
+            Branch.adjust_occupancy({self.assigned_id: -1})
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit()
+
+    def update_occupancy(self):
+        # Move the car between branch counters if its assignment changed since it was loaded
+        state = db.inspect(self)
+        old = None
+        if state.persistent:
+            type_history = state.attrs.assigned_type.history
+            id_history = state.attrs.assigned_id.history
+            old = (type_history.deleted[0] if type_history.deleted else self.assigned_type,
+                   id_history.deleted[0] if id_history.deleted else self.assigned_id)
+        new = (self.assigned_type, self.assigned_id)
+        if old != new:
+            Branch.adjust_occupancy(occupancy_changes(old, new))
+
+    def update_by_id(id, values):
+        # Single statement update, when the assignment changes the old one is read back through RETURNING
+        if "assigned_type" not in values:
+            return update_row(Car, id, values)
+
+        row = db.session.execute(Car.reassign_statement(id, values)).first()
+        if row is None:
+            return False
+
+        Branch.adjust_occupancy(occupancy_changes(tuple(row), (values["assigned_type"], values["assigned_id"])))
+        cache.invalidate_on_commit(db.session, Car.__tablename__, id)
+        return True
+
+    def reassign_statement(id, values):
+        # UPDATE ... FROM a locked select of the old row, so the old assignment comes back through RETURNING
+        old = db.select([Car.id, Car.assigned_type, Car.assigned_id]).where(Car.id == id).with_for_update()
+        old = old.alias('old')
+        statement = Car.__table__.update().where(Car.id == old.c.id)
+        statement = statement.values(dict(values, version=Car.version + 1,
+                                          **assignment_values(values["assigned_type"], values["assigned_id"])))
+        return statement.returning(old.c.assigned_type, old.c.assigned_id)
+
+    def transfer(ids, params, assigned_type, assigned_id):
+        # Moves cars in one statement and the counters of all branches involved in one more, returns number moved
+        rows = db.session.execute(transfer_statement(ids, params, assigned_type, assigned_id)).fetchall()
+        Branch.adjust_occupancy(transfer_changes(rows, (assigned_type, assigned_id)))
+        moved = [id for row in rows for id in row[2]]
+        for id in moved:
+            cache.invalidate_on_commit(db.session, Car.__tablename__, id)
+        return len(moved)
+
+    def delete_by_id(id):
+        row = delete_row(Car, id, Car.assigned_type, Car.assigned_id)
+        if row is None:
+            return False
+        Branch.adjust_occupancy(occupancy_changes((row.assigned_type, row.assigned_id), None))
+        return True
 
     def get(params):
-        query = db.session.query(Car)
-        if "id" in params.keys():
-            query = query.filter(Car.id == params['id'])
-        if "make" in params.keys():
-            query = query.filter(Car.make == params['make'])
-        if "model" in params.keys():
-            query = query.filter(Car.model == params['model'])
-        if "year" in params.keys():
-            query = query.filter(Car.year == params['year'])
-        if "assigned_type" in params.keys():
-            query = query.filter(Car.assigned_type == params['assigned_type'])
-        if "assigned_id" in params.keys():
-            query = query.filter(Car.assigned_id == params['assigned_id'])
-        return query.first()
+        return get_first(Car, params)
+
+    def get_row(params):
+        return get_first(Car, params, Car.export_fields)
+
+    def get_rows(ids):
+        return get_rows(Car, ids)
+
+    def get_page(params, limit, after=None):
+        return get_page(Car, params, limit, after)
+
+    def bulk_insert(rows, chunk_size=1000):
+        # Multi-row INSERT ... VALUES (...), (...) in chunks, committed once by the caller
+        for start in range(0, len(rows), chunk_size):
+            db.session.execute(car_insert_statement(rows[start:start + chunk_size]))
+        Branch.add_cars(rows)
+
+    def get_with_assignee(params):
+        return get_with_assignee(params)
+
+    def export(batch_size=1000):
+        return stream_rows(Car.__table__, Car.export_fields, batch_size)
+
+    def serialize_row(row):
+        return dict(zip(Car.export_fields, row))
+
+    def serialize_with_assignee(row):
+        # Row of assignee_columns() as the car with its driver or branch under assignee, None if it's unassigned
+        car = Car.serialize_row(row[:len(Car.export_fields)])
+        driver = row[len(Car.export_fields):len(Car.export_fields) + len(Driver.export_fields)]
+        branch = row[len(Car.export_fields) + len(Driver.export_fields):]
+        if driver[0] is not None:
+            car["assignee"] = Driver.serialize_row(driver)
+        elif branch[0] is not None:
+            car["assignee"] = Branch.serialize_row(branch)
+        else:
+            car["assignee"] = None
+        return car
 
     def serialize(self):
         return {
@@ -49,64 +605,155 @@ class Car(db.Model):
             "model": self.model,
             "year": self.year,
             "assigned_type": self.assigned_type,
-            "assigned_id": self.assigned_id
+            "assigned_id": self.assigned_id,
+            "version": self.version
         }
 
 
 class Branch(db.Model):
     __tablename__ = 'branch'
+    __table_args__ = (
+        db.Index('ix_branch_city', 'city'),
+        db.Index('ix_branch_postcode', 'postcode'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     city = db.Column(db.String(60), nullable=False)
     postcode = db.Column(db.String(8), nullable=False)
     capacity = db.Column(db.Integer(), nullable=False)
+    occupancy = db.Column(db.Integer(), nullable=False, default=0, server_default='0')  # cars assigned to branch
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default='1')  # changes on every update
+
+    export_fields = ("id", "city", "postcode", "capacity", "occupancy", "version")
+    occupancy_fields = ("id", "city", "postcode", "capacity", "occupancy", "free")  # columns of the occupancy report
+    upsert_fields = ("city", "postcode", "capacity")
+    upsert_key = ("postcode",)
+    spaceless_key = ("postcode",)  # postcodes are the same branch however they're spaced, see ux_branch_postcode
 
     def __init__(self, city, postcode, capacity):
         self.city = city
         self.postcode = postcode
         self.capacity = capacity
+        self.occupancy = 0
 
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self)
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
+        with unique_key(Branch):
+            commit()
 
     def delete(self):
+        unassign_cars(Car.branch_id, self.id)
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit()
+
+    def update_by_id(id, values):
+        with unique_key(Branch):
+            return update_row(Branch, id, values)
+
+    def upsert(rows, chunk_size=1000):
+        return upsert_rows(Branch, rows, chunk_size)
+
+    def delete_by_id(id):
+        unassign_cars(Car.branch_id, id)
+        return delete_row(Branch, id) is not None
 
     def get(params):
-        query = db.session.query(Branch)
-        if "id" in params.keys():
-            query = query.filter(Branch.id == params['id'])
-        if "city" in params.keys():
-            query = query.filter(Branch.city == params['city'])
-        if "postcode" in params.keys():
-            query = query.filter(Branch.id == params['postcode'])
-        return query.first()
-
-    def get_assigned_cars_count(self, id):
-        query = db.session.query(Car.id)
-        query = query.filter(Car.assigned_type == 2)
-        query = query.filter(Car.assigned_id == id)
-        return query.count()
+        return get_first(Branch, params)
+
+    def get_row(params):
+        return get_first(Branch, params, Branch.export_fields)
+
+    def get_rows(ids):
+        return get_rows(Branch, ids)
+
+    def get_page(params, limit, after=None):
+        return get_page(Branch, params, limit, after)
+
+    def occupancy_report(city=None, from_view=False):
+        # Rows of occupancy_view's columns for every branch (of a city) in one query, see occupancy_report_statement
+        return db.session.execute(occupancy_report_statement(city, from_view)).fetchall()
+
+    def get_free_slots(ids):
+        # Locks the branches until the caller commits, see free_slots_statement
+        return dict(db.session.execute(free_slots_statement(ids)).fetchall())
+
+    def adjust_occupancy(changes):
+        # changes is a dict of branch id => number of cars added (or removed if negative), runs in caller's transaction.
+        # Raises ApiError when a branch doesn't have room, the caller's transaction has to be rolled back then
+        if not any(changes.values()):
+            return
+        changed = [id for id, in db.session.execute(occupancy_statement(changes))]
+        for id in changed:
+            cache.invalidate_on_commit(db.session, Branch.__tablename__, id)
+        check_occupancy_changed(changes, changed)
+
+    def add_cars(rows):
+        # Counts cars inserted outside of the ORM (bulk insert, import) into their branches
+        Branch.adjust_occupancy(added_cars(rows))
+
+    def check_occupancy():
+        # Compares counters with the car table, returns list of (branch id, stored, actual) that don't match
+        counts = db.session.query(Car.assigned_id, db.func.count(Car.id).label('count')).filter(Car.assigned_type == 2)
+        counts = counts.group_by(Car.assigned_id).subquery()
+        actual = db.func.coalesce(counts.c.count, 0)
+        query = db.session.query(Branch.id, Branch.occupancy, actual)
+        query = query.outerjoin(counts, counts.c.assigned_id == Branch.id)
+        query = query.filter(Branch.occupancy != actual)
+        return query.order_by(Branch.id).all()
+
+    def rebuild_occupancy():
+        # Recounts every branch in one statement, returns number of branches updated
+        count = db.select([db.func.count(Car.id)]).where(Car.assigned_type == 2)
+        count = count.where(Car.assigned_id == Branch.id).as_scalar()
+        statement = Branch.__table__.update().values(occupancy=count, version=Branch.version + 1)
+        statement = statement.where(Branch.occupancy != count)
+        return db.session.execute(statement).rowcount
+
+    def export(batch_size=1000):
+        return stream_rows(Branch.__table__, Branch.export_fields, batch_size)
+
+    def serialize_occupancy(rows):
+        # Report of occupancy_report rows, with the totals of all branches in it
+        items = [dict(zip(Branch.occupancy_fields, row)) for row in rows]
+        return {"items": items, "capacity": sum(item["capacity"] for item in items),
+                "occupancy": sum(item["occupancy"] for item in items), "free": sum(item["free"] for item in items)}
+
+    def serialize_row(row):
+        return dict(zip(Branch.export_fields, row))
 
     def serialize(self):
         return {
             "id": self.id,
             "city": self.city,
             "postcode": self.postcode,
-            "capacity": self.capacity
+            "capacity": self.capacity,
+            "occupancy": self.occupancy,
+            "version": self.version
         }
 
 
 class Driver(db.Model):
     __tablename__ = 'driver'
+    __table_args__ = (
+        db.Index('ux_driver_name_dob', 'last_name', 'first_name', 'dob', unique=True),  # natural key of /driver/upsert
+        db.Index('ix_driver_first_name', 'first_name'),
+        db.Index('ix_driver_dob', 'dob'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100), nullable=False)
     middle_name = db.Column(db.String(100), nullable=True)
     last_name = db.Column(db.String(100), nullable=False)
     dob = db.Column(db.Date, nullable=False)
+    version = db.Column(db.Integer(), nullable=False, default=1, server_default='1')  # changes on every update
+
+    export_fields = ("id", "first_name", "middle_name", "last_name", "dob", "version")
+    upsert_fields = ("first_name", "middle_name", "last_name", "dob")
+    upsert_key = ("first_name", "last_name", "dob")
+    spaceless_key = ()
 
     def __init__(self, first_name, middle_name, last_name, dob):
         self.first_name = first_name
@@ -116,25 +763,54 @@ class Driver(db.Model):
 
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self)
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
+        with unique_key(Driver):
+            commit()
 
     def delete(self):
+        unassign_cars(Car.driver_id, self.id)
+        cache.invalidate_on_commit(db.session, self.__tablename__, self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit()
+
+    def update_by_id(id, values):
+        with unique_key(Driver):
+            return update_row(Driver, id, values)
+
+    def upsert(rows, chunk_size=1000):
+        return upsert_rows(Driver, rows, chunk_size)
+
+    def delete_by_id(id):
+        unassign_cars(Car.driver_id, id)
+        return delete_row(Driver, id) is not None
 
     def get(params):
-        query = db.session.query(Driver)
-        if "id" in params.keys():
-            query = query.filter(Driver.id == params['id'])
-        if "first_name" in params.keys():
-            query = query.filter(Driver.first_name == params['first_name'])
-        if "middle_name" in params.keys():
-            query = query.filter(Driver.middle_name == params['middle_name'])
-        if "last_name" in params.keys():
-            query = query.filter(Driver.last_name == params['last_name'])
-        if "dob" in params.keys():
-            query = query.filter(Driver.dob == params['dob'])
-        return query.first()
+        return get_first(Driver, params)
+
+    def get_row(params):
+        return get_first(Driver, params, Driver.export_fields)
+
+    def get_rows(ids):
+        return get_rows(Driver, ids)
+
+    def get_page(params, limit, after=None):
+        return get_page(Driver, params, limit, after)
+
+    def get_existing_ids(ids):
+        if not ids:
+            return set()
+        query = db.session.query(Driver.id)
+        query = query.filter(in_ids(Driver.id, ids))
+        return set(id for id, in query.all())
+
+    def export(batch_size=1000):
+        return stream_rows(Driver.__table__, Driver.export_fields, batch_size)
+
+    def serialize_row(row):
+        driver = dict(zip(Driver.export_fields, row))
+        driver["dob"] = driver["dob"].strftime("%d/%m/%Y")
+        return driver
 
     def serialize(self):
         return {
@@ -142,5 +818,77 @@ class Driver(db.Model):
             "first_name": self.first_name,
             "middle_name": self.middle_name,
             "last_name": self.last_name,
-            "dob": self.dob.strftime("%d/%m/%Y")
-        }
\ No newline at end of file
+            "dob": self.dob.strftime("%d/%m/%Y"),
+            "version": self.version
+        }
+
+
+# Natural key of /branch/upsert. Postcodes are stored as sent (lower case), the index compares them without spaces
+db.Index('ux_branch_postcode', *key_columns(Branch), unique=True)
+
+# Materialized occupancy_select(), read instead of it when the view is enabled (OCCUPANCY_VIEW). It's kept out of
+# db.metadata so create_all and drop_all leave it alone
+occupancy_view = db.Table(
+    'branch_occupancy', db.MetaData(),
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('city', db.String(60)),
+    db.Column('postcode', db.String(8)),
+    db.Column('capacity', db.Integer()),
+    db.Column('occupancy', db.Integer()),
+    db.Column('free', db.Integer()),
+)
+
+
+def occupancy_select():
+    # Capacity, cars assigned and free slots of every branch, counted from the car table in one GROUP BY
+    branch = Branch.__table__
+    car = Car.__table__
+    occupancy = db.func.count(car.c.id)
+    joined = branch.outerjoin(car, car.c.branch_id == branch.c.id)
+    statement = db.select([branch.c.id, branch.c.city, branch.c.postcode, branch.c.capacity,
+                           occupancy.label('occupancy'), (branch.c.capacity - occupancy).label('free')])
+    return statement.select_from(joined).group_by(branch.c.id)
+
+
+def occupancy_report_statement(city=None, from_view=False):
+    """
+    Builds the query of the branch occupancy report, one row per branch ordered by id
+
+    :param city: only branches of this city
+    :param from_view: read the branch_occupancy materialized view instead of counting cars
+    :return: select of occupancy_view's columns
+    """
+    if from_view:
+        statement = db.select([occupancy_view])
+        table = occupancy_view
+    else:
+        statement = occupancy_select()
+        table = Branch.__table__
+    if city is not None:
+        statement = statement.where(table.c.city == city)
+    return statement.order_by(table.c.id)
+
+
+def create_occupancy_view(connection):
+    """
+    Creates the branch_occupancy materialized view (PostgreSQL only) with the unique index REFRESH CONCURRENTLY needs
+
+    :param connection: connection to run the DDL on
+    :return: True if the view was created, False if it already existed
+    """
+    if connection.execute("SELECT 1 FROM pg_matviews WHERE matviewname = %s", occupancy_view.name).first():
+        return False
+    definition = occupancy_select().compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    connection.execute('CREATE MATERIALIZED VIEW {} AS {}'.format(occupancy_view.name, definition))
+    connection.execute('CREATE UNIQUE INDEX ix_{0}_id ON {0} (id)'.format(occupancy_view.name))
+    return True
+
+
+def refresh_occupancy_view(connection, concurrently=True):
+    # Recounts the view, CONCURRENTLY keeps it readable meanwhile at the cost of a slower refresh
+    connection.execute('REFRESH MATERIALIZED VIEW {}{}'.format('CONCURRENTLY ' if concurrently else '',
+                                                               occupancy_view.name))
+
+
+def drop_occupancy_view(connection):
+    connection.execute('DROP MATERIALIZED VIEW IF EXISTS {}'.format(occupancy_view.name))
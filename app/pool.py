@@ -0,0 +1,56 @@
+import os
+import time
+import threading
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from app.metrics import POOL_CHECKOUT_WAIT, POOL_TIMEOUTS, POOL_CHECKED_OUT, POOL_CAPACITY
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that reports checkout time, timeouts and connections in use to the metrics. db_pool_checked_out over
+    db_pool_capacity is the saturation of the pools, capacity added up over every worker has to stay under the
+    max_connections of the database.
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30, **kw):
+        super(InstrumentedQueuePool, self).__init__(creator, pool_size, max_overflow, timeout, **kw)
+        self.timing = threading.local()
+        POOL_CAPACITY.set(pool_size + max(max_overflow, 0))
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself again on some paths, only the outermost call is timed
+        if getattr(self.timing, 'active', False):
+            return super(InstrumentedQueuePool, self)._do_get()
+
+        self.timing.active = True
+        started = time.perf_counter()
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            self.timing.active = False
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+        POOL_CHECKED_OUT.set(self.checkedout())
+        return connection
+
+    def _do_return_conn(self, conn):
+        super(InstrumentedQueuePool, self)._do_return_conn(conn)
+        POOL_CHECKED_OUT.set(self.checkedout())
+
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    # A connection opened before gunicorn forked (e.g. with --preload) belongs to the master. It's dropped without
+    # closing it, which would end the master's session, and the pool opens a new one for this worker
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError("Connection belongs to pid {}, opening a new one in pid {}".format(
+            connection_record.info['pid'], os.getpid()))
@@ -0,0 +1,217 @@
+from app import helpers
+from app.helpers import ApiError
+
+MISSING = object()
+
+
+# Checks take the value and the field name, return the clean value and raise ApiError when it's invalid
+string = helpers.validate_string
+integer = helpers.validate_int
+
+
+def year(value, name):
+    return helpers.validate_year(value)
+
+
+def postcode(value, name):
+    return helpers.validate_postcode(value)
+
+
+def dob(value, name):
+    return helpers.validate_dob(value)
+
+
+def ids(value, name):
+    return helpers.validate_ids(value)
+
+
+def transfer_ids(value, name):
+    return helpers.validate_ids(value, helpers.MAX_TRANSFER_SIZE)
+
+
+def car_filter(value, name):
+    # Same params as /car/get, at least one of them
+    if not isinstance(value, dict):
+        raise ApiError(400, "Invalid filter")
+    params = car_search(value)
+    if not params:
+        raise ApiError(400, "Invalid filter")
+    return params
+
+
+def sub_requests(value, name):
+    return helpers.validate_batch(value)
+
+
+def flag(value, name):
+    if not isinstance(value, bool):
+        raise ApiError(400, "Invalid " + name)
+    return value
+
+
+def raw(value, name):
+    # Passed through as it is, checked later (e.g. assigned_type by validate_assigning)
+    return value
+
+
+class Field(object):
+    """
+    One field of a schema
+
+    :param name: key in the payload
+    :param check: check function for the value
+    :param required: a missing field fails with "Missing <name>"
+    :param default: value of an optional field when it's missing, the field is left out when not set
+    """
+
+    def __init__(self, name, check, required=True, default=MISSING):
+        self.name = name
+        self.check = check
+        self.required = required
+        self.default = default
+
+
+class Schema(object):
+    """
+    Declares the fields of a payload in the order they are checked, the first error is the one reported.
+    compile() turns it into a plain function doing only the checks, generated once when the module is imported.
+
+    :param fields: Field objects
+    :param together: pairs of field names that have to be passed together
+    """
+
+    def __init__(self, *fields, together=()):
+        self.fields = fields
+        self.together = together
+
+    def compile(self):
+        # Unrolls the fields into the source of one function, so a request runs straight line checks with
+        # constant names and messages instead of looping over the field definitions
+        namespace = {"ApiError": ApiError}
+        lines = ["def validate(data):", "    clean = {}"]
+        for index, field in enumerate(self.fields):
+            if field.check is raw:
+                lines += ["    if %r in data:" % field.name, "        clean[%r] = data[%r]" % (field.name, field.name)]
+            else:
+                namespace["check_%d" % index] = field.check
+                lines += ["    if %r in data:" % field.name,
+                          "        clean[%r] = check_%d(data[%r], %r)" % (field.name, index, field.name, field.name)]
+            if field.required:
+                lines += ["    else:", "        raise ApiError(400, %r)" % ("Missing " + field.name)]
+            elif field.default is not MISSING:
+                namespace["default_%d" % index] = field.default
+                lines += ["    else:", "        clean[%r] = default_%d" % (field.name, index)]
+        for first, second in self.together:
+            lines += ["    if %r in clean and %r not in clean:" % (first, second),
+                      "        raise ApiError(400, %r)" % ("Missing " + second),
+                      "    if %r in clean and %r not in clean:" % (second, first),
+                      "        raise ApiError(400, %r)" % ("Missing " + first)]
+        lines.append("    return clean")
+        exec("\n".join(lines), namespace)
+
+        validate = namespace["validate"]
+        validate.__doc__ = """
+            Validates a payload
+
+            :param data: request data or args
+            :return: dict of clean values
+            :raises ApiError: if a field is missing or invalid
+            """
+        return validate
+
+
+def optional(name, check):
+    return Field(name, check, required=False)
+
+
+car_create = Schema(
+    Field("make", string),
+    Field("model", string),
+    Field("year", year),
+    Field("assigned_type", raw),
+    Field("assigned_id", integer),
+).compile()
+
+car_update = Schema(
+    Field("id", integer),
+    optional("make", string),
+    optional("model", string),
+    optional("year", year),
+    optional("assigned_type", raw),
+    optional("assigned_id", raw),
+    together=[("assigned_type", "assigned_id")],
+).compile()
+
+car_search = Schema(
+    optional("id", integer),
+    optional("make", string),
+    optional("model", string),
+    optional("year", year),
+    optional("assigned_type", integer),
+    optional("assigned_id", integer),
+).compile()
+
+# Cars picked by ids and/or filter, at least one of them is checked for by the handler
+car_transfer = Schema(
+    Field("assigned_type", raw),
+    Field("assigned_id", raw),
+    optional("ids", transfer_ids),
+    optional("filter", car_filter),
+).compile()
+
+branch_create = Schema(
+    Field("city", string),
+    Field("postcode", postcode),
+    Field("capacity", integer),
+).compile()
+
+branch_update = Schema(
+    Field("id", integer),
+    optional("city", string),
+    optional("postcode", postcode),
+    optional("capacity", integer),
+).compile()
+
+branch_search = Schema(
+    optional("id", integer),
+    optional("city", string),
+    optional("postcode", postcode),
+    optional("capacity", integer),
+).compile()
+
+branch_occupancy = Schema(
+    optional("city", string),
+).compile()
+
+driver_create = Schema(
+    Field("first_name", string),
+    Field("middle_name", string, required=False, default=None),  # middle name is optional for creating a driver
+    Field("last_name", string),
+    Field("dob", dob),  # only accepting drivers that are 18 or older
+).compile()
+
+driver_update = Schema(
+    Field("id", integer),
+    optional("first_name", string),
+    optional("middle_name", string),
+    optional("last_name", string),
+    optional("dob", dob),
+).compile()
+
+driver_search = Schema(
+    optional("id", integer),
+    optional("first_name", string),
+    optional("middle_name", string),
+    optional("last_name", string),
+    optional("dob", dob),
+).compile()
+
+# ids=1,2,3 on the get endpoints, or {"ids": [1, 2, 3]} in a POST body
+get_many = Schema(
+    Field("ids", ids),
+).compile()
+
+batch = Schema(
+    Field("requests", sub_requests),
+    Field("atomic", flag, required=False, default=False),  # all or nothing, in one transaction
+).compile()
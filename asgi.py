@@ -0,0 +1,5 @@
+import os
+from app.asgi import create_asgi_app
+
+config_name = os.getenv('APP_ENV')
+app = create_asgi_app(config_name)
\ No newline at end of file
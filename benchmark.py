@@ -0,0 +1,552 @@
+import os
+import sys
+import math
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlencode, urlsplit
+from prometheus_client.parser import text_string_to_metric_families
+
+FIRST_NAMES = ["alan", "grace", "ada", "linus", "margaret", "dennis", "barbara", "ken", "frances", "edsger"]
+LAST_NAMES = ["turing", "hopper", "lovelace", "torvalds", "hamilton", "ritchie", "liskov", "thompson", "allen"]
+CITIES = ["london", "leeds", "guildford", "bristol", "manchester", "york", "bath", "oxford"]
+OUTWARD_CODES = ["E1W", "LS1", "GU1", "BS1", "M1", "YO1", "BA1", "OX1"]
+INWARD_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"
+CARS = [("bmw", "530d"), ("tesla", "model 3"), ("ford", "focus"), ("audi", "a4"), ("toyota", "prius")]
+
+# Weights of operations in every mix, an operation is "<entity>/<action>"
+MIXES = {
+    "read": {"car/get": 40, "branch/get": 15, "driver/get": 15, "car/list": 10, "branch/list": 5,
+             "driver/list": 5, "car/create": 5, "car/update": 5},
+    "write": {"car/create": 25, "car/update": 25, "car/delete": 10, "driver/create": 10, "driver/update": 10,
+              "branch/create": 5, "branch/update": 5, "car/get": 10},
+    "mixed": {"car/get": 25, "branch/get": 10, "driver/get": 10, "car/list": 5, "branch/list": 2,
+              "driver/list": 3, "car/create": 15, "car/update": 10, "car/delete": 5, "driver/create": 5,
+              "driver/update": 4, "branch/create": 2, "branch/update": 2, "driver/delete": 1, "branch/delete": 1},
+}
+
+
+class TestClient(object):
+    """Sends requests to the app in this process through the Flask test client"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, url, data):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        if method in ("POST", "PUT"):
+            res = self.local.client.open(url, method=method, data=json.dumps(data), content_type='application/json')
+        else:
+            res = self.local.client.open(url, method=method, query_string=data)
+        return res.status_code, res.get_data()
+
+
+class HttpClient(object):
+    """Sends requests to a running server, one connection per thread, reconnecting when the server closes it"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.local = threading.local()
+
+    def request(self, method, url, data):
+        body = None
+        headers = {}
+        if method in ("POST", "PUT"):
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        elif data:
+            url = url + '?' + urlencode(data)
+
+        for attempt in range(2):
+            if getattr(self.local, 'connection', None) is None:
+                self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.local.connection.request(method, url, body, headers)
+                res = self.local.connection.getresponse()
+                content = res.read()
+                if res.getheader('Connection', '').lower() == 'close':
+                    self.local.connection.close()
+                    self.local.connection = None
+                return res.status, content
+            except (http.client.HTTPException, ConnectionError):
+                self.local.connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+
+def app_status(status, content):
+    """
+    Gets the status of a response, errors are sent with HTTP 200 and status_code in the body
+
+    :param status: HTTP status
+    :param content: response body
+    :return: status as a string
+    """
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return str(status)
+    if isinstance(data, dict) and isinstance(data.get('status_code'), int):
+        return str(data['status_code'])
+    return str(status)
+
+
+def postcode(rnd, outward):
+    # Postcodes are unique, a random inward code keeps new branches (mostly) from colliding with existing ones
+    return "{} {}{}".format(outward, rnd.randint(0, 9), "".join(rnd.choices(INWARD_LETTERS, k=2)))
+
+
+def numbered_postcode(number):
+    # Postcode made from a number, different numbers give different postcodes up to 8 * 10 * 400 of them
+    number, letters = divmod(number, len(INWARD_LETTERS) ** 2)
+    number, digit = divmod(number, 10)
+    first, second = divmod(letters, len(INWARD_LETTERS))
+    return "{} {}{}{}".format(OUTWARD_CODES[number % len(OUTWARD_CODES)], digit, INWARD_LETTERS[first],
+                              INWARD_LETTERS[second])
+
+
+def create(client, url, data):
+    # Sends a create the run depends on, failing with the API's message when it isn't created
+    status, body = client.request("POST", url, data)
+    response = json.loads(body)
+    if response.get("status_code") != 201:
+        raise ValueError("{} failed with {}: {}".format(url, response.get("status_code"), response.get("message")))
+
+
+class Workload(object):
+    """Builds requests for the operations of a mix, keeping track of ids that exist"""
+
+    def __init__(self, rnd):
+        self.rnd = rnd
+        self.ids = {"car": [], "branch": [], "driver": []}
+
+    def load_ids(self, client):
+        # Pages through the list endpoints to learn which records exist
+        for entity in self.ids:
+            self.ids[entity] = []
+            params = {"limit": 1000}
+            while True:
+                status, content = client.request("GET", "/{}/list".format(entity), params)
+                page = json.loads(content)
+                self.ids[entity] += [item["id"] for item in page.get("items", [])]
+                if not page.get("next"):
+                    break
+                params["after"] = page["next"]
+
+    def pick(self, entity):
+        return self.rnd.choice(self.ids[entity]) if self.ids[entity] else 1
+
+    def driver(self):
+        return dict(first_name=self.rnd.choice(FIRST_NAMES), last_name=self.rnd.choice(LAST_NAMES),
+                    dob="{:02d}/{:02d}/{}".format(self.rnd.randint(1, 28), self.rnd.randint(1, 12),
+                                                  self.rnd.randint(1950, 2000)))
+
+    def branch(self):
+        index = self.rnd.randrange(len(CITIES))
+        return dict(city=CITIES[index], postcode=postcode(self.rnd, OUTWARD_CODES[index]),
+                    capacity=self.rnd.randint(50, 500))
+
+    def car(self):
+        make, model = self.rnd.choice(CARS)
+        if self.rnd.random() < 0.5:
+            assigned_type, assigned_id = 1, self.pick("driver")
+        else:
+            assigned_type, assigned_id = 2, self.pick("branch")
+        return dict(make=make, model=model, year=self.rnd.randint(2000, 2019), assigned_type=assigned_type,
+                    assigned_id=assigned_id)
+
+    def build(self, operation):
+        """
+        Builds one request for an operation
+
+        :param operation: "<entity>/<action>"
+        :return: (method, url, data) tuple
+        """
+        entity, action = operation.split("/")
+        url = "/" + operation
+        if action == "create":
+            return "POST", url, getattr(self, entity)()
+        if action == "get":
+            return "GET", url, {"id": self.pick(entity)}
+        if action == "list":
+            return "GET", url, {"limit": 50}
+        if action == "update":
+            record = getattr(self, entity)()
+            field = self.rnd.choice([field for field in record if field not in ("assigned_type", "assigned_id")])
+            return "PUT", url, {"id": self.pick(entity), field: record[field]}
+        if action == "delete":
+            ids = self.ids[entity]
+            id = ids.pop(self.rnd.randrange(len(ids))) if ids else 1
+            return "DELETE", url, {"id": id}
+        raise ValueError("Unknown operation " + operation)
+
+    def generate(self, mix, count):
+        operations = list(MIXES[mix].keys())
+        weights = list(MIXES[mix].values())
+        return [self.build(operation) for operation in self.rnd.choices(operations, weights, k=count)]
+
+
+def seed(client, workload, scale):
+    """
+    Creates scale drivers and branches and 5 * scale cars, then loads ids of every record in the database
+
+    :param client: client to send requests with
+    :param workload: workload to fill with ids
+    :param scale: size of the data set
+    """
+    for index in range(scale):
+        client.request("POST", "/driver/create", workload.driver())
+        client.request("POST", "/branch/create", workload.branch())
+    workload.load_ids(client)
+    cars = [workload.car() for index in range(scale * 5)]
+    for start in range(0, len(cars), 500):
+        client.request("POST", "/car/bulk_create", cars[start:start + 500])
+    workload.load_ids(client)
+
+
+def read_replay(path):
+    """
+    Reads recorded requests, one JSON object per line: {"method": "GET", "url": "/car/get", "data": {"id": 1}}
+
+    :param path: path to JSONL file
+    :return: list of (method, url, data) tuples
+    """
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                requests.append((record["method"].upper(), record["url"], record.get("data") or {}))
+    return requests
+
+
+def read_sql_metrics(client):
+    """
+    Reads SQL statement counters from /metrics
+
+    :param client: client to send request with
+    :return: dict of "METHOD endpoint" => (statements, requests), None if the server has no metrics
+    """
+    status, content = client.request("GET", "/metrics", {})
+    if status != 200:
+        return None
+    counters = {}
+    for family in text_string_to_metric_families(content.decode('utf-8')):
+        if family.name != 'http_request_sql_queries':
+            continue
+        for sample in family.samples:
+            key = "{} {}".format(sample.labels.get('method'), sample.labels.get('endpoint'))
+            queries, requests = counters.get(key, (0, 0))
+            if sample.name.endswith('_sum'):
+                counters[key] = (queries + sample.value, requests)
+            elif sample.name.endswith('_count'):
+                counters[key] = (queries, requests + sample.value)
+    return counters
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of sorted values
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def run(client, requests, concurrency):
+    """
+    Sends requests from concurrency threads and times every one of them
+
+    :param client: client to send requests with
+    :param requests: list of (method, url, data) tuples
+    :param concurrency: number of threads
+    :return: list of (method, url, status, seconds) and total seconds
+    """
+    results = [None] * len(requests)
+    position = iter(range(len(requests)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                return
+            method, url, data = requests[index]
+            started = time.perf_counter()
+            status, content = client.request(method, url, data)
+            results[index] = (method, url, app_status(status, content), time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(timings, seconds):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "req_per_s": round(len(timings) / seconds, 2) if seconds else None,
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3) if timings else None,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3) if timings else None,
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3) if timings else None,
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3) if timings else None,
+    }
+
+
+def report(results, seconds, before, after):
+    """
+    Builds the JSON report: totals and, per endpoint, throughput, latency percentiles, statuses and queries per request
+
+    :param results: list of (method, url, status, seconds)
+    :param seconds: wall time of the run
+    :param before: SQL metrics before the run or None
+    :param after: SQL metrics after the run or None
+    :return: dict
+    """
+    endpoints = {}
+    for method, url, status, elapsed in results:
+        endpoint = endpoints.setdefault("{} {}".format(method, url), {"timings": [], "statuses": {}})
+        endpoint["timings"].append(elapsed)
+        endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+
+    summary = {}
+    for key in sorted(endpoints):
+        summary[key] = summarize(endpoints[key]["timings"], seconds)
+        summary[key]["statuses"] = endpoints[key]["statuses"]
+        if before is not None and after is not None:
+            queries, requests = after.get(key, (0, 0))
+            old_queries, old_requests = before.get(key, (0, 0))
+            if requests > old_requests:
+                summary[key]["queries_per_request"] = round((queries - old_queries) / (requests - old_requests), 3)
+
+    total = summarize([elapsed for method, url, status, elapsed in results], seconds)
+    total["seconds"] = round(seconds, 3)
+    return {"total": total, "endpoints": summary}
+
+
+def compare(result, baseline, threshold):
+    """
+    Flags regressions against an earlier report: throughput down, p95 or queries per request up by more than threshold
+
+    :param result: report of this run
+    :param baseline: earlier report
+    :param threshold: allowed relative change, 0.1 is 10%
+    :return: list of messages
+    """
+    regressions = []
+    pairs = [("total", result["total"], baseline["total"])]
+    pairs += [(key, value, baseline["endpoints"][key]) for key, value in result["endpoints"].items()
+              if key in baseline.get("endpoints", {})]
+    for key, new, old in pairs:
+        if old.get("req_per_s") and new["req_per_s"] < old["req_per_s"] * (1 - threshold):
+            regressions.append("{}: req/s {} -> {}".format(key, old["req_per_s"], new["req_per_s"]))
+        if old.get("p95_ms") and new["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            regressions.append("{}: p95 {}ms -> {}ms".format(key, old["p95_ms"], new["p95_ms"]))
+        if old.get("queries_per_request") and \
+                new.get("queries_per_request", 0) > old["queries_per_request"] * (1 + threshold):
+            regressions.append("{}: queries per request {} -> {}".format(key, old["queries_per_request"],
+                                                                           new["queries_per_request"]))
+    return regressions
+
+
+def contend(client, assigners, capacity):
+    """
+    Sends assigners car creates at once from as many threads, all assigned to one new branch with room for capacity
+    cars. The same number of creates assigned to a driver is sent next, to see what the contention costs
+
+    :param client: client to send requests with
+    :param assigners: number of parallel requests
+    :param capacity: capacity of the branch
+    :return: dict of outcome of the branch run (created, rejected, occupancy and cars counted after) and req/s of both
+    """
+    stamp = int(time.time() * 1000)
+    name = "contention {}".format(stamp)
+    create(client, "/branch/create", {"city": name, "postcode": numbered_postcode(stamp), "capacity": capacity})
+    branch_id = json.loads(client.request("GET", "/branch/get", {"city": name})[1])["id"]
+    create(client, "/driver/create", {"first_name": "contention", "last_name": name, "dob": "01/01/1980"})
+    driver_id = json.loads(client.request("GET", "/driver/get", {"last_name": name})[1])["id"]
+
+    result = {"assigners": assigners, "capacity": capacity}
+    for assigned_type, assigned_id, key in ((2, branch_id, "branch"), (1, driver_id, "driver")):
+        car = {"make": "contention", "model": "x", "year": 2020, "assigned_type": assigned_type,
+               "assigned_id": assigned_id}
+        results, seconds = run(client, [("POST", "/car/create", car)] * assigners, assigners)
+        statuses = [status for method, url, status, took in results]
+        result[key] = {"created": statuses.count("201"), "rejected": len(statuses) - statuses.count("201"),
+                       "req_per_s": round(len(results) / seconds, 1) if seconds else None}
+
+    branch = json.loads(client.request("GET", "/branch/get", {"id": branch_id})[1])
+    cars = json.loads(client.request("GET", "/car/list", {"assigned_type": 2, "assigned_id": branch_id,
+                                                          "limit": 1000})[1])
+    result["branch"].update(occupancy=branch["occupancy"], cars=len(cars["items"]))
+    return result
+
+
+def time_calls(function, data, iterations):
+    # Microseconds per call
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(data)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def validation_benchmark(iterations):
+    """
+    Times validating typical payloads with the compiled schemas of app/schemas.py against the per field helper calls
+    the handlers made before
+
+    :param iterations: calls per payload
+    :return: dict of payload name => microseconds per call before and after
+    """
+    from app import helpers, schemas
+    from app.helpers import ApiError
+
+    def car_create(data):
+        make = helpers.validate_string(helpers.check_missing('list', data, 'make'), 'make')
+        model = helpers.validate_string(helpers.check_missing('list', data, 'model'), 'model')
+        year = helpers.validate_year(helpers.check_missing('list', data, 'year'))
+        assigned_type = helpers.check_missing('list', data, 'assigned_type')
+        assigned_id = helpers.validate_int(helpers.check_missing('list', data, 'assigned_id'), 'assigned_id')
+        return make, model, year, assigned_type, assigned_id
+
+    def car_update(data):
+        id = helpers.validate_int(helpers.check_missing('list', data, 'id'), 'id')
+        values = {}
+        if "make" in data.keys():
+            values['make'] = helpers.validate_string(data['make'], 'make')
+        if "model" in data.keys():
+            values['model'] = helpers.validate_string(data['model'], 'model')
+        if "year" in data.keys():
+            values['year'] = helpers.validate_year(data['year'])
+        if "assigned_type" in data.keys() and not "assigned_id" in data.keys():
+            raise ApiError(400, "Missing assigned_id")
+        elif "assigned_id" in data.keys() and not "assigned_type" in data.keys():
+            raise ApiError(400, "Missing assigned_type")
+        return id, values
+
+    def driver_create(data):
+        first_name = helpers.validate_string(helpers.check_missing('list', data, 'first_name'), 'first_name')
+        middle_name = None
+        if "middle_name" in data.keys():
+            middle_name = helpers.validate_string(data['middle_name'], 'middle_name')
+        last_name = helpers.validate_string(helpers.check_missing('list', data, 'last_name'), 'last_name')
+        dob = helpers.validate_dob(helpers.check_missing('list', data, 'dob'))
+        return first_name, middle_name, last_name, dob
+
+    def car_search(args):
+        params = {}
+        if "id" in args.keys():
+            params['id'] = helpers.validate_int(args.get('id'), 'id')
+        if "make" in args.keys():
+            params['make'] = helpers.validate_string(args.get('make'), 'make')
+        if "model" in args.keys():
+            params['model'] = helpers.validate_string(args.get('model'), 'model')
+        if "year" in args.keys():
+            params['year'] = helpers.validate_year(args.get('year'))
+        if "assigned_type" in args.keys():
+            params['assigned_type'] = helpers.validate_int(args.get('assigned_type'), 'assigned_type')
+        if "assigned_id" in args.keys():
+            params['assigned_id'] = helpers.validate_int(args.get('assigned_id'), 'assigned_id')
+        return params
+
+    payloads = {
+        "car_create": (car_create, schemas.car_create,
+                       {"make": "BMW", "model": "530d", "year": 2019, "assigned_type": 1, "assigned_id": 1}),
+        "car_update": (car_update, schemas.car_update, {"id": 1, "make": "Ford", "year": 2012}),
+        "driver_create": (driver_create, schemas.driver_create,
+                          {"first_name": "Ada", "last_name": "Lovelace", "dob": "12/10/1990"}),
+        "car_search": (car_search, schemas.car_search, {"make": "bmw", "assigned_type": "1"}),
+    }
+    result = {}
+    for name, (by_hand, schema, data) in sorted(payloads.items()):
+        before = time_calls(by_hand, data, iterations)
+        after = time_calls(schema, data, iterations)
+        result[name] = {"before_us": round(before, 3), "after_us": round(after, 3),
+                        "speedup": round(before / after, 2)}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs a request mix or a recorded capture against the API and "
+                                                 "reports throughput, latency percentiles and queries per request")
+    parser.add_argument('--url', help='base URL of a running server, e.g. http://127.0.0.1:8000. '
+                                      'Without it requests go through the Flask test client using APP_ENV config')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed', help='request mix to generate')
+    parser.add_argument('--replay', help='JSONL file of recorded requests to send instead of a generated mix')
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests of a generated mix')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of threads sending requests')
+    parser.add_argument('--scale', type=int, default=100, help='drivers and branches created before the run, '
+                                                              'with 5 cars per driver. 0 to use existing data')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, same seed gives the same requests')
+    parser.add_argument('--output', help='file to write the JSON report to, printed otherwise')
+    parser.add_argument('--baseline', help='earlier JSON report to compare with, exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    parser.add_argument('--contention', type=int, metavar='ASSIGNERS',
+                        help='send this many parallel car creates to one branch and report if its capacity held '
+                             'instead of running a mix')
+    parser.add_argument('--capacity', type=int, default=10, help='capacity of the branch of --contention')
+    parser.add_argument('--validation', type=int, metavar='ITERATIONS',
+                        help='time request validation with and without the compiled schemas instead of sending '
+                             'requests')
+    args = parser.parse_args(argv)
+
+    if args.validation:
+        print(json.dumps(validation_benchmark(args.validation), indent=2, sort_keys=True))
+        return 0
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        from app import create_app, db
+        app = create_app(os.getenv('APP_ENV') or 'development')
+        with app.app_context():
+            db.create_all()
+        client = TestClient(app)
+
+    if args.contention:
+        print(json.dumps(contend(client, args.contention, args.capacity), indent=2, sort_keys=True))
+        return 0
+
+    workload = Workload(random.Random(args.seed))
+    if args.scale:
+        seed(client, workload, args.scale)
+    else:
+        workload.load_ids(client)
+    requests = read_replay(args.replay) if args.replay else workload.generate(args.mix, args.requests)
+
+    before = read_sql_metrics(client)
+    results, seconds = run(client, requests, args.concurrency)
+    after = read_sql_metrics(client)
+
+    result = report(results, seconds, before, after)
+    result["run"] = {"mode": "http" if args.url else "test_client", "mix": None if args.replay else args.mix,
+                     "replay": args.replay, "concurrency": args.concurrency, "seed": args.seed}
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import os
+import shutil
+import tempfile
+
+# Workers write their metrics to files in this directory, /metrics aggregates them. Has to be set before the app
+# (and prometheus_client) is imported, which happens in the workers after this file is read by the master
+os.environ.setdefault('prometheus_multiproc_dir', os.path.join(tempfile.gettempdir(), 'backendchallenge-metrics'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to the new ones
+    path = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,13 +1,126 @@
 import os
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
+from sqlalchemy.schema import AddConstraint, CreateIndex
 from app import db, create_app
+from app.importer import ImportCommand
 
 app = create_app(config_name=os.getenv('APP_ENV'))
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
+manager.add_command('import', ImportCommand())
+
+
+@manager.option('--fix', dest='fix', action='store_true', default=False, help='Rebuild counters that are wrong')
+def occupancy(fix):
+    """Verifies branch occupancy counters against the car table"""
+    from app.models import Branch
+
+    mismatches = Branch.check_occupancy()
+    for id, stored, actual in mismatches:
+        print("Branch {}: occupancy is {}, {} cars assigned".format(id, stored, actual))
+    if not mismatches:
+        print("All branch occupancy counters are correct")
+    elif fix:
+        print("Rebuilt {} branch counters".format(Branch.rebuild_occupancy()))
+        db.session.commit()
+
+
+@manager.option('--blocking', dest='blocking', action='store_true', default=False,
+                help='Refresh without CONCURRENTLY, faster but /branch/occupancy waits for it')
+def occupancy_view(blocking):
+    """Creates the branch_occupancy materialized view read by /branch/occupancy with OCCUPANCY_VIEW, or refreshes it"""
+    from app.models import create_occupancy_view, refresh_occupancy_view
+
+    if db.engine.dialect.name != 'postgresql':
+        print("Materialized views need PostgreSQL")
+        return
+    # Every statement commits on its own, a refresh holds its locks no longer than it takes
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        if create_occupancy_view(connection):
+            print("Created view branch_occupancy")
+        else:
+            refresh_occupancy_view(connection, concurrently=not blocking)
+            print("Refreshed view branch_occupancy")
+    finally:
+        connection.close()
+
+
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False, help='Only list missing indexes')
+def indexes(dry_run):
+    """Creates missing indexes declared on the models, on PostgreSQL without blocking writes (CONCURRENTLY)"""
+    existing = {}
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing[table.name] = set(index['name'] for index in inspector.get_indexes(table.name))
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for table in db.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name in existing[table.name]:
+                    continue
+                print("{} index {} on {}".format("Missing" if dry_run else "Creating", index.name, table.name))
+                if dry_run:
+                    continue
+                if db.engine.dialect.name == 'postgresql':
+                    # compiled rather than built from index.columns, which leaves out expressions like spaceless()
+                    connection.execute(str(CreateIndex(index).compile(dialect=connection.dialect)).replace(
+                        'INDEX', 'INDEX CONCURRENTLY IF NOT EXISTS', 1))
+                else:
+                    index.create(bind=connection)
+    finally:
+        connection.close()
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=10000, help='Cars filled in per transaction')
+@manager.option('--no-constraints', dest='constraints', action='store_false', default=True,
+                help='Only add and fill in the columns, for a first run before deploying code that writes them')
+def assignments(batch_size, constraints):
+    """Adds the driver_id and branch_id foreign keys of cars to an existing database and fills them in"""
+    from app.models import Car, orphans_statement, backfill_statement
+
+    inspector = db.inspect(db.engine)
+    columns = set(column['name'] for column in inspector.get_columns('car'))
+    # Every statement commits on its own, so a batch only locks its own cars and only for as long as it takes
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for name in ('driver_id', 'branch_id'):
+            if name not in columns:
+                print("Adding column car.{}".format(name))
+                connection.execute('ALTER TABLE car ADD COLUMN {} INTEGER'.format(name))
+
+        orphans = [id for id, in connection.execute(orphans_statement())]
+        if orphans:
+            print("Unassigned {} cars of drivers or branches that don't exist: {}".format(
+                len(orphans), ', '.join(str(id) for id in orphans[:20])))
+
+        last = connection.execute(db.select([db.func.coalesce(db.func.max(Car.id), 0)])).scalar()
+        filled = 0
+        for start in range(0, last, batch_size):
+            filled += connection.execute(backfill_statement(start, start + batch_size)).rowcount
+        print("Filled in driver_id and branch_id of {} cars".format(filled))
+
+        if not constraints:
+            return
+        # Added without checking existing rows, then checked without blocking writes to the table
+        existing = set(name for name, in connection.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = 'car'::regclass"))
+        for constraint in sorted(Car.__table__.constraints, key=lambda constraint: str(constraint.name)):
+            if not isinstance(constraint, (db.ForeignKeyConstraint, db.CheckConstraint)) or \
+                    constraint.name in existing:
+                continue
+            print("Adding constraint {}".format(constraint.name))
+            connection.execute('{} NOT VALID'.format(AddConstraint(constraint).compile(dialect=connection.dialect)))
+            connection.execute('ALTER TABLE car VALIDATE CONSTRAINT {}'.format(constraint.name))
+    finally:
+        connection.close()
+    indexes(dry_run=False)
+
 
 if __name__ == '__main__':
     manager.run()
@@ -1,7 +1,93 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
+import contextlib
 from app import create_app, db
+from instance.config import TestingConfig
 from flask import json
 import app.helpers as helpers
+import app.importer as importer
+import app.schemas as schemas
+import benchmark
+from app.cache import cache, ModelCache
+from app.models import Car, Branch, Driver, bakery, search_query, drop_occupancy_view
+from app.pool import InstrumentedQueuePool
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql
+from prometheus_client import REGISTRY
+
+API_MODE = os.getenv('API_MODE', 'wsgi')  # asgi runs the API tests against the app of asgi.py
+
+
+def skip_asgi(reason):
+    # Skips a test that can't run against the ASGI app, saying why
+    return unittest.skipIf(API_MODE == 'asgi', reason)
+
+
+class AsgiResponse(object):
+    """Response of AsgiClient with the attributes of Flask's test response used by the tests"""
+
+    def __init__(self, res):
+        self.res = res
+        self.status_code = res.status_code
+        self.headers = res.headers
+        self.content_type = res.headers.get('content-type', '')
+        self.mimetype = self.content_type.split(';')[0].strip()
+
+    def get_json(self):
+        return self.res.json() if self.mimetype == 'application/json' else None
+
+    def get_data(self, as_text=False):
+        return self.res.text if as_text else self.res.content
+
+
+class AsgiClient(object):
+    """Client for the ASGI app with the interface of Flask's test client, so the same tests run in both modes"""
+
+    def __init__(self, app):
+        from starlette.testclient import TestClient
+        self.client = TestClient(app)
+        self.client.__enter__()  # runs startup, connecting the database
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+    def open(self, url, method, data=None, content_type=None, query_string=None, headers=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        return AsgiResponse(self.client.request(method, url, data=data, params=query_string, headers=headers))
+
+    def get(self, url, **kwargs):
+        return self.open(url, 'GET', **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open(url, 'POST', **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.open(url, 'PUT', **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open(url, 'DELETE', **kwargs)
+
+
+def make_client(test):
+    """
+    Client for the app of a test case: Flask's test client, or with API_MODE=asgi a client of the ASGI app built from
+    the same config
+
+    :param test: test case with app set up
+    :return: client
+    """
+    if API_MODE != 'asgi':
+        return test.app.test_client()
+    from app.asgi import create_asgi_app
+    client = AsgiClient(create_asgi_app("testing"))
+    test.addCleanup(client.close)
+    return client
+
 
 def api_call(self, method, url, data, status_code, return_jason=False):
     """
@@ -32,11 +118,45 @@ def api_call(self, method, url, data, status_code, return_jason=False):
         return res.get_json()
 
 
+class QueryCounter(contextlib.ContextDecorator):
+    """
+    Records SQL statements sent to the database while active, usable as a context manager or a decorator
+
+    :param budget: most statements allowed, exceeding it fails with the statements listed. None only counts them
+    :param label: what is being counted, shown in the failure message
+    """
+
+    def __init__(self, budget=None, label="block"):
+        self.budget = budget
+        self.label = label
+        self.statements = []
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(Engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(Engine, 'before_cursor_execute', self.record)
+        if exc_type is None and self.budget is not None and len(self.statements) > self.budget:
+            raise AssertionError("{} issued {} SQL statements, budget is {}:\n{}".format(
+                self.label, len(self.statements), self.budget,
+                "\n".join("{}. {}".format(index + 1, statement) for index, statement in enumerate(self.statements))))
+        return False
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
 class CarTestCase(unittest.TestCase):
     def setUp(self):
         # sets up clean app with testing config
         self.app = create_app(config_name="testing")
-        self.client = self.app.test_client()
+        self.client = make_client(self)
 
         # set up test db
         with self.app.app_context():
@@ -115,6 +235,63 @@ class CarTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 400)
         self.assertEqual(json_response["message"], 'Missing assigned_type')
 
+    def test_can_bulk_create_cars(self):
+        """ Test that API can create many cars at once and reports rows that failed"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W3SS", capacity=2), 200)
+
+        cars = [dict(make="Tesla", model="Model 3", year=2018, assigned_type=1, assigned_id=1),
+                dict(make="BMW", model="530d", year=2018, assigned_type=2, assigned_id=1),
+                dict(make="BMW", model="M3", year="twenty", assigned_type=2, assigned_id=1),
+                dict(make="Ford", model="Focus", year=2010, assigned_type=1, assigned_id=20),
+                dict(make="Ford", model="Fiesta", year=2011, assigned_type=2, assigned_id=1),
+                dict(make="Audi", model="A4", year=2012, assigned_type=2, assigned_id=1)]
+        json_response = api_call(self, "POST", "/car/bulk_create", cars, 200, True)
+        self.assertEqual(json_response["status_code"], 201)
+        self.assertEqual(json_response["created"], 3)
+        self.assertEqual(json_response["errors"], [
+            {"index": 2, "status_code": 400, "message": "Invalid year"},
+            {"index": 3, "status_code": 404, "message": "Driver not found"},
+            {"index": 5, "status_code": 400, "message": "Branch has reached its capacity"}])
+
+        json_response = api_call(self, "GET", '/car/get', dict(model="fiesta"), 200, True)
+        self.assertEqual(json_response['assigned_type'], 2)
+        self.assertEqual(json_response['assigned_id'], 1)
+
+    def test_can_bulk_create_cars_ndjson(self):
+        """ Test that bulk create accepts newline delimited json"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        body = '\n'.join(json.dumps(dict(make="Tesla", model="Model " + str(i), year=2018, assigned_type=1,
+                                         assigned_id=1)) for i in range(10))
+        res = self.client.post('/car/bulk_create', data=body, content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 200)
+        json_response = res.get_json()
+        self.assertEqual(json_response["status_code"], 201)
+        self.assertEqual(json_response["created"], 10)
+        self.assertEqual(json_response["errors"], [])
+
+    def test_cant_bulk_create_cars_invalid_request(self):
+        """ Test that bulk create rejects empty or malformed bodies"""
+        json_response = api_call(self, "POST", "/car/bulk_create", [], 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "Invalid request")
+
+        json_response = api_call(self, "POST", "/car/bulk_create", dict(make="Tesla"), 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "Invalid request")
+
+        res = self.client.post('/car/bulk_create', data='{"make": "Tesla"\nnot json',
+                               content_type='application/x-ndjson')
+        self.assertEqual(res.get_json()["message"], "Invalid request")
+
+        json_response = api_call(self, "POST", "/car/bulk_create", [dict(make="Tesla")], 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "No cars created")
+        self.assertEqual(json_response["errors"], [{"index": 0, "status_code": 400, "message": "Missing model"}])
+
+        res = self.client.get('/car/bulk_create')
+        self.assertEqual(res.status_code, 405)
+
     def test_can_get_car(self):
         """ Test that API can retrieve a car"""
         api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200,
@@ -140,10 +317,134 @@ class CarTestCase(unittest.TestCase):
         self.assertEqual(json_response['assigned_type'], 2)
         self.assertEqual(json_response['assigned_id'], 1)
 
+    def test_can_transfer_cars(self):
+        """ Test that API can move cars by ids or filter in one go and keeps branch counters right"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=3), 200)
+        api_call(self, "POST", "/branch/create", dict(city="Leeds", postcode="LS1 4DY", capacity=10), 200)
+        for assigned_type, assigned_id in ((2, 2), (2, 2), (2, 2), (1, 1)):
+            api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=assigned_type,
+                                                       assigned_id=assigned_id), 200)
+
+        json_response = api_call(self, "PUT", '/car/transfer', dict(ids=[1, 2], assigned_type=2, assigned_id=1), 200,
+                                 True)
+        self.assertEqual(json_response, {"status_code": 200, "message": "Cars transferred", "moved": 2})
+        json_response = api_call(self, "PUT", '/car/transfer', dict(ids="1,3", assigned_type=2, assigned_id=1), 200,
+                                 True)
+        self.assertEqual(json_response["moved"], 1)  # car 1 is already there
+        json_response = api_call(self, "GET", '/car/get', dict(ids="1,2,3,4"), 200, True)
+        self.assertEqual([(car["assigned_type"], car["assigned_id"]) for car in json_response["items"]],
+                         [(2, 1), (2, 1), (2, 1), (1, 1)])
+
+        json_response = api_call(self, "PUT", '/car/transfer', dict(filter=dict(assigned_type=2, assigned_id=1),
+                                                                   assigned_type=2, assigned_id=2), 200, True)
+        self.assertEqual(json_response["moved"], 3)
+        json_response = api_call(self, "GET", '/branch/get', dict(ids="1,2"), 200, True)
+        self.assertEqual([branch["occupancy"] for branch in json_response["items"]], [0, 3])
+
+        # nothing moves when the target doesn't have room for all of the cars
+        json_response = api_call(self, "PUT", '/car/transfer', dict(ids=[1, 2, 3, 4], assigned_type=2, assigned_id=1),
+                                 200, True)
+        self.assertEqual(json_response, {"status_code": 400, "message": "Branch has reached its capacity"})
+        json_response = api_call(self, "GET", '/branch/get', dict(ids="1,2"), 200, True)
+        self.assertEqual([branch["occupancy"] for branch in json_response["items"]], [0, 3])
+
+    def test_cant_transfer_cars_invalid_request(self):
+        """ Test that transfer validates the target and how cars are picked"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        cases = [
+            (dict(ids=[1]), "Missing assigned_type"),
+            (dict(assigned_type=1, assigned_id=1), "Missing ids"),
+            (dict(ids="x", assigned_type=1, assigned_id=1), "Invalid ids"),
+            (dict(filter={}, assigned_type=1, assigned_id=1), "Invalid filter"),
+            (dict(filter=dict(year="twenty"), assigned_type=1, assigned_id=1), "Invalid year"),
+            (dict(ids=[1], assigned_type=3, assigned_id=1), "Invalid assigned_type"),
+            (dict(ids=[1], assigned_type=2, assigned_id=1), "Branch not found"),
+        ]
+        for data, message in cases:
+            with self.subTest(message=message):
+                json_response = api_call(self, "PUT", '/car/transfer', data, 200, True)
+                self.assertEqual(json_response["message"], message)
+
+        res = self.client.get('/car/transfer')
+        self.assertEqual(res.status_code, 405)
+
+    def test_transfer_statements_dont_grow_with_cars(self):
+        """ Test that moving a couple of thousand cars takes the same statements as moving one"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=2000), 200)
+        with self.app.app_context():
+            Car.bulk_insert([dict(make="ford", model="ka", year=2012, assigned_type=1, assigned_id=1,
+                                  version=1)] * 2000)
+            db.session.commit()
+
+        with QueryCounter(3, "transfer"):
+            json_response = api_call(self, "PUT", '/car/transfer', dict(filter=dict(make="Ford"), assigned_type=2,
+                                                                       assigned_id=1), 200, True)
+        self.assertEqual(json_response["moved"], 2000)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 2000)
+
+    def test_can_get_car_with_assignee(self):
+        """ Test that expand=assignee embeds the car's driver or branch, fetched in the same query"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/car/create', dict(make="Tesla", model="Model 3", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+
+        with QueryCounter(1, "get with assignee"):
+            json_response = api_call(self, "GET", '/car/get', dict(id=1, expand="assignee"), 200, True)
+        self.assertEqual(json_response["make"], "tesla")
+        self.assertEqual(json_response["assignee"], api_call(self, "GET", '/driver/get', dict(id=1), 200, True))
+
+        json_response = api_call(self, "GET", '/car/get', dict(make="BMW", expand="assignee"), 200, True)
+        self.assertEqual(json_response["id"], 2)
+        self.assertEqual(json_response["assignee"], api_call(self, "GET", '/branch/get', dict(id=1), 200, True))
+        self.assertNotIn("assignee", api_call(self, "GET", '/car/get', dict(id=2), 200, True))
+
+        # deleting the branch leaves its cars unassigned
+        api_call(self, "DELETE", '/branch/delete', dict(id=1), 200)
+        self.assertIsNone(api_call(self, "GET", '/car/get', dict(id=2, expand="assignee"), 200, True)["assignee"])
+
+        json_response = api_call(self, "GET", '/car/get', dict(id=3, expand="assignee"), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (404, "Car not found"))
+
+        json_response = api_call(self, "GET", '/car/get', dict(id=1, expand="driver"), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Invalid expand"))
+
+        json_response = api_call(self, "GET", '/car/get', dict(expand="assignee"), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Invalid request"))
+
+    def test_can_get_cars_by_ids(self):
+        """ Test that API can retrieve several cars by id in request order, reporting the missing ones"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        for make in ("BMW", "Tesla", "Ford"):
+            api_call(self, "POST", '/car/create', dict(make=make, model="x", year=2018, assigned_type=1,
+                                                       assigned_id=1), 200)
+
+        json_response = api_call(self, "GET", '/car/get', dict(ids="3,99,1,3"), 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        self.assertEqual([car["make"] for car in json_response["items"]], ["ford", "bmw"])
+        self.assertEqual(json_response["missing"], [99])
+
+        json_response = api_call(self, "POST", '/car/get', dict(ids=[2, 1]), 200, True)
+        self.assertEqual([car["id"] for car in json_response["items"]], [2, 1])
+        self.assertEqual(json_response["missing"], [])
+
+        json_response = api_call(self, "POST", '/car/get', dict(ids="2,x"), 200, True)
+        self.assertEqual(json_response, {"status_code": 400, "message": "Invalid ids"})
+        json_response = api_call(self, "GET", '/car/get', dict(ids=""), 200, True)
+        self.assertEqual(json_response, {"status_code": 400, "message": "Invalid ids"})
+        json_response = api_call(self, "POST", '/car/get', dict(ids=list(range(1001))), 200, True)
+        self.assertEqual(json_response, {"status_code": 400, "message": "Invalid ids"})
+
     def test_cant_get_car_invalid_request(self):
         """ Test that endpoint can deal with missing query string"""
+        # POST is the long form of ids=1,2,3
         res = self.client.post('/car/get')
-        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {"status_code": 400, "message": "Missing ids"})
 
         res = self.client.delete('/car/get')
         self.assertEqual(res.status_code, 405)
@@ -203,6 +504,110 @@ class CarTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 400)
         self.assertEqual(json_response["message"], 'Invalid assigned_id')
 
+    def test_assignment_is_mirrored_in_foreign_keys(self):
+        """ Test that every write keeps driver_id and branch_id in line with the assignment"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/car/create', dict(make="Tesla", model="Model 3", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+        api_call(self, "POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2010, assigned_type=2,
+                                                         assigned_id=1)] * 2, 200)
+
+        def assignments():
+            with self.app.app_context():
+                return db.session.query(Car.id, Car.driver_id, Car.branch_id).order_by(Car.id).all()
+
+        self.assertEqual(assignments(), [(1, 1, None), (2, None, 1), (3, None, 1)])
+        api_call(self, "PUT", '/car/update', dict(id=1, assigned_type=2, assigned_id=1), 200)
+        api_call(self, "PUT", '/car/transfer', dict(ids=[2], assigned_type=1, assigned_id=1), 200)
+        self.assertEqual(assignments(), [(1, None, 1), (2, 1, None), (3, None, 1)])
+
+        with self.app.app_context():
+            with self.assertRaises(exc.IntegrityError):
+                db.session.execute("UPDATE car SET assigned_id = 2 WHERE id = 2")
+            db.session.rollback()
+            with self.assertRaises(exc.IntegrityError):
+                db.session.execute("UPDATE car SET driver_id = 7, assigned_id = 7 WHERE id = 2")
+            db.session.rollback()
+
+    def test_can_fill_in_foreign_keys_of_existing_cars(self):
+        """ Test that the statements of manage.py assignments fill in cars written before driver_id and branch_id"""
+        from app.models import orphans_statement, backfill_statement
+        from sqlalchemy.schema import AddConstraint
+
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        with self.app.app_context():
+            db.session.execute("ALTER TABLE car DROP CONSTRAINT ck_car_assignment")
+            db.session.execute("ALTER TABLE car DROP CONSTRAINT fk_car_driver_id")
+            db.session.execute("INSERT INTO car (make, model, year, assigned_type, assigned_id) VALUES "
+                               "('ford', 'ka', 2012, 1, 1), ('ford', 'ka', 2012, 2, 1), ('ford', 'ka', 2012, 1, 9), "
+                               "('ford', 'ka', 2012, NULL, NULL), ('ford', 'ka', 2012, 2, NULL)")
+            self.assertEqual([id for id, in db.session.execute(orphans_statement())], [3, 5])
+            self.assertEqual(db.session.execute(backfill_statement(0, 3)).rowcount, 2)
+            self.assertEqual(db.session.execute(backfill_statement(3, 6)).rowcount, 0)
+            self.assertEqual(db.session.query(Car.driver_id, Car.branch_id, Car.assigned_type).order_by(Car.id).all(),
+                             [(1, None, 1), (None, 1, 2), (None, None, None), (None, None, None), (None, None, None)])
+            for constraint in Car.__table__.constraints:
+                if constraint.name in ("ck_car_assignment", "fk_car_driver_id"):
+                    db.session.execute(AddConstraint(constraint))
+            db.session.commit()
+
+    def test_can_list_cars(self):
+        """ Test that API can page through cars matching filters"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        for year in range(2000, 2012):
+            api_call(self, "POST", '/car/create', dict(make="Ford" if year % 2 else "BMW", model="Focus", year=year,
+                                                       assigned_type=1, assigned_id=1), 200)
+
+        json_response = api_call(self, "GET", '/car/list', dict(make="ford", limit=4), 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        self.assertEqual([car["year"] for car in json_response["items"]], [2001, 2003, 2005, 2007])
+        self.assertIsNotNone(json_response["next"])
+
+        json_response = api_call(self, "GET", '/car/list', dict(make="ford", limit=4, after=json_response["next"]),
+                                 200, True)
+        self.assertEqual([car["year"] for car in json_response["items"]], [2009, 2011])
+        self.assertIsNone(json_response["next"])
+
+        json_response = api_call(self, "GET", '/car/list', dict(), 200, True)
+        self.assertEqual(len(json_response["items"]), 12)
+
+    def test_cant_list_cars_invalid_params(self):
+        """ Test that list endpoint validates filters, limit and cursor"""
+        json_response = api_call(self, "GET", '/car/list', dict(limit=0), 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "Invalid limit")
+
+        json_response = api_call(self, "GET", '/car/list', dict(limit="many"), 200, True)
+        self.assertEqual(json_response["message"], "Invalid limit")
+
+        json_response = api_call(self, "GET", '/car/list', dict(after="not a cursor"), 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "Invalid after")
+
+        json_response = api_call(self, "GET", '/car/list', dict(year="twenty"), 200, True)
+        self.assertEqual(json_response["message"], "Invalid year")
+
+        res = self.client.post('/car/list')
+        self.assertEqual(res.status_code, 405)
+
+    def test_can_export_cars(self):
+        """ Test that API can stream every car as NDJSON"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2000 + i, assigned_type=1,
+                                                         assigned_id=1) for i in range(25)], 200)
+
+        res = self.client.get('/car/export')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        cars = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+        self.assertEqual([car["year"] for car in cars], list(range(2000, 2025)))
+        self.assertEqual(cars[0], api_call(self, "GET", '/car/get', dict(id=1), 200, True))
+
+        res = self.client.post('/car/export')
+        self.assertEqual(res.status_code, 405)
+
     def test_can_update_car(self):
         """ Test for updating car details and successfuly retrieving it"""
         api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200,
@@ -295,7 +700,7 @@ class CarTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 404)
         self.assertEqual(json_response["message"], "Driver not found")
 
-        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W3SS", capacity=1), 200, True)
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="SW1A 1AA", capacity=1), 200, True)
         api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2, assigned_id=2),
                  200)
         json_response = api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
@@ -317,6 +722,29 @@ class CarTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 404)
         self.assertEqual(json_response["message"], "Car not found")
 
+    def test_update_validates_before_lookup(self):
+        """ Test update checks parameters before the record, and only updates that change something move the version
+        on"""
+        json_response = api_call(self, "PUT", '/car/update', dict(id=257, year="C45 AMG"), 200, True)
+        self.assertEqual(json_response["status_code"], 400)
+        self.assertEqual(json_response["message"], "Invalid year")
+
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+        api_call(self, "PUT", '/car/update', dict(id=1, year=2019), 200)
+        res = self.client.get('/car/get', query_string=dict(id=1))
+        etag = res.headers["ETag"]
+        self.assertEqual((res.get_json()["year"], res.get_json()["version"]), (2019, 2))
+
+        # nothing to update, the record is only looked up and its version and ETag stay
+        json_response = api_call(self, "PUT", '/car/update', dict(id=1), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (200, "Car record was updated"))
+        res = self.client.get('/car/get', query_string=dict(id=1), headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        json_response = api_call(self, "PUT", '/car/update', dict(id=2), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (404, "Car not found"))
+
     def test_cant_delete_car_invalid_id(self):
         """ Test we cant delete car with invalid ID """
         json_response = api_call(self, "DELETE", '/car/delete', dict(id=102030), 200, True)
@@ -353,7 +781,7 @@ class BranchTestCase(unittest.TestCase):
     def setUp(self):
         # sets up clean app with testing config
         self.app = create_app(config_name="testing")
-        self.client = self.app.test_client()
+        self.client = make_client(self)
 
         # set up test db
         with self.app.app_context():
@@ -444,10 +872,22 @@ class BranchTestCase(unittest.TestCase):
         self.assertEqual(json_response['postcode'], 'gu11ea')
         self.assertEqual(json_response['capacity'], 10)
 
+    def test_can_get_branches_by_ids(self):
+        """ Test that API can retrieve several branches by id, including ones already cached"""
+        api_call(self, "POST", "/branch/create", dict(city="London", postcode="E1W 3SS", capacity=10), 200)
+        api_call(self, "POST", "/branch/create", dict(city="Leeds", postcode="LS1 4DY", capacity=10), 200)
+        api_call(self, "GET", '/branch/get', dict(id=2), 200)
+
+        json_response = api_call(self, "GET", '/branch/get', dict(ids="2,1"), 200, True)
+        self.assertEqual([branch["city"] for branch in json_response["items"]], ["leeds", "london"])
+        self.assertEqual(json_response["missing"], [])
+
     def test_cant_get_branch_invalid_request(self):
         """ Test that endpoint can deal with missing query string"""
+        # POST is the long form of ids=1,2,3
         res = self.client.post('/branch/get')
-        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {"status_code": 400, "message": "Missing ids"})
 
         res = self.client.delete('/branch/get')
         self.assertEqual(res.status_code, 405)
@@ -483,6 +923,151 @@ class BranchTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 400)
         self.assertEqual(json_response["message"], "Invalid id")
 
+    def test_can_list_branches(self):
+        """ Test that API can list branches by city and postcode"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=10), 200)
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="SW15 1RB", capacity=15), 200)
+
+        json_response = api_call(self, "GET", '/branch/list', dict(city="London"), 200, True)
+        self.assertEqual([branch["id"] for branch in json_response["items"]], [1, 3])
+        self.assertIsNone(json_response["next"])
+
+        json_response = api_call(self, "GET", '/branch/list', dict(postcode="GU11EA"), 200, True)
+        self.assertEqual([branch["city"] for branch in json_response["items"]], ["guildford"])
+
+        json_response = api_call(self, "GET", '/branch/get', dict(postcode="SW15 1RB"), 200, True)
+        self.assertEqual(json_response["id"], 3)
+
+    def test_can_export_branches(self):
+        """ Test that API can stream every branch as NDJSON"""
+        res = self.client.get('/branch/export')
+        self.assertEqual(res.get_data(as_text=True), '')
+
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=10), 200)
+
+        res = self.client.get('/branch/export')
+        branches = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+        self.assertEqual(branches, [api_call(self, "GET", '/branch/get', dict(id=1), 200, True),
+                                    api_call(self, "GET", '/branch/get', dict(id=2), 200, True)])
+
+    def test_branch_occupancy_follows_cars(self):
+        """ Test that branch occupancy counter is kept up to date by every car write"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=2), 200)
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+
+        def occupancy(id):
+            return api_call(self, "GET", '/branch/get', dict(id=id), 200, True)["occupancy"]
+
+        self.assertEqual(occupancy(1), 0)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        api_call(self, "POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2010, assigned_type=2,
+                                                         assigned_id=1)] * 2, 200)
+        self.assertEqual(occupancy(1), 3)
+
+        # Reassigning moves the car between counters, other updates don't touch them
+        api_call(self, "PUT", '/car/update', dict(id=1, assigned_type=2, assigned_id=2), 200)
+        api_call(self, "PUT", '/car/update', dict(id=1, year=2019), 200)
+        self.assertEqual((occupancy(1), occupancy(2)), (2, 1))
+        api_call(self, "PUT", '/car/update', dict(id=2, assigned_type=1, assigned_id=1), 200)
+        self.assertEqual(occupancy(1), 1)
+
+        api_call(self, "DELETE", '/car/delete', dict(id=1), 200)
+        self.assertEqual(occupancy(2), 0)
+
+        with self.app.app_context():
+            self.assertEqual(Branch.check_occupancy(), [])
+
+    def test_can_rebuild_branch_occupancy(self):
+        """ Test that wrong occupancy counters are found and rebuilt"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=2), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+
+        with self.app.app_context():
+            db.session.execute("UPDATE branch SET occupancy = 4")
+            self.assertEqual(Branch.check_occupancy(), [(1, 4, 1), (2, 4, 0)])
+            self.assertEqual(Branch.rebuild_occupancy(), 2)
+            db.session.commit()
+            self.assertEqual(Branch.check_occupancy(), [])
+
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 1)
+
+    def test_can_get_branch_occupancy_report(self):
+        """ Test that the occupancy report counts cars of every branch in one query, optionally of one city"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=2), 200)
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="SW1A 1AA", capacity=3), 200)
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2010, assigned_type=2,
+                                                         assigned_id=1)] * 3, 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=2), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                   assigned_id=2), 200)
+
+        with QueryCounter(1, "occupancy report"):
+            json_response = api_call(self, "GET", '/branch/occupancy', None, 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        self.assertEqual([(item["id"], item["capacity"], item["occupancy"], item["free"])
+                          for item in json_response["items"]], [(1, 5, 3, 2), (2, 2, 1, 1), (3, 3, 0, 3)])
+        self.assertEqual((json_response["capacity"], json_response["occupancy"], json_response["free"]), (10, 4, 6))
+
+        json_response = api_call(self, "GET", '/branch/occupancy', dict(city="London"), 200, True)
+        self.assertEqual([item["id"] for item in json_response["items"]], [1, 3])
+        self.assertEqual(json_response["items"][0], dict(id=1, city="london", postcode="e1w 3ss", capacity=5,
+                                                         occupancy=3, free=2))
+        self.assertEqual(json_response["free"], 5)
+
+        json_response = api_call(self, "GET", '/branch/occupancy', dict(city="Paris"), 200, True)
+        self.assertEqual((json_response["items"], json_response["capacity"]), ([], 0))
+
+        res = self.client.post('/branch/occupancy')
+        self.assertEqual(res.status_code, 405)
+
+    def test_can_read_branch_occupancy_from_view(self):
+        """ Test that the occupancy report can be read from the materialized view, as of its last refresh"""
+        from app.models import create_occupancy_view, refresh_occupancy_view
+
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        with self.app.app_context():
+            self.assertTrue(create_occupancy_view(db.engine))
+            self.assertFalse(create_occupancy_view(db.engine))
+            self.assertEqual(Branch.occupancy_report(from_view=True), Branch.occupancy_report())
+
+            api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                       assigned_id=1), 200)
+            self.assertEqual(Branch.occupancy_report(from_view=True)[0].occupancy, 1)
+            refresh_occupancy_view(db.engine)
+            self.assertEqual(Branch.occupancy_report(from_view=True)[0].occupancy, 2)
+            self.assertEqual(Branch.occupancy_report("london", from_view=True), Branch.occupancy_report("london"))
+            db.session.remove()
+
+    def test_branch_occupancy_endpoint_reads_view_when_enabled(self):
+        """ Test that /branch/occupancy reads the view with OCCUPANCY_VIEW set"""
+        from app.models import create_occupancy_view
+
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        with self.app.app_context():
+            create_occupancy_view(db.engine)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+
+        self.app.config['OCCUPANCY_VIEW'] = True
+        if API_MODE == 'asgi':  # the ASGI app reads the config of its own Flask app
+            self.client.client.app.state.flask_app.config['OCCUPANCY_VIEW'] = True
+        with QueryCounter() as queries:
+            json_response = api_call(self, "GET", '/branch/occupancy', None, 200, True)
+        self.assertEqual(json_response["occupancy"], 0)  # not refreshed since the car was added
+        if API_MODE != 'asgi':  # QueryCounter only sees statements of SQLAlchemy engines, not of asyncpg
+            self.assertIn("FROM branch_occupancy", queries.statements[0])
+
     def test_can_update_branch(self):
         """ Test for updating branch details"""
         api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
@@ -569,6 +1154,67 @@ class BranchTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 400)
         self.assertEqual(json_response["message"], "Invalid capacity")
 
+    def test_can_upsert_branches(self):
+        """ Test that upsert inserts new branches, updates changed ones and leaves the others alone"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Leeds", postcode="LS1 4DY", capacity=2), 200)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["capacity"], 5)  # cached
+
+        branches = [dict(city="London", postcode="E1W 3SS", capacity=10),
+                    dict(city="Leeds", postcode="LS1 4DY", capacity=2),
+                    dict(city="Guildford", postcode="GU2 8DJ", capacity=3),
+                    dict(city="Bath", postcode="nope", capacity=3),
+                    dict(city="Guildford", postcode="GU2 8DJ", capacity=4)]
+        json_response = api_call(self, "PUT", '/branch/upsert', branches, 200, True)
+        self.assertEqual(json_response, dict(status_code=200, message="Branches upserted", inserted=1, updated=1,
+                                             unchanged=1, errors=[
+                                                 dict(index=3, status_code=400, message="Invalid postcode"),
+                                                 dict(index=4, status_code=400, message="Duplicate record")]))
+
+        json_response = api_call(self, "GET", '/branch/get', dict(id=1), 200, True)
+        self.assertEqual((json_response["capacity"], json_response["version"]), (10, 2))
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=2), 200, True)["version"], 1)
+        json_response = api_call(self, "GET", '/branch/get', dict(postcode="GU2 8DJ"), 200, True)
+        self.assertEqual((json_response["city"], json_response["capacity"], json_response["occupancy"]),
+                         ("guildford", 3, 0))
+
+        # resending the same list changes nothing
+        json_response = api_call(self, "PUT", '/branch/upsert', branches[:3], 200, True)
+        self.assertEqual((json_response["inserted"], json_response["updated"], json_response["unchanged"]), (0, 0, 3))
+
+        # postcodes spaced differently are the same branch, which keeps the postcode it was saved with
+        json_response = api_call(self, "PUT", '/branch/upsert', [dict(city="London", postcode="E1W3SS", capacity=10),
+                                                                 dict(city="Leeds", postcode="LS14DY", capacity=4)],
+                                 200, True)
+        self.assertEqual((json_response["inserted"], json_response["updated"], json_response["unchanged"]), (0, 1, 1))
+        json_response = api_call(self, "GET", '/branch/get', dict(id=2), 200, True)
+        self.assertEqual((json_response["postcode"], json_response["capacity"]), ("ls1 4dy", 4))
+        json_response = api_call(self, "PUT", '/branch/upsert', [dict(city="London", postcode="E1W3SS", capacity=1),
+                                                                 dict(city="London", postcode="E1W 3SS", capacity=2)],
+                                 200, True)
+        self.assertEqual(json_response["errors"], [dict(index=1, status_code=400, message="Duplicate record")])
+
+    def test_cant_upsert_branches_invalid_request(self):
+        """ Test that upsert rejects empty bodies and that postcodes stay unique however they are spaced"""
+        json_response = api_call(self, "PUT", '/branch/upsert', [], 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Invalid request"))
+
+        json_response = api_call(self, "PUT", '/branch/upsert', [dict(city="London")], 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "No branches upserted"))
+        self.assertEqual(json_response["errors"], [dict(index=0, status_code=400, message="Missing postcode")])
+
+        res = self.client.post('/branch/upsert')
+        self.assertEqual(res.status_code, 405)
+
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Leeds", postcode="LS1 4DY", capacity=2), 200)
+        json_response = api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W3SS", capacity=5),
+                                 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Branch already exists"))
+        json_response = api_call(self, "PUT", '/branch/update', dict(id=2, postcode="E1W 3SS"), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Branch already exists"))
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=2), 200, True)["postcode"], "ls1 4dy")
+
     def test_can_delete_branch(self):
         """ Test can delete branch """
         api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
@@ -581,6 +1227,45 @@ class BranchTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 404)
         self.assertEqual(json_response["message"], "Branch not found")
 
+    def test_deleting_branch_unassigns_its_cars(self):
+        """ Test that cars of a deleted branch are left unassigned instead of pointing at nothing"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        version = api_call(self, "GET", '/car/get', dict(id=1), 200, True)["version"]
+
+        api_call(self, "DELETE", '/branch/delete', dict(id=1), 200)
+        json_response = api_call(self, "GET", '/car/get', dict(id=1), 200, True)
+        self.assertEqual((json_response["assigned_type"], json_response["assigned_id"]), (None, None))
+        self.assertEqual(json_response["version"], version + 1)
+
+    def test_can_list_branch_cars(self):
+        """ Test that API can page through the cars of a branch"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Guildford", postcode="GU11EA", capacity=5), 200)
+        for year, branch in [(2010, 1), (2011, 2), (2012, 1), (2013, 1)]:
+            api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=year, assigned_type=2,
+                                                       assigned_id=branch), 200)
+
+        json_response = api_call(self, "GET", '/branch/cars', dict(id=1, limit=2), 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        self.assertEqual([car["year"] for car in json_response["items"]], [2010, 2012])
+        json_response = api_call(self, "GET", '/branch/cars', dict(id=1, limit=2, after=json_response["next"]), 200,
+                                 True)
+        self.assertEqual([car["year"] for car in json_response["items"]], [2013])
+        self.assertIsNone(json_response["next"])
+        self.assertEqual(json_response["items"][0], api_call(self, "GET", '/car/get', dict(id=4), 200, True))
+
+        api_call(self, "POST", '/branch/create', dict(city="Leeds", postcode="LS1 4DY", capacity=5), 200)
+        self.assertEqual(api_call(self, "GET", '/branch/cars', dict(id=3), 200, True)["items"], [])
+
+        json_response = api_call(self, "GET", '/branch/cars', dict(id=99), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (404, "Branch not found"))
+        json_response = api_call(self, "GET", '/branch/cars', dict(), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Missing id"))
+        json_response = api_call(self, "GET", '/branch/cars', dict(id=1, limit=0), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Invalid limit"))
+
     def test_cant_delete_branch_invalid_id(self):
         """ Test we cant delete branch with invalid ID """
         json_response = api_call(self, "DELETE", '/branch/delete', dict(id=102030), 200, True)
@@ -610,6 +1295,7 @@ class BranchTestCase(unittest.TestCase):
         with self.app.app_context():
             # drop all tables
             db.session.remove()
+            drop_occupancy_view(db.engine)  # depends on the tables
             db.drop_all()
 
 
@@ -617,7 +1303,7 @@ class DriverTestCase(unittest.TestCase):
     def setUp(self):
         # sets up clean app with testing config
         self.app = create_app(config_name="testing")
-        self.client = self.app.test_client()
+        self.client = make_client(self)
 
         # set up test db
         with self.app.app_context():
@@ -690,10 +1376,20 @@ class DriverTestCase(unittest.TestCase):
         self.assertEqual(json_response['middle_name'], 'john')
         self.assertEqual(json_response['dob'], '11/05/1950')
 
+    def test_can_get_drivers_by_ids(self):
+        """ Test that API can retrieve several drivers by id"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+
+        json_response = api_call(self, "GET", '/driver/get', dict(ids="5,1"), 200, True)
+        self.assertEqual([driver["dob"] for driver in json_response["items"]], ["23/06/1962"])
+        self.assertEqual(json_response["missing"], [5])
+
     def test_cant_get_driver_invalid_request(self):
         """ Test that endpoint can deal with missing query string"""
+        # POST is the long form of ids=1,2,3
         res = self.client.post('/driver/get')
-        self.assertEqual(res.status_code, 405)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {"status_code": 400, "message": "Missing ids"})
 
         res = self.client.delete('/driver/get')
         self.assertEqual(res.status_code, 405)
@@ -741,6 +1437,34 @@ class DriverTestCase(unittest.TestCase):
         self.assertEqual(json_response['status_code'], 400)
         self.assertEqual(json_response['message'], "Invalid dob")
 
+    def test_can_list_drivers(self):
+        """ Test that API can page through drivers one at a time"""
+        for name in ["Bill", "Steve", "Linus"]:
+            api_call(self, "POST", '/driver/create', dict(first_name=name, last_name="Smith", dob="11/05/1950"), 200)
+
+        names = []
+        after = None
+        while True:
+            params = dict(last_name="Smith", limit=1)
+            if after:
+                params["after"] = after
+            json_response = api_call(self, "GET", '/driver/list', params, 200, True)
+            names += [driver["first_name"] for driver in json_response["items"]]
+            after = json_response["next"]
+            if not after:
+                break
+        self.assertEqual(names, ["bill", "steve", "linus"])
+
+    def test_can_export_drivers(self):
+        """ Test that API can stream every driver as NDJSON"""
+        api_call(self, "POST", '/driver/create', dict(first_name="Bill", middle_name="John", last_name="Gates",
+                                                      dob="11/05/1950"), 200)
+
+        res = self.client.get('/driver/export')
+        drivers = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+        self.assertEqual(drivers, [api_call(self, "GET", '/driver/get', dict(id=1), 200, True)])
+        self.assertEqual(drivers[0]["dob"], "11/05/1950")
+
     def test_can_update_driver(self):
         """ Test for updating driver details"""
         api_call(self, "POST", '/driver/create', dict(first_name="Nicola", last_name="Tesla", middle_name="Testovich",
@@ -805,6 +1529,31 @@ class DriverTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 400)
         self.assertEqual(json_response["message"], "Invalid dob")
 
+    def test_can_upsert_drivers(self):
+        """ Test that upsert matches drivers on first name, last name and date of birth"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+
+        body = '\n'.join(json.dumps(driver) for driver in [
+            dict(first_name="Alan", middle_name="Mathison", last_name="Turing", dob="23/06/1962"),
+            dict(first_name="Alan", last_name="Turing", dob="23/06/1963"),
+            dict(first_name="Grace", last_name="Hopper", dob="09/12/1906"),
+            dict(first_name="Ada", last_name="Lovelace", dob="10/12/2015")])
+        res = self.client.put('/driver/upsert', data=body, content_type='application/x-ndjson')
+        json_response = res.get_json()
+        self.assertEqual((json_response["status_code"], json_response["message"]), (200, "Drivers upserted"))
+        self.assertEqual((json_response["inserted"], json_response["updated"], json_response["unchanged"]), (2, 1, 0))
+        self.assertEqual(json_response["errors"], [dict(index=3, status_code=400, message="Invalid dob")])
+
+        json_response = api_call(self, "GET", '/driver/get', dict(id=1), 200, True)
+        self.assertEqual((json_response["middle_name"], json_response["version"]), ("mathison", 2))
+        json_response = api_call(self, "GET", '/driver/list', dict(), 200, True)
+        self.assertEqual([driver["dob"] for driver in json_response["items"]], ["23/06/1962", "23/06/1963",
+                                                                                "09/12/1906"])
+
+        json_response = api_call(self, "POST", "/driver/create", dict(first_name="Grace", last_name="Hopper",
+                                                                      dob="09/12/1906"), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Driver already exists"))
+
     def test_can_delete_driver(self):
         """ Test can delete driver """
         api_call(self, "POST", '/driver/create', dict(first_name="Nicola", last_name="Tesla", dob="23/12/1983"), 200)
@@ -817,6 +1566,22 @@ class DriverTestCase(unittest.TestCase):
         self.assertEqual(json_response["status_code"], 404)
         self.assertEqual(json_response["message"], "Driver not found")
 
+    def test_can_list_driver_cars_and_delete_driver(self):
+        """ Test that API can page through the cars of a driver, deleting the driver unassigns them"""
+        api_call(self, "POST", '/driver/create', dict(first_name="Nicola", last_name="Tesla", dob="23/12/1983"), 200)
+        for make in ["Tesla", "Ford"]:
+            api_call(self, "POST", '/car/create', dict(make=make, model="x", year=2018, assigned_type=1,
+                                                       assigned_id=1), 200)
+
+        json_response = api_call(self, "GET", '/driver/cars', dict(id=1), 200, True)
+        self.assertEqual([car["make"] for car in json_response["items"]], ["tesla", "ford"])
+        self.assertIsNone(json_response["next"])
+
+        api_call(self, "DELETE", '/driver/delete', dict(id=1), 200)
+        json_response = api_call(self, "GET", '/driver/cars', dict(id=1), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (404, "Driver not found"))
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=2), 200, True)["assigned_type"], None)
+
     def test_cant_delete_driver_invalid_id(self):
         """ Test we cant delete driver with invalid ID """
         json_response = api_call(self, "DELETE", '/driver/delete', dict(id=102030), 200, True)
@@ -849,11 +1614,768 @@ class DriverTestCase(unittest.TestCase):
             db.drop_all()
 
 
+class ImportTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+        self.files = []
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def write_file(self, suffix, content):
+        """ Writes content to a temporary file and returns its path"""
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as f:
+            f.write(content)
+        self.files.append(path)
+        return path
+
+    def import_all(self, use_copy):
+        drivers = self.write_file('.csv', "first_name,middle_name,last_name,dob\n"
+                                          "Alan,,Turing,23/06/1962\n"
+                                          "Bill,John,Gates,11/05/1950\n"
+                                          "Kid,,Young,01/01/2015\n"
+                                          "ALAN,,turing,23/06/1962\n")
+        branches = self.write_file('.ndjson', '{"city": "London", "postcode": "E1W 3SS", "capacity": 2}\n'
+                                              '{"city": "London", "postcode": "nope", "capacity": 2}\n'
+                                              '{"city": "Leeds", "postcode": "E1W3SS", "capacity": 2}\n')
+        cars = self.write_file('.ndjson', '\n'.join(json.dumps(car) for car in [
+            dict(make="Tesla", model="Model 3", year=2018, assigned_type=1, assigned_id=2),
+            dict(make="BMW", model="530d", year=2018, assigned_type=2, assigned_id=1),
+            dict(make="BMW", model="M3", year=2019, assigned_type=2, assigned_id=1),
+            dict(make="Audi", model="A4", year=2012, assigned_type=2, assigned_id=1),
+            dict(make="Ford", model="Focus", year=2010, assigned_type=1, assigned_id=20),
+            dict(make="Ford", year=2010, assigned_type=1, assigned_id=1)]))
+
+        with self.app.app_context():
+            results = {kind: importer.import_file(kind, path, batch_size=2, use_copy=use_copy)
+                       for kind, path in [("drivers", drivers), ("branches", branches), ("cars", cars)]}
+            db.session.commit()
+        return results
+
+    def check_import(self, results):
+        self.assertEqual(results["drivers"]["loaded"], 2)
+        self.assertEqual(results["drivers"]["errors"], [(4, "Invalid dob"), (5, "Duplicate record")])
+        self.assertEqual(results["branches"]["loaded"], 1)
+        self.assertEqual(results["branches"]["errors"], [(2, "Invalid postcode"), (3, "Duplicate record")])
+        self.assertEqual(results["cars"]["loaded"], 3)
+        self.assertEqual(results["cars"]["errors"], [(4, "Branch has reached its capacity"),
+                                                     (5, "Driver not found"), (6, "Missing model")])
+
+        json_response = api_call(self, "GET", '/driver/get', dict(id=2), 200, True)
+        self.assertEqual(json_response["dob"], "11/05/1950")
+        self.assertEqual(json_response["middle_name"], "john")
+        json_response = api_call(self, "GET", '/driver/get', dict(id=1), 200, True)
+        self.assertIsNone(json_response["middle_name"])
+        json_response = api_call(self, "GET", '/car/get', dict(model="m3"), 200, True)
+        self.assertEqual(json_response["assigned_type"], 2)
+
+    def test_can_import_with_copy(self):
+        """ Test that import command loads valid rows with COPY and reports the rest"""
+        self.check_import(self.import_all(use_copy=True))
+
+    def test_can_import_with_insert(self):
+        """ Test that import falls back to INSERT with the same results"""
+        self.check_import(self.import_all(use_copy=False))
+
+    def test_import_skips_records_that_exist(self):
+        """ Test that drivers and branches already in the database are reported instead of failing the import"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=2), 200)
+        drivers = self.write_file('.csv', "first_name,middle_name,last_name,dob\n"
+                                          "Grace,,Hopper,09/12/1906\n"
+                                          "Alan,Mathison,Turing,23/06/1962\n")
+        branches = self.write_file('.ndjson', '{"city": "London", "postcode": "E1W3SS", "capacity": 2}\n'
+                                              '{"city": "Leeds", "postcode": "LS1 4DY", "capacity": 2}\n')
+
+        for use_copy in [True, False]:
+            with self.subTest(use_copy=use_copy):
+                with self.app.app_context():
+                    results = {kind: importer.import_file(kind, path, use_copy=use_copy)
+                               for kind, path in [("drivers", drivers), ("branches", branches)]}
+                    db.session.rollback()
+                self.assertEqual(results["drivers"]["loaded"], 1)
+                self.assertEqual(results["drivers"]["errors"], [(3, "Driver already exists")])
+                self.assertEqual(results["branches"]["loaded"], 1)
+                self.assertEqual(results["branches"]["errors"], [(1, "Branch already exists")])
+
+    def tearDown(self):
+        for path in self.files:
+            os.remove(path)
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class CapacityTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def test_counter_only_moves_within_capacity(self):
+        """ Test cars are only added to branches with room, removing always goes through"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=1), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Leeds", postcode="LS1 4DY", capacity=5), 200)
+        with self.app.app_context():
+            Branch.adjust_occupancy({1: 1, 2: 1})
+            db.session.commit()
+            with self.assertRaises(helpers.ApiError) as context:
+                Branch.adjust_occupancy({1: 1, 2: 1})
+            self.assertEqual(context.exception.message, "Branch has reached its capacity")
+            db.session.rollback()
+
+            db.session.execute("UPDATE branch SET capacity = 0")  # capacity lowered below occupancy
+            Branch.adjust_occupancy({1: -1, 2: -1})
+            db.session.commit()
+            self.assertEqual([Branch.get({"id": id}).occupancy for id in (1, 2)], [0, 0])
+
+    @skip_asgi("benchmark.TestClient sends the parallel requests to the Flask app from threads")
+    def test_capacity_holds_under_parallel_assigners(self):
+        """ Test that 60 cars created at once for a branch with room for 10 only ever add 10"""
+        result = benchmark.contend(benchmark.TestClient(self.app), 60, 10)
+        self.assertEqual(result["branch"]["created"], 10)
+        self.assertEqual(result["branch"]["rejected"], 50)
+        self.assertEqual(result["branch"]["occupancy"], 10)
+        self.assertEqual(result["branch"]["cars"], 10)
+        self.assertEqual(result["driver"]["created"], 60)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def explain(self, model, params):
+        """ Returns query plan of model search with given params, with sequential scans discouraged so that tiny test
+        tables get the plan a large table would"""
+        query = search_query(model, params).to_query(db.session()).params(**params)
+        statement = query.statement.compile(dialect=postgresql.dialect())
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute("EXPLAIN " + str(statement), statement.params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+    def test_search_filters_use_indexes(self):
+        """ Test that every filter combination the get and list endpoints use is served by an index. assigned_id on its
+        own is left out, it means nothing without assigned_type"""
+        car = dict(make="bmw", model="530d", year=2018, assigned_type=2, assigned_id=1)
+        branch = dict(city="london", postcode="e1w 3ss")
+        driver = dict(first_name="alan", middle_name="mathison", last_name="turing", dob="06/23/1962")
+        combinations = [
+            (Car, ["make"]), (Car, ["model"]), (Car, ["year"]), (Car, ["assigned_type"]),
+            (Car, ["make", "model"]), (Car, ["make", "model", "year"]), (Car, ["make", "year"]),
+            (Car, ["model", "year"]), (Car, ["assigned_type", "assigned_id"]), (Car, ["make", "assigned_type"]),
+            (Branch, ["city"]), (Branch, ["postcode"]), (Branch, ["city", "postcode"]),
+            (Driver, ["first_name"]), (Driver, ["last_name"]), (Driver, ["dob"]), (Driver, ["first_name", "last_name"]),
+            (Driver, ["first_name", "middle_name", "last_name"]), (Driver, ["last_name", "dob"]),
+        ]
+        examples = {Car: car, Branch: branch, Driver: driver}
+
+        with self.app.app_context():
+            for model, keys in combinations:
+                plan = self.explain(model, {key: examples[model][key] for key in keys})
+                self.assertIn("Index Cond", plan, "{} filtered by {} doesn't use an index:\n{}".format(
+                    model.__tablename__, keys, plan))
+
+    def test_search_is_baked_once_per_shape(self):
+        """ Test that lookups with the same filter names reuse the cached query whatever the values and their order"""
+        with self.app.app_context():
+            Car.get(dict(make="bmw", year=2018))
+            Car.get_page(dict(make="bmw"), 10, 5)
+            cached = len(bakery.cache)
+
+            Car.get(dict(year=2019, make="audi"))
+            Car.get_page(dict(make="ford"), 20, 1)
+            self.assertEqual(len(bakery.cache), cached)
+
+            Car.get(dict(model="a4"))
+            self.assertGreater(len(bakery.cache), cached)
+
+    def test_branch_capacity_check_uses_assignment_index(self):
+        """ Test that counting cars of a branch is answered from the (assigned_type, assigned_id) index"""
+        with self.app.app_context():
+            plan = self.explain(Car, dict(assigned_type=2, assigned_id=1))
+            self.assertIn("ix_car_assigned ", plan + " ")
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def test_get_by_id_is_served_from_cache(self):
+        """ Test that repeated get by id skips the database and writes through the API invalidate the entry"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+
+        api_call(self, "GET", '/branch/get', dict(id=1), 200, True)
+        with self.app.app_context():
+            db.session.execute("UPDATE branch SET city = 'changed behind our back'")
+            db.session.commit()
+        json_response = api_call(self, "GET", '/branch/get', dict(id=1), 200, True)
+        self.assertEqual(json_response["city"], "london")
+
+        stats = api_call(self, "GET", '/cache/stats', dict(), 200, True)
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+
+        # Searches by other fields always go to the database
+        json_response = api_call(self, "GET", '/branch/get', dict(city="changed behind our back"), 200, True)
+        self.assertEqual(json_response["id"], 1)
+
+        api_call(self, "PUT", '/branch/update', dict(id=1, capacity=10), 200)
+        json_response = api_call(self, "GET", '/branch/get', dict(id=1), 200, True)
+        self.assertEqual(json_response["capacity"], 10)
+        self.assertEqual(json_response["city"], "changed behind our back")
+
+    def test_car_writes_invalidate_cache(self):
+        """ Test that car and branch entries are dropped when a car write changes them"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 1)
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=1), 200, True)["year"], 2018)
+
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="M3", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        api_call(self, "PUT", '/car/update', dict(id=1, year=2019), 200)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 2)
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=1), 200, True)["year"], 2019)
+
+        api_call(self, "DELETE", '/car/delete', dict(id=1), 200)
+        json_response = api_call(self, "GET", '/car/get', dict(id=1), 200, True)
+        self.assertEqual(json_response["status_code"], 404)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 1)
+
+    def test_cache_evicts_and_expires(self):
+        """ Test LRU eviction and TTL expiry of the cache itself"""
+        model_cache = ModelCache()
+        model_cache.size = 2
+        model_cache.ttl = 60
+        model_cache.put(("car", 1), {"id": 1})
+        model_cache.put(("car", 2), {"id": 2})
+        model_cache.get(("car", 1))
+        model_cache.put(("car", 3), {"id": 3})
+        self.assertIsNone(model_cache.get(("car", 2)))
+        self.assertEqual(model_cache.get(("car", 1)), {"id": 1})
+        self.assertEqual(model_cache.evictions, 1)
+
+        model_cache.ttl = -1
+        model_cache.put(("car", 4), {"id": 4})
+        self.assertIsNone(model_cache.get(("car", 4)))
+        self.assertEqual(model_cache.expirations, 1)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def test_get_answers_if_none_match(self):
+        """ Test that get endpoints send ETags and answer matching If-None-Match with 304"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+
+        for url in ['/car/get', '/driver/get']:
+            res = self.client.get(url, query_string=dict(id=1))
+            etag = res.headers['ETag']
+            self.assertTrue(etag.startswith('"'))
+
+            res = self.client.get(url, query_string=dict(id=1), headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.get_data(), b'')
+            self.assertEqual(res.headers['ETag'], etag)
+
+            # If-None-Match uses the weak comparison, a proxy that compressed the response sends the tag back weak
+            res = self.client.get(url, query_string=dict(id=1), headers={'If-None-Match': 'W/' + etag})
+            self.assertEqual(res.status_code, 304)
+
+            res = self.client.get(url, query_string=dict(id=1), headers={'If-None-Match': '"something-else"'})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json()["id"], 1)
+
+        etag = self.client.get('/car/get', query_string=dict(id=1)).headers['ETag']
+        api_call(self, "PUT", '/car/update', dict(id=1, year=2019), 200)
+        res = self.client.get('/car/get', query_string=dict(id=1), headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.get_json()["year"], 2019)
+
+    def test_branch_etag_changes_with_occupancy(self):
+        """ Test that assigning a car changes the ETag of its branch"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        etag = self.client.get('/branch/get', query_string=dict(id=1)).headers['ETag']
+
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                   assigned_id=1), 200)
+        res = self.client.get('/branch/get', query_string=dict(id=1), headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["occupancy"], 1)
+
+        # Filtered lookups get ETags too
+        res = self.client.get('/branch/get', query_string=dict(city="london"),
+                              headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_not_modified_without_cache(self):
+        """ Test that 304 is decided from the version column when the record isn't cached"""
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=5), 200)
+        etag = self.client.get('/branch/get', query_string=dict(id=1)).headers['ETag']
+        cache.enabled = False
+        try:
+            res = self.client.get('/branch/get', query_string=dict(id=1), headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            res = self.client.get('/branch/get', query_string=dict(id=2), headers={'If-None-Match': etag})
+            self.assertEqual(res.get_json()["status_code"], 404)
+        finally:
+            cache.enabled = True
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=1), 200)
+
+    def test_can_run_batch(self):
+        """ Test that a batch runs every sub-request in order on one connection and returns all of the responses"""
+        checkouts = REGISTRY.get_sample_value('db_pool_checkout_seconds_count') or 0
+        json_response = api_call(self, "POST", '/batch', [
+            dict(method="POST", path="/driver/create", body=dict(first_name="Alan", last_name="Turing",
+                                                                 dob="23/06/1962")),
+            dict(method="post", path="/car/create", body=dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                              assigned_id=1)),
+            dict(method="GET", path="/car/get?id=1&expand=assignee"),
+            dict(method="GET", path="/driver/get", query=dict(id=2)),
+            dict(method="PUT", path="/car/update", body=dict(id=1, assigned_type=2, assigned_id=7)),
+            dict(method="GET", path="/car/nothing"),
+        ], 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        responses = json_response["responses"]
+        self.assertEqual(responses[0], dict(status_code=200, body=dict(status_code=201, message="Driver created")))
+        self.assertEqual(responses[1]["body"]["message"], "Car created")
+        self.assertEqual(responses[2]["body"]["assignee"]["last_name"], "turing")
+        self.assertEqual(responses[3]["body"], dict(status_code=404, message="Driver not found"))
+        self.assertEqual(responses[4]["body"], dict(status_code=404, message="Branch not found"))
+        self.assertEqual(responses[5]["status_code"], 404)
+        self.assertEqual(len(responses), 6)
+        if API_MODE != 'asgi':
+            self.assertEqual((REGISTRY.get_sample_value('db_pool_checkout_seconds_count') or 0) - checkouts, 1)
+
+        # failed sub-requests are rolled back on their own, the others are committed
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=1), 200, True)["assigned_type"], 1)
+
+    def test_failed_sub_request_is_rolled_back_on_its_own(self):
+        """ Test that a sub-request failing after it wrote leaves nothing behind, without atomic"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2010, assigned_type=1,
+                                                         assigned_id=1)] * 2, 200)
+        json_response = api_call(self, "POST", '/batch', dict(requests=[
+            dict(method="PUT", path="/car/transfer", body=dict(ids=[1, 2], assigned_type=2, assigned_id=1)),
+            dict(method="PUT", path="/car/transfer", body=dict(ids=[1], assigned_type=2, assigned_id=1)),
+        ]), 200, True)
+        self.assertEqual([response["body"]["status_code"] for response in json_response["responses"]], [400, 200])
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 1)
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=2), 200, True)["assigned_type"], 1)
+
+    def test_atomic_batch_is_all_or_nothing(self):
+        """ Test that the first failing sub-request of an atomic batch rolls back the ones before it"""
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=1), 200, True)["year"], 2018)  # cached
+
+        json_response = api_call(self, "POST", '/batch', dict(atomic=True, requests=[
+            dict(method="PUT", path="/car/update", body=dict(id=1, year=2019)),
+            dict(method="GET", path="/car/get", query=dict(id=1)),
+            dict(method="POST", path="/car/create", body=dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                              assigned_id=1)),
+            dict(method="POST", path="/car/create", body=dict(make="BMW", model="530d", year=2018, assigned_type=2,
+                                                              assigned_id=1)),
+            dict(method="DELETE", path="/driver/delete", query=dict(id=1)),
+        ]), 200, True)
+        self.assertEqual((json_response["status_code"], json_response["message"]), (400, "Batch rolled back"))
+        self.assertEqual(json_response["failed"], 3)
+        self.assertEqual(json_response["responses"][1]["body"]["year"], 2019)  # sees its own changes
+        self.assertEqual(json_response["responses"][3]["body"]["message"], "Branch has reached its capacity")
+        self.assertEqual(len(json_response["responses"]), 4)
+
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=1), 200, True)["year"], 2018)
+        self.assertEqual(api_call(self, "GET", '/car/get', dict(id=2), 200, True)["status_code"], 404)
+        self.assertEqual(api_call(self, "GET", '/branch/get', dict(id=1), 200, True)["occupancy"], 0)
+
+        json_response = api_call(self, "POST", '/batch', dict(atomic=True, requests=[
+            dict(method="PUT", path="/car/update", body=dict(id=1, year=2019)),
+            dict(method="PUT", path="/car/transfer", body=dict(ids=[1], assigned_type=2, assigned_id=1)),
+        ]), 200, True)
+        self.assertEqual(json_response["status_code"], 200)
+        json_response = api_call(self, "GET", '/car/get', dict(id=1), 200, True)
+        self.assertEqual((json_response["year"], json_response["assigned_type"]), (2019, 2))
+
+    def test_cant_run_invalid_batch(self):
+        """ Test that a batch is checked as a whole before any of it runs"""
+        for data, message in [
+                (None, "Invalid request"),
+                (dict(atomic=True), "Missing requests"),
+                (dict(requests=[]), "Invalid requests"),
+                (dict(requests=[dict(method="GET", path="/car/get?id=1")] * 21), "Invalid requests"),
+                (dict(requests=[dict(method="PATCH", path="/car/update")]), "Invalid requests"),
+                (dict(requests=[dict(method="GET", path="car/get")]), "Invalid requests"),
+                (dict(requests=[dict(method="GET", path="/car/get?id=1", query=dict(id=2))]), "Invalid requests"),
+                (dict(requests=[dict(method="POST", path="/batch", body=[])]), "Batches can't be nested"),
+                (dict(requests=[dict(method="GET", path="/car/get?id=1")], atomic="yes"), "Invalid atomic")]:
+            with self.subTest(data):
+                json_response = api_call(self, "POST", '/batch', data, 200, True)
+                self.assertEqual((json_response["status_code"], json_response["message"]), (400, message))
+
+        res = self.client.get('/batch')
+        self.assertEqual(res.status_code, 405)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+@skip_asgi("requests answered by the async handlers don't go through the Flask hooks that record metrics")
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def sample(self, name, **labels):
+        # metrics are shared by every app in the process, tests look at how much a value moved
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_measured_by_endpoint_and_status(self):
+        """ Test latency is recorded per endpoint with the status from the response body"""
+        labels = dict(method="GET", endpoint="/car/get")
+        found = self.sample('http_request_duration_seconds_count', status="200", **labels)
+        not_found = self.sample('http_request_duration_seconds_count', status="404", **labels)
+
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", '/car/create', dict(make="BMW", model="530d", year=2018, assigned_type=1,
+                                                   assigned_id=1), 200)
+        # the status is kept where the response is built, bodies aren't decoded again to find it
+        with mock.patch.object(self.app.response_class, 'get_json', side_effect=AssertionError("body decoded")):
+            api_call(self, "GET", '/car/get', dict(id=1), 200)
+            api_call(self, "GET", '/car/get', dict(id=2), 200)
+            api_call(self, "GET", '/car/get', dict(id=3), 200)
+
+        self.assertEqual(self.sample('http_request_duration_seconds_count', status="200", **labels) - found, 1)
+        self.assertEqual(self.sample('http_request_duration_seconds_count', status="404", **labels) - not_found, 2)
+
+    def test_sql_statements_are_counted_per_request(self):
+        """ Test number of SQL statements and time spent on them is recorded per request"""
+        labels = dict(method="GET", endpoint="/driver/list")
+        requests = self.sample('http_request_sql_queries_count', **labels)
+        queries = self.sample('http_request_sql_queries_sum', **labels)
+
+        api_call(self, "GET", '/driver/list', dict(), 200)
+        api_call(self, "GET", '/driver/list', dict(limit="x"), 200)
+
+        self.assertEqual(self.sample('http_request_sql_queries_count', **labels) - requests, 2)
+        self.assertEqual(self.sample('http_request_sql_queries_sum', **labels) - queries, 1)
+        self.assertGreater(self.sample('http_request_sql_seconds_sum', **labels), 0)
+
+    def test_metrics_endpoint(self):
+        """ Test metrics are exposed in Prometheus text format"""
+        api_call(self, "GET", '/branch/get', dict(id=1), 200)
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        body = res.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="/branch/get",le="0.005",method="GET",'
+                      'status="404"}', body)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+# Most SQL statements each endpoint may issue, checked by QueryBudgetTestCase against the data it sets up.
+# (method, url, data, budget); raise a budget only together with the change that needs the extra statements
+QUERY_BUDGETS = [
+    ("POST", "/driver/create", dict(first_name="Ada", last_name="Lovelace", dob="10/12/1915"), 1),
+    ("POST", "/branch/create", dict(city="Guildford", postcode="GU11EA", capacity=5), 1),
+    # validate_assigning loads the branch, the occupancy counter is updated next to the insert
+    ("POST", "/car/create", dict(make="BMW", model="530d", year=2018, assigned_type=2, assigned_id=1), 3),
+    ("POST", "/car/create", dict(make="BMW", model="530d", year=2018, assigned_type=1, assigned_id=1), 2),
+    # bulk create is the same number of statements whatever the number of rows
+    ("POST", "/car/bulk_create", [dict(make="Ford", model="Focus", year=2010, assigned_type=2, assigned_id=1)] * 5, 3),
+    ("GET", "/car/get", dict(id=1), 1),
+    # the driver or branch comes LEFT JOINed in the same query
+    ("GET", "/car/get", dict(id=1, expand="assignee"), 1),
+    # batch lookups are one WHERE id = ANY(:ids) query
+    ("GET", "/car/get", dict(ids="2,1,99"), 1),
+    ("POST", "/car/get", dict(ids=[1, 2]), 1),
+    ("GET", "/branch/get", dict(ids="1,2"), 1),
+    ("GET", "/driver/get", dict(ids="1,2"), 1),
+    ("GET", "/car/list", dict(), 1),
+    ("GET", "/car/export", dict(), 1),
+    ("GET", "/branch/get", dict(id=1), 1),
+    ("GET", "/branch/list", dict(), 1),
+    ("GET", "/branch/export", dict(), 1),
+    ("GET", "/branch/occupancy", dict(), 1),
+    ("GET", "/branch/cars", dict(id=1), 1),
+    ("GET", "/driver/cars", dict(id=2), 1),
+    ("GET", "/driver/get", dict(id=1), 1),
+    ("GET", "/driver/list", dict(), 1),
+    ("GET", "/driver/export", dict(), 1),
+    ("PUT", "/car/update", dict(id=1, year=2019), 1),
+    ("PUT", "/car/update", dict(id=1, assigned_type=1, assigned_id=1), 3),
+    # transfer is the same number of statements whatever the number of cars
+    ("PUT", "/car/transfer", dict(ids=[1], assigned_type=2, assigned_id=1), 3),
+    ("PUT", "/branch/update", dict(id=1, capacity=12), 1),
+    ("PUT", "/driver/update", dict(id=1, first_name="Bob"), 1),
+    # upserts are one INSERT ... ON CONFLICT per 1000 records
+    ("PUT", "/branch/upsert", [dict(city="Bristol", postcode="BS1 5TR", capacity=5),
+                               dict(city="Leeds", postcode="LS1 4DY", capacity=3)], 1),
+    ("PUT", "/driver/upsert", [dict(first_name="Grace", last_name="Hopper", dob="09/12/1906"),
+                               dict(first_name="Ken", last_name="Thompson", dob="04/02/1943")], 1),
+    ("DELETE", "/car/delete", dict(id=2), 1),
+    # cars of a branch or driver are unassigned before it's deleted
+    ("DELETE", "/branch/delete", dict(id=2), 2),
+    ("DELETE", "/driver/delete", dict(id=2), 2),
+]
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up app with a pool of one connection, the engine is created on first use
+        self.app = create_app(config_name="testing")
+        self.app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(self.app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+                                                            pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    def sample(self, name):
+        return REGISTRY.get_sample_value(name) or 0
+
+    def test_pool_is_configured_and_measured(self):
+        """ Test the engine uses the configured instrumented pool and checkouts are measured"""
+        with self.app.app_context():
+            pool = db.engine.pool
+            self.assertIsInstance(pool, InstrumentedQueuePool)
+            self.assertEqual((pool.size(), pool._timeout, pool._pre_ping), (1, 0.1, True))
+            self.assertEqual(self.sample('db_pool_capacity'), 1)
+
+            checkouts = self.sample('db_pool_checkout_seconds_count')
+            timeouts = self.sample('db_pool_checkout_timeouts_total')
+            connection = db.engine.connect()
+            self.assertEqual(self.sample('db_pool_checked_out'), 1)
+            with self.assertRaises(exc.TimeoutError):
+                db.engine.connect()
+            connection.close()
+
+            self.assertEqual(self.sample('db_pool_checked_out'), 0)
+            self.assertEqual(self.sample('db_pool_checkout_seconds_count') - checkouts, 2)
+            self.assertEqual(self.sample('db_pool_checkout_timeouts_total') - timeouts, 1)
+
+    def test_connections_of_other_process_are_replaced(self):
+        """ Test a connection opened by another process (gunicorn master) isn't reused"""
+        with self.app.app_context():
+            connection = db.engine.connect()
+            inherited = connection.connection.connection
+            connection.connection._connection_record.info['pid'] = -1
+            connection.close()
+
+            connection = db.engine.connect()
+            self.assertIsNot(connection.connection.connection, inherited)
+            self.assertEqual(connection.scalar("SELECT 1"), 1)
+            connection.close()
+            inherited.close()
+            db.engine.dispose()
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+        # every lookup has to reach the database to be counted
+        cache.enabled = False
+
+        api_call(self, "POST", "/driver/create", dict(first_name="Alan", last_name="Turing", dob="23/06/1962"), 200)
+        api_call(self, "POST", "/driver/create", dict(first_name="Grace", last_name="Hopper", dob="09/12/1906"), 200)
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode="E1W 3SS", capacity=20), 200)
+        api_call(self, "POST", '/branch/create', dict(city="Leeds", postcode="LS1 4DY", capacity=2), 200)
+        api_call(self, "POST", '/car/create', dict(make="Tesla", model="Model 3", year=2015, assigned_type=2,
+                                                   assigned_id=1), 200)
+        api_call(self, "POST", '/car/create', dict(make="Ford", model="Ka", year=2012, assigned_type=1,
+                                                   assigned_id=2), 200)
+
+    def test_query_counter(self):
+        """ Test the counter records statements and fails when the budget is exceeded"""
+        with self.app.app_context():
+            with QueryCounter() as queries:
+                Car.get({"id": 1})
+                Branch.get({"id": 1})
+            self.assertEqual(queries.count, 2)
+            self.assertTrue(queries.statements[0].startswith("SELECT car.id"))
+
+            @QueryCounter(1, "two gets")
+            def two_gets():
+                Car.get({"id": 1})
+                Driver.get({"id": 1})
+
+            with self.assertRaises(AssertionError) as raised:
+                two_gets()
+            self.assertIn("two gets issued 2 SQL statements, budget is 1", str(raised.exception))
+            self.assertIn("FROM driver", str(raised.exception))
+
+    @skip_asgi("QueryCounter only sees statements of SQLAlchemy engines, not of asyncpg")
+    def test_endpoints_stay_within_query_budget(self):
+        """ Test every endpoint issues no more SQL statements than its budget"""
+        for method, url, data, budget in QUERY_BUDGETS:
+            label = "{} {} {}".format(method, url, data)
+            with self.subTest(label):
+                with QueryCounter(budget, label):
+                    json_response = api_call(self, method, url, data, 200, not url.endswith("/export"))
+                if json_response is not None:
+                    self.assertLess(json_response.get("status_code", 200), 400, json_response)
+
+    def tearDown(self):
+        cache.enabled = True
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        # sets up clean app with testing config
+        self.app = create_app(config_name="testing")
+        self.client = make_client(self)
+
+        # set up test db
+        with self.app.app_context():
+            db.create_all()
+
+    def test_can_run_mix_and_report(self):
+        """ Test a generated mix runs through the test client and is reported per endpoint"""
+        client = benchmark.TestClient(self.app)
+        workload = benchmark.Workload(benchmark.random.Random(1))
+        benchmark.seed(client, workload, 3)
+        self.assertEqual((len(workload.ids["driver"]), len(workload.ids["branch"]), len(workload.ids["car"])),
+                         (3, 3, 15))
+
+        requests = workload.generate("mixed", 50)
+        before = benchmark.read_sql_metrics(client)
+        results, seconds = benchmark.run(client, requests, 2)
+        result = benchmark.report(results, seconds, before, benchmark.read_sql_metrics(client))
+
+        self.assertEqual(result["total"]["count"], 50)
+        self.assertEqual(sum(endpoint["count"] for endpoint in result["endpoints"].values()), 50)
+        for endpoint in result["endpoints"].values():
+            self.assertLessEqual(endpoint["p50_ms"], endpoint["p99_ms"])
+            self.assertIn("queries_per_request", endpoint)
+
+    def test_validation_benchmark(self):
+        """ Test the validation microbenchmark times every payload before and after"""
+        result = benchmark.validation_benchmark(10)
+        self.assertIn("car_create", result)
+        for timings in result.values():
+            self.assertEqual(set(timings), {"before_us", "after_us", "speedup"})
+
+    def test_contention_needs_its_branch(self):
+        """ Test the contention run takes its postcode from its timestamp and stops when the branch can't be created"""
+        self.assertNotEqual(benchmark.numbered_postcode(1000), benchmark.numbered_postcode(1001))
+        api_call(self, "POST", '/branch/create', dict(city="London", postcode=benchmark.numbered_postcode(1000),
+                                                      capacity=5), 200)
+        with mock.patch("benchmark.time.time", return_value=1.0):
+            with self.assertRaises(ValueError) as raised:
+                benchmark.contend(benchmark.TestClient(self.app), 2, 1)
+        self.assertEqual(str(raised.exception), "/branch/create failed with 400: Branch already exists")
+
+    def test_compare_flags_regressions(self):
+        """ Test comparing with a baseline flags slower endpoints and extra queries only"""
+        baseline = {"total": {"req_per_s": 100, "p95_ms": 10},
+                    "endpoints": {"GET /car/get": {"req_per_s": 50, "p95_ms": 5, "queries_per_request": 1}}}
+        result = {"total": {"req_per_s": 95, "p95_ms": 10.5},
+                  "endpoints": {"GET /car/get": {"req_per_s": 40, "p95_ms": 5, "queries_per_request": 2}}}
+        self.assertEqual(benchmark.compare(result, baseline, 0.1), ["GET /car/get: req/s 50 -> 40",
+                                                                    "GET /car/get: queries per request 1 -> 2"])
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 0.99), 4)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
 class HelpersTestCase(unittest.TestCase):
     def setUp(self):
         # sets up clean app with testing config
         self.app = create_app(config_name="testing")
-        self.client = self.app.test_client()
+        self.client = make_client(self)
 
         # set up test db
         with self.app.app_context():
@@ -1010,6 +2532,61 @@ class HelpersTestCase(unittest.TestCase):
         self.assertEqual(exception.args[0]["status_code"], 400)
         self.assertEqual(exception.args[0]["message"], "Invalid dob")
 
+    def test_dumps_matches_standard_library(self):
+        """ Test JSON is the same compact, key sorted document with orjson and with the standard library"""
+        value = {"status_code": 200, "items": [{"make": "bmw", "id": 1, "assigned_id": None}], "next": "MTA="}
+        expected = json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+        self.assertEqual(helpers.dumps(value), expected)
+        with mock.patch.object(helpers, "orjson", None):
+            self.assertEqual(helpers.dumps(value), expected)
+
+    def test_browsable_api_can_be_turned_off(self):
+        """ Test renderers are resolved once and the browsable one is left out when turned off"""
+        from flask_api.renderers import JSONRenderer, BrowsableAPIRenderer
+        self.assertEqual(self.app.config['DEFAULT_RENDERERS'], [JSONRenderer, BrowsableAPIRenderer])
+
+        with mock.patch.object(TestingConfig, "BROWSABLE_API", False):
+            app = create_app(config_name="testing")
+        self.assertEqual(app.config['DEFAULT_RENDERERS'], [JSONRenderer])
+
+    def test_validate_dob_format(self):
+        """ Test date of birth is returned in m/d/Y with zero padding"""
+        self.assertEqual(helpers.validate_dob("3/6/1962"), "06/03/1962")
+        self.assertEqual(helpers.validate_dob("23/06/1962"), "06/23/1962")
+        with self.assertRaises(helpers.ApiError):
+            helpers.validate_dob("31/02/1990")
+        with self.assertRaises(helpers.ApiError):
+            helpers.validate_dob(19900101)
+
+    def test_schema_good(self):
+        """ Test compiled schemas return clean values and defaults"""
+        self.assertEqual(schemas.car_create(dict(make="BMW", model="530d", year=2019, assigned_type="1",
+                                                 assigned_id="2")),
+                         dict(make="bmw", model="530d", year=2019, assigned_type="1", assigned_id=2))
+        self.assertEqual(schemas.driver_create(dict(first_name="Alan", last_name="Turing", dob="23/06/1962")),
+                         dict(first_name="alan", middle_name=None, last_name="turing", dob="06/23/1962"))
+        self.assertEqual(schemas.car_update(dict(id="1", year=2012)), dict(id=1, year=2012))
+        self.assertEqual(schemas.branch_search(dict(capacity="5")), dict(capacity=5))
+
+    def test_schema_bad(self):
+        """ Test compiled schemas report the first missing or invalid field in declared order"""
+        cases = [
+            (schemas.car_create, dict(model="530d"), "Missing make"),
+            (schemas.car_create, dict(make=1, model="530d"), "Invalid make"),
+            (schemas.car_create, dict(make="BMW", model="530d", year=2019, assigned_type=1), "Missing assigned_id"),
+            (schemas.car_update, dict(make="BMW"), "Missing id"),
+            (schemas.car_update, dict(id=1, assigned_type=1), "Missing assigned_id"),
+            (schemas.car_update, dict(id=1, assigned_id=1), "Missing assigned_type"),
+            (schemas.branch_create, dict(city="London", postcode="nope", capacity=1), "Invalid postcode"),
+            (schemas.driver_update, dict(id=1, dob="15/06/2012"), "Invalid dob"),
+        ]
+        for schema, data, message in cases:
+            with self.subTest(message=message):
+                with self.assertRaises(helpers.ApiError) as context:
+                    schema(data)
+                self.assertEqual(context.exception.status_code, 400)
+                self.assertEqual(context.exception.message, message)
+
     def tearDown(self):
         with self.app.app_context():
             # drop all tables